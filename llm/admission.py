@@ -0,0 +1,215 @@
+"""
+Admission queue for the RKLLM server.
+Requests wait here for a free model slot instead of being rejected while the
+NPU is busy. Waiting requests are served FIFO per API key and round-robin
+across keys, so one bursty client cannot starve the others.
+Tickets can carry a group (the model and LoRA adapter they run): a freed
+slot goes first to a waiting request of the group that just used it, so
+requests for the same adapter run back to back instead of switching the
+runtime for every request. At most `affinity_limit` such picks in a row
+may skip ahead of the round-robin order.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class QueueFull(Exception):
+    """Raised when max_depth requests are already waiting."""
+
+    def __init__(self, retry_after):
+        super().__init__("Request queue is full")
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Exception):
+    """Raised when a request waited longer than the queue's wait timeout."""
+
+    def __init__(self, waited, retry_after):
+        super().__init__(f"Timed out after {waited:.1f}s waiting for the model")
+        self.waited = waited
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A request's place in the queue, and later its model slot."""
+
+    def __init__(self, queue, key, group=None):
+        self.queue = queue
+        self.key = key
+        self.group = group
+        self.enqueued_at = time.time()
+        self.admitted_at = None
+        self.released = False
+        self.position = 0  # 0 = admitted without waiting
+        self.estimated_wait = 0.0
+
+    @property
+    def wait_time(self):
+        """Seconds spent waiting before admission (so far, if still queued)."""
+        end = self.admitted_at if self.admitted_at is not None else time.time()
+        return end - self.enqueued_at
+
+    def headers(self):
+        """Queue position and wait information for the HTTP response."""
+        return {
+            "X-Queue-Position": str(self.position),
+            "X-Queue-Estimated-Wait": f"{self.estimated_wait:.2f}",
+            "X-Queue-Wait": f"{self.wait_time:.3f}",
+        }
+
+    def release(self):
+        self.queue.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AdmissionQueue:
+    """
+    Bounded queue in front of a fixed number of model slots.
+
+    acquire() blocks until the caller owns a slot and returns a Ticket;
+    the slot is handed to the next waiter when the ticket is released.
+    """
+
+    def __init__(self, slots=1, max_depth=16, wait_timeout=120.0, default_service_time=5.0, affinity_limit=4):
+        self.slots = slots
+        self.affinity_limit = affinity_limit
+        self.max_depth = max_depth
+        self.wait_timeout = wait_timeout
+        self.avg_service_time = default_service_time
+        self._cond = threading.Condition()
+        self._waiting = OrderedDict()  # key -> deque of tickets, in round-robin order
+        self._depth = 0
+        self._active = 0
+        self.admitted_count = 0
+        self.rejected_count = 0
+        self.timeout_count = 0
+        self.affinity_picks = 0
+        self._affinity_streak = 0  # Consecutive picks that skipped ahead for affinity
+
+    def _position_for(self, key):
+        """1-based position a new ticket for `key` would have in the serving order."""
+        own = self._waiting.get(key)
+        ahead_in_key = len(own) if own else 0
+        position = ahead_in_key + 1
+        before_own = True
+        for other_key, tickets in self._waiting.items():
+            if other_key == key:
+                before_own = False
+                continue
+            # Round-robin serves every key once per turn, starting from the front
+            turns = ahead_in_key + 1 if before_own else ahead_in_key
+            position += min(len(tickets), turns)
+        return position
+
+    def _estimate_wait(self, position):
+        return (position - 1 + self._active) / max(self.slots, 1) * self.avg_service_time
+
+    def _next_key(self, prefer_group):
+        """Key to serve next: the first whose oldest ticket is in `prefer_group`, else the round-robin head."""
+        head = next(iter(self._waiting))
+        if prefer_group is None or self._waiting[head][0].group == prefer_group:
+            self._affinity_streak = 0
+            return head
+        if self._affinity_streak < self.affinity_limit:
+            for key, tickets in self._waiting.items():
+                if tickets[0].group == prefer_group:
+                    self._affinity_streak += 1
+                    self.affinity_picks += 1
+                    return key
+        self._affinity_streak = 0
+        return head
+
+    def _dispatch(self, prefer_group=None):
+        """Hand free slots to waiting tickets, one key at a time."""
+        admitted = False
+        while self._active < self.slots and self._waiting:
+            key = self._next_key(prefer_group)
+            prefer_group = None  # Only the slot just freed has a warm group
+            tickets = self._waiting[key]
+            ticket = tickets.popleft()
+            if tickets:
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+            self._depth -= 1
+            self._admit(ticket)
+            admitted = True
+        if admitted:
+            self._cond.notify_all()
+
+    def _admit(self, ticket):
+        ticket.admitted_at = time.time()
+        self._active += 1
+        self.admitted_count += 1
+
+    def acquire(self, key, timeout=None, group=None):
+        """
+        Wait for a model slot on behalf of `key` (usually the API key).
+        `group` is what the request will run, for affinity when slots free up.
+        Raises QueueFull or QueueTimeout instead of returning when the
+        request cannot be served.
+        """
+        timeout = self.wait_timeout if timeout is None else timeout
+        with self._cond:
+            ticket = Ticket(self, key, group)
+            if self._active < self.slots and not self._waiting:
+                self._admit(ticket)
+                return ticket
+
+            if self._depth >= self.max_depth:
+                self.rejected_count += 1
+                raise QueueFull(self._estimate_wait(self._depth + 1))
+
+            ticket.position = self._position_for(key)
+            ticket.estimated_wait = self._estimate_wait(ticket.position)
+            self._waiting.setdefault(key, deque()).append(ticket)
+            self._depth += 1
+            self._dispatch()
+
+            deadline = ticket.enqueued_at + timeout
+            while ticket.admitted_at is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    tickets = self._waiting[key]
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self._waiting[key]
+                    self._depth -= 1
+                    self.timeout_count += 1
+                    raise QueueTimeout(ticket.wait_time, self._estimate_wait(self._depth + 1))
+                self._cond.wait(remaining)
+            return ticket
+
+    def release(self, ticket):
+        """Return a ticket's slot to the queue. Safe to call more than once."""
+        with self._cond:
+            if ticket.released or ticket.admitted_at is None:
+                return
+            ticket.released = True
+            self._active -= 1
+            # Exponential moving average of how long a request holds the model
+            service_time = time.time() - ticket.admitted_at
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+            self._dispatch(prefer_group=ticket.group)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "slots": self.slots,
+                "active": self._active,
+                "waiting": self._depth,
+                "max_depth": self.max_depth,
+                "waiting_keys": len(self._waiting),
+                "avg_service_time_s": round(self.avg_service_time, 3),
+                "admitted": self.admitted_count,
+                "rejected": self.rejected_count,
+                "timed_out": self.timeout_count,
+                "affinity_picks": self.affinity_picks,
+            }
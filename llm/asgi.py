@@ -0,0 +1,212 @@
+"""
+ASGI front end for the RKLLM server, served by uvicorn.
+Requests are read on the event loop and handed to the Flask app on a bounded
+thread pool, so validation, admission and the non-streaming endpoints keep
+their code. Streaming bodies that support `async for` (SessionStream) are
+sent from the event loop instead: they wait for tokens on an asyncio queue
+that the runtime callback feeds through call_soon_threadsafe, so an open
+stream holds no thread and each token goes out as soon as it is decoded.
+Every send waits for the client to drain its socket, and a client that
+disconnects cancels its generation at once.
+"""
+
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+_END = object()
+
+
+def stream_error_events(e):
+    """Closing SSE events for a stream that failed: an OpenAI error object, then [DONE]"""
+    print(f"Error in streaming: {str(e)}")
+    error = {"error": {"message": f"Stream error: {str(e)}", "type": "server_error", "param": None, "code": None}}
+    return [f"data: {json.dumps(error)}\n\n", "data: [DONE]\n\n"]
+
+
+class SessionStream:
+    """
+    Streaming response body over a generation session. WSGI servers iterate
+    it on the request thread; the ASGI front end uses `async for`.
+    `start()` returns the session and runs when the body is first read,
+    `render(chunks)` turns a batch of output chunks (see
+    GenerationSession.batches) into one event and `finish(session)` yields
+    the closing events. A run still going when the stream ends is cancelled.
+    """
+
+    def __init__(self, start, render, finish, window=0.0, max_bytes=1024):
+        self.start = start
+        self.render = render
+        self.finish = finish
+        self.window = window
+        self.max_bytes = max_bytes
+
+    def __iter__(self):
+        session = self.start()
+        try:
+            for batch in session.batches(self.window, self.max_bytes):
+                yield self.render(batch)
+            yield from self.finish(session)
+        except Exception as e:
+            yield from stream_error_events(e)
+        finally:
+            if session.is_generating:
+                session.cancel()
+
+    async def __aiter__(self):
+        session = self.start()
+        try:
+            async for batch in session.abatches(self.window, self.max_bytes):
+                yield self.render(batch)
+            for event in self.finish(session):
+                yield event
+        except Exception as e:
+            for event in stream_error_events(e):
+                yield event
+        finally:
+            if session.is_generating:
+                session.cancel()
+
+
+class ASGIApp:
+    def __init__(self, flask_app, max_threads=32):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        environ = self._environ(scope, b"".join(body))
+
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(self.executor, self._dispatch, environ)
+        except Exception as e:
+            print(f"Unhandled error in {scope['method']} {scope['path']}: {e}", file=sys.stderr)
+            await send({"type": "http.response.start", "status": 500, "headers": [(b"content-type", b"text/plain")]})
+            await send({"type": "http.response.body", "body": b"Internal Server Error"})
+            return
+
+        # Completes when the client goes away
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            headers = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in response.get_wsgi_headers(environ).to_wsgi_list()
+            ]
+            await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+            if environ["REQUEST_METHOD"] == "HEAD" or response.status_code in (204, 304):
+                pass
+            elif hasattr(response.response, "__aiter__"):
+                await self._send_async(response.response, send, disconnected)
+            elif response.is_sequence:
+                await send({"type": "http.response.body", "body": b"".join(response.iter_encoded()), "more_body": True})
+            else:
+                await self._send_iterable(response.iter_encoded(), send, disconnected, loop)
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            # Runs call_on_close callbacks, such as releasing the admission ticket
+            await loop.run_in_executor(self.executor, response.close)
+
+    async def _send_async(self, body, send, disconnected):
+        """Send an async body from the event loop; a disconnect cancels it mid-wait"""
+        iterator = body.__aiter__()
+        try:
+            while True:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+                await asyncio.wait({next_chunk, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_chunk.done():
+                    next_chunk.cancel()
+                    await asyncio.wait({next_chunk})
+                    return
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    return
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            await iterator.aclose()
+
+    async def _send_iterable(self, iterable, send, disconnected, loop):
+        """Send a blocking body, one item per pool task, stopping after a disconnect"""
+        iterator = iter(iterable)
+        while not disconnected.done():
+            chunk = await loop.run_in_executor(self.executor, next, iterator, _END)
+            if chunk is _END:
+                return
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    def _dispatch(self, environ):
+        """Run the Flask handler for `environ` and return its Response, without consuming the body"""
+        app = self.flask_app
+        with app.request_context(environ):
+            try:
+                return app.full_dispatch_request()
+            except Exception as e:
+                return app.handle_exception(e)
+
+    @staticmethod
+    def _environ(scope, body):
+        """WSGI environ (PEP 3333) for an ASGI HTTP scope and its complete body"""
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_LENGTH":
+                continue
+            key = name if name == "CONTENT_TYPE" else f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
@@ -0,0 +1,380 @@
+"""
+Load benchmark for the server.
+
+Sweeps concurrency levels and prompt lengths over four scenarios:
+streaming chat (chat_stream), non-streaming chat (chat), /v1/completions
+(completion) and chat with a tool definition attached (tools). Every
+level is a closed loop of N workers, each sending its next request as
+soon as the previous one finishes. For each level it reports:
+- TTFT: the first content frame for streams, the whole request otherwise.
+- Inter-token latency: gaps between streamed content frames.
+- End-to-end latency, with p50/p95/p99 for all three.
+- Output tokens/s, taken from the usage the server returns.
+- Busy (429/503) and error rates.
+
+Results are written as JSON. `--compare` prints the change against an
+earlier run, so throughput regressions show up before a build goes to
+the devices. Only the standard library is used.
+
+    python3 benchmark.py --url http://localhost:1306 --output run.json
+    python3 benchmark.py --simulated --concurrency 1,2,4 --compare run.json
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+SERVER_URL = "http://localhost:1306"
+SCENARIOS = ("chat_stream", "chat", "completion", "tools")
+BUSY_STATUSES = (429, 503)
+
+# Roughly one token per word for the real tokenizers
+FILLER_WORDS = (
+    "the", "board", "runs", "a", "small", "language", "model", "on", "its", "npu", "and", "answers",
+    "questions", "about", "time", "weather", "people", "places", "with", "short", "clear", "replies",
+)
+
+TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "get_current_time_string",
+        "description": "Get the current time as a string",
+        "parameters": {"type": "object", "properties": {}},
+    },
+}]
+
+
+def make_prompt(prompt_tokens, nonce):
+    """About `prompt_tokens` tokens of filler. A nonce keeps the response cache from answering."""
+    words = [FILLER_WORDS[i % len(FILLER_WORDS)] for i in range(max(prompt_tokens - 8, 0))]
+    prefix = f"[{nonce}] " if nonce else ""
+    return prefix + " ".join(words) + "\nIn one sentence, what does the board do?"
+
+
+def request_body(scenario, model, prompt, max_tokens):
+    if scenario == "completion":
+        return "/v1/completions", {"model": model, "prompt": prompt, "max_tokens": max_tokens}
+    body = {"model": model, "messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens}
+    if scenario == "chat_stream":
+        body["stream"] = True
+        body["stream_options"] = {"include_usage": True}
+    elif scenario == "tools":
+        body["messages"][0]["content"] = prompt + " Also, what time is it?"
+        body["tools"] = TOOLS
+    return "/v1/chat/completions", body
+
+
+def run_request(url, scenario, model, prompt, max_tokens, timeout, api_key=None):
+    """Send one scenario request and time it"""
+    path, body = request_body(scenario, model, prompt, max_tokens)
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    return send_request(url, path, body, timeout, headers)
+
+
+def send_request(url, path, body, timeout, headers=None):
+    """POST `body` and time it. Returns a dict with outcome, status, latencies, token count and the timing block."""
+    headers = {"Content-Type": "application/json", **(headers or {})}
+    result = {"outcome": "ok", "status": None, "ttft": None, "e2e": None, "gaps": [], "tokens": 0, "timings": None}
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    started = time.perf_counter()
+    try:
+        conn.request("POST", path, json.dumps(body), headers)
+        response = conn.getresponse()
+        result["status"] = response.status
+        if response.status != 200:
+            response.read()
+            result["outcome"] = "busy" if response.status in BUSY_STATUSES else "error"
+        elif body.get("stream"):
+            read_stream(response, started, result)
+        else:
+            data = json.loads(response.read())
+            result["ttft"] = time.perf_counter() - started
+            result["tokens"] = data.get("usage", {}).get("completion_tokens", 0)
+            result["timings"] = data.get("timings")
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        result["outcome"] = "error"
+        result["error"] = str(e)
+    finally:
+        conn.close()
+    result["e2e"] = time.perf_counter() - started
+    return result
+
+
+def read_stream(response, started, result):
+    """Read SSE events, timing each content frame (a frame may carry several coalesced tokens)"""
+    last_frame = None
+    content_frames = 0
+    while True:
+        line = response.readline()
+        if not line:
+            raise ValueError("stream ended without [DONE]")
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            break
+        chunk = json.loads(payload)
+        if "error" in chunk:
+            raise ValueError(chunk["error"])
+        if chunk.get("usage"):
+            result["tokens"] = chunk["usage"].get("completion_tokens", 0)
+        if chunk.get("timings"):
+            result["timings"] = chunk["timings"]
+        choices = chunk.get("choices") or [{}]
+        if not choices[0].get("delta", {}).get("content"):
+            continue
+        now = time.perf_counter()
+        content_frames += 1
+        if last_frame is None:
+            result["ttft"] = now - started
+        else:
+            result["gaps"].append(now - last_frame)
+        last_frame = now
+    if not result["tokens"]:
+        result["tokens"] = content_frames
+
+
+def percentiles(samples):
+    """Nearest-rank p50/p95/p99 and the mean, in seconds; None without samples"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def rank(q):
+        return ordered[max(math.ceil(q * len(ordered)), 1) - 1]
+    return {
+        "p50": round(rank(0.50), 4),
+        "p95": round(rank(0.95), 4),
+        "p99": round(rank(0.99), 4),
+        "mean": round(sum(ordered) / len(ordered), 4),
+    }
+
+
+def run_level(url, scenario, concurrency, prompt_tokens, args):
+    """Run concurrency * requests_per_worker requests with `concurrency` in flight and summarize them"""
+    total = concurrency * args.requests_per_worker
+    nonce_base = "" if args.allow_cache else uuid.uuid4().hex[:8]
+    prompts = [make_prompt(prompt_tokens, f"{nonce_base}-{i}" if nonce_base else "") for i in range(total)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(
+            lambda prompt: run_request(url, scenario, args.model, prompt, args.max_tokens, args.timeout, args.api_key),
+            prompts,
+        ))
+    duration = time.perf_counter() - started
+
+    ok = [r for r in results if r["outcome"] == "ok"]
+    busy = sum(1 for r in results if r["outcome"] == "busy")
+    errors = len(results) - len(ok) - busy
+    tokens = sum(r["tokens"] for r in ok)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "prompt_tokens": prompt_tokens,
+        "requests": total,
+        "ok": len(ok),
+        "busy": busy,
+        "errors": errors,
+        "busy_rate": round(busy / total, 4),
+        "error_rate": round(errors / total, 4),
+        "duration_s": round(duration, 3),
+        "requests_per_s": round(len(ok) / duration, 3),
+        "output_tokens": tokens,
+        "output_tokens_per_s": round(tokens / duration, 3),
+        "ttft_s": percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "inter_token_s": percentiles([gap for r in ok for gap in r["gaps"]]),
+        "e2e_s": percentiles([r["e2e"] for r in ok]),
+        "status_codes": sorted({r["status"] for r in results if r["status"] is not None}),
+    }
+
+
+def get_json(url, path, timeout=5):
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return json.loads(response.read()) if response.status == 200 else None
+    except (OSError, http.client.HTTPException, ValueError):
+        return None
+    finally:
+        conn.close()
+
+
+def start_simulated_server(port, wait=60):
+    """Start server.py on the simulated runtime and wait until /health answers"""
+    llm_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, RKLLM_BACKEND="simulated")
+    log = open(os.path.join(tempfile.gettempdir(), f"benchmark-server-{port}.log"), "w")
+    process = subprocess.Popen([sys.executable, "server.py", "--port", str(port)],
+                               cwd=llm_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = urllib.parse.urlparse(f"http://127.0.0.1:{port}")
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Simulated server exited with code {process.returncode}, see {log.name}")
+        if get_json(url, "/health", timeout=1):
+            return process, url
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"Simulated server did not become healthy within {wait}s, see {log.name}")
+
+
+def format_ms(stats, key="p50"):
+    return f"{stats[key] * 1000:8.1f}" if stats else "       -"
+
+
+def print_table(levels):
+    print(f"{'scenario':<12} {'conc':>4} {'prompt':>6} {'ok':>4} {'busy%':>6} {'err%':>6} "
+          f"{'tok/s':>8} {'ttft50':>8} {'ttft95':>8} {'itl50':>8} {'itl95':>8} {'e2e50':>8} {'e2e95':>8} {'e2e99':>8}")
+    for level in levels:
+        print(f"{level['scenario']:<12} {level['concurrency']:>4} {level['prompt_tokens']:>6} {level['ok']:>4} "
+              f"{level['busy_rate'] * 100:>6.1f} {level['error_rate'] * 100:>6.1f} {level['output_tokens_per_s']:>8.2f} "
+              f"{format_ms(level['ttft_s'])} {format_ms(level['ttft_s'], 'p95')} "
+              f"{format_ms(level['inter_token_s'])} {format_ms(level['inter_token_s'], 'p95')} "
+              f"{format_ms(level['e2e_s'])} {format_ms(level['e2e_s'], 'p95')} {format_ms(level['e2e_s'], 'p99')}")
+    print("(latencies in ms)")
+
+
+def compare(levels, baseline_path, threshold):
+    """Print the change from a baseline run per level. Returns the number of regressions past `threshold` percent."""
+    with open(baseline_path) as f:
+        baseline = {
+            (level["scenario"], level["concurrency"], level["prompt_tokens"]): level
+            for level in json.load(f)["levels"]
+        }
+    regressions = 0
+    print(f"\nCompared with {baseline_path}:")
+    print(f"{'scenario':<12} {'conc':>4} {'prompt':>6} {'tok/s':>9} {'ttft95':>9} {'e2e95':>9} {'err%':>7}")
+    for level in levels:
+        old = baseline.get((level["scenario"], level["concurrency"], level["prompt_tokens"]))
+        if old is None:
+            continue
+
+        def change(new_value, old_value, higher_is_better):
+            nonlocal regressions
+            if not new_value or not old_value:
+                return "        -"
+            percent = (new_value - old_value) / old_value * 100
+            if (-percent if higher_is_better else percent) > threshold:
+                regressions += 1
+                return f"{percent:+8.1f}!"
+            return f"{percent:+8.1f} "
+
+        def p95(stats):
+            return stats["p95"] if stats else None
+
+        print(f"{level['scenario']:<12} {level['concurrency']:>4} {level['prompt_tokens']:>6} "
+              f"{change(level['output_tokens_per_s'], old['output_tokens_per_s'], True)} "
+              f"{change(p95(level['ttft_s']), p95(old['ttft_s']), False)} "
+              f"{change(p95(level['e2e_s']), p95(old['e2e_s']), False)} "
+              f"{(level['error_rate'] - old['error_rate']) * 100:+7.1f}")
+    print(f"(percent change; '!' marks a regression over {threshold:g}%)")
+    return regressions
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrency sweep benchmark for the server")
+    parser.add_argument("--url", default=SERVER_URL, help=f"Server base URL (default {SERVER_URL})")
+    parser.add_argument("--simulated", action="store_true", help="Start server.py on the simulated runtime and benchmark it")
+    parser.add_argument("--port", type=int, default=18306, help="Port for the --simulated server (default 18306)")
+    parser.add_argument("--model", default="luna-small", help="Model name to request (default luna-small)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 2, 4, 8], help="Comma-separated concurrency levels (default 1,2,4,8)")
+    parser.add_argument("--prompt-tokens", type=int_list, default=[32, 256], help="Comma-separated prompt lengths in tokens (default 32,256)")
+    parser.add_argument("--requests-per-worker", type=int, default=4, help="Requests each worker sends per level (default 4)")
+    parser.add_argument("--max-tokens", type=int, default=64, help="max_tokens per request (default 64)")
+    parser.add_argument("--warmup", type=int, default=1, help="Unrecorded requests per scenario before the sweep (default 1)")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request socket timeout in seconds (default 300)")
+    parser.add_argument("--api-key", help="Sent as a Bearer token")
+    parser.add_argument("--allow-cache", action="store_true", help="Send identical prompts, so response cache hits are measured too")
+    parser.add_argument("--output", help="JSON file for the results (default benchmark-<timestamp>.json)")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=10.0,
+                        help="Percent change counted as a regression by --compare; any regression exits with status 1 (default 10)")
+    args = parser.parse_args()
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    server = None
+    if args.simulated:
+        server, url = start_simulated_server(args.port)
+    else:
+        url = urllib.parse.urlparse(args.url)
+    base_url = f"http://{url.hostname}:{url.port or 80}"
+
+    try:
+        if get_json(url, "/health") is None:
+            print(f"Server at {base_url} is not healthy")
+            return 1
+        started_at = datetime.now(timezone.utc)
+        print(f"Benchmarking {base_url} ({args.model}): scenarios {scenarios}, concurrency {args.concurrency}, prompt tokens {args.prompt_tokens}")
+        for scenario in scenarios:
+            for _ in range(args.warmup):
+                run_request(url, scenario, args.model, make_prompt(16, uuid.uuid4().hex[:8]), args.max_tokens, args.timeout, args.api_key)
+
+        levels = []
+        for scenario in scenarios:
+            for prompt_tokens in args.prompt_tokens:
+                for concurrency in args.concurrency:
+                    level = run_level(url, scenario, concurrency, prompt_tokens, args)
+                    levels.append(level)
+                    print(f"  {scenario} x{concurrency} @ {prompt_tokens} tokens: {level['ok']}/{level['requests']} ok, "
+                          f"{level['output_tokens_per_s']} tok/s, busy {level['busy']}, errors {level['errors']}")
+
+        results = {
+            "meta": {
+                "url": base_url,
+                "simulated": args.simulated,
+                "model": args.model,
+                "started": started_at.isoformat(),
+                "version": (get_json(url, "/version") or {}).get("version"),
+                "host": platform.node(),
+                "settings": {
+                    "scenarios": scenarios,
+                    "concurrency": args.concurrency,
+                    "prompt_tokens": args.prompt_tokens,
+                    "requests_per_worker": args.requests_per_worker,
+                    "max_tokens": args.max_tokens,
+                    "allow_cache": args.allow_cache,
+                },
+            },
+            "levels": levels,
+        }
+        output = args.output or f"benchmark-{started_at.strftime('%Y%m%d-%H%M%S')}.json"
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+        print()
+        print_table(levels)
+        print(f"Results saved to {output}")
+        if args.compare and compare(levels, args.compare, args.regression_threshold):
+            return 1
+        return 0
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
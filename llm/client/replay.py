@@ -0,0 +1,187 @@
+"""
+Replay recorded traffic against the server.
+
+Reads the JSONL files the server writes when REQUEST_LOG_PATH (or
+--request_log) is set, and re-sends each request at its original offset
+from the first one. `--speed 2` halves the gaps and `--speed 0` sends as
+fast as `--max-in-flight` allows. Requests go out open loop: a slow server
+does not delay later arrivals, so the admission queue and caches see the
+same bursts the devices saw. Each recorded client is sent as its own
+bearer token, which keeps per-client fair queueing.
+
+The report puts the recorded and replayed status codes, queue waits and
+end-to-end latencies side by side, and is saved as JSON like benchmark.py.
+
+    python3 replay.py ../logs/requests.jsonl.1 ../logs/requests.jsonl --speed 4 --output replay.json
+"""
+
+import argparse
+import json
+import sys
+import time
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from benchmark import SERVER_URL, get_json, percentiles, send_request
+
+REPLAYABLE_PATHS = ("/v1/chat/completions", "/v1/completions", "/v1/embeddings", "/v1/score")
+
+
+def load_records(paths):
+    """Replayable records from the given files, by arrival time, and how many were skipped"""
+    records, skipped = [], Counter()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    skipped["unreadable"] += 1
+                    continue
+                if record.get("endpoint") not in REPLAYABLE_PATHS or not isinstance(record.get("request"), dict):
+                    skipped["not replayable"] += 1
+                elif record["request"].get("previous_response_id"):
+                    # Points at a response id only the recording server knows
+                    skipped["previous_response_id"] += 1
+                else:
+                    records.append(record)
+    records.sort(key=lambda record: record["arrival"])
+    return records, dict(skipped)
+
+
+def replay(url, records, speed, max_in_flight, timeout):
+    """Send every record at its (scaled) offset; returns one result per record, in order"""
+    first_arrival = records[0]["arrival"]
+    started = time.perf_counter()
+
+    def send(record, offset):
+        result = send_request(url, record["endpoint"], record["request"], timeout,
+                              {"Authorization": f"Bearer replay-{record.get('client', 'anonymous')}"})
+        result["lag"] = max(time.perf_counter() - started - offset - result["e2e"], 0.0)
+        return result
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        for record in records:
+            offset = (record["arrival"] - first_arrival) / speed if speed > 0 else 0.0
+            delay = offset - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send, record, offset))
+    return [future.result() for future in futures]
+
+
+def summarize(records, results):
+    """Recorded against replayed statuses and latencies, for a group of records"""
+    recorded_e2e = [r["duration_ms"] / 1000.0 for r in records if r.get("status") == 200 and "duration_ms" in r]
+    recorded_queue = [r["queue_ms"] / 1000.0 for r in records if "queue_ms" in r]
+    replayed_queue = [
+        result["timings"]["queue_ms"] / 1000.0 for result in results
+        if result["timings"] and "queue_ms" in result["timings"]
+    ]
+    ok = [result for result in results if result["outcome"] == "ok"]
+    return {
+        "requests": len(records),
+        "status_codes": {
+            "recorded": dict(Counter(str(r.get("status")) for r in records)),
+            "replayed": dict(Counter(str(result["status"]) for result in results)),
+        },
+        "busy_rate": round(sum(1 for result in results if result["outcome"] == "busy") / len(results), 4),
+        "error_rate": round(sum(1 for result in results if result["outcome"] == "error") / len(results), 4),
+        "e2e_s": {"recorded": percentiles(recorded_e2e), "replayed": percentiles([result["e2e"] for result in ok])},
+        "queue_s": {"recorded": percentiles(recorded_queue), "replayed": percentiles(replayed_queue)},
+        "ttft_s": percentiles([result["ttft"] for result in ok if result["ttft"] is not None]),
+        "output_tokens": sum(result["tokens"] for result in ok),
+    }
+
+
+def format_p(stats, key):
+    return f"{stats[key] * 1000:9.1f}" if stats else "        -"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay requests recorded by the server")
+    parser.add_argument("logs", nargs="+", help="Recorded JSONL files (rotated files may be given in any order)")
+    parser.add_argument("--url", default=SERVER_URL, help=f"Server base URL (default {SERVER_URL})")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time compression: 2 replays twice as fast, 0 without gaps (default 1)")
+    parser.add_argument("--limit", type=int, help="Replay only the first N requests")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="Requests open at once; later arrivals wait for a slot (default 64)")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request socket timeout in seconds (default 300)")
+    parser.add_argument("--output", help="JSON file for the report (default replay-<timestamp>.json)")
+    args = parser.parse_args()
+
+    records, skipped = load_records(args.logs)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("No replayable requests found")
+        return 1
+    url = urllib.parse.urlparse(args.url)
+    base_url = f"http://{url.hostname}:{url.port or 80}"
+    if get_json(url, "/health") is None:
+        print(f"Server at {base_url} is not healthy")
+        return 1
+
+    span = records[-1]["arrival"] - records[0]["arrival"]
+    print(f"Replaying {len(records)} requests spanning {span:.1f}s against {base_url} at {args.speed:g}x"
+          + (f" (skipped {skipped})" if skipped else ""))
+    started_at = datetime.now(timezone.utc)
+    wall_started = time.perf_counter()
+    results = replay(url, records, args.speed, args.max_in_flight, args.timeout)
+    wall = time.perf_counter() - wall_started
+
+    endpoints = {}
+    for endpoint in sorted({record["endpoint"] for record in records}):
+        pairs = [(record, result) for record, result in zip(records, results) if record["endpoint"] == endpoint]
+        endpoints[endpoint] = summarize([record for record, _ in pairs], [result for _, result in pairs])
+
+    report = {
+        "meta": {
+            "url": base_url,
+            "logs": args.logs,
+            "speed": args.speed,
+            "started": started_at.isoformat(),
+            "recorded_span_s": round(span, 3),
+            "replay_duration_s": round(wall, 3),
+            "skipped": skipped,
+            "version": (get_json(url, "/version") or {}).get("version"),
+        },
+        "overall": summarize(records, results),
+        "send_lag_s": percentiles([result["lag"] for result in results]),
+        "endpoints": endpoints,
+        "requests": [
+            {
+                "id": record.get("id"),
+                "endpoint": record["endpoint"],
+                "offset_s": round(record["arrival"] - records[0]["arrival"], 3),
+                "recorded_status": record.get("status"),
+                "recorded_ms": record.get("duration_ms"),
+                "replayed_status": result["status"],
+                "replayed_ms": round(result["e2e"] * 1000.0, 2),
+                "error": result.get("error"),
+            }
+            for record, result in zip(records, results)
+        ],
+    }
+    output = args.output or f"replay-{started_at.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n{'endpoint':<22} {'reqs':>5} {'busy%':>6} {'err%':>6} {'e2e50 rec':>9} {'e2e50 rep':>9} "
+          f"{'e2e95 rec':>9} {'e2e95 rep':>9} {'q95 rec':>9} {'q95 rep':>9}")
+    for endpoint, summary in list(endpoints.items()) + [("all", report["overall"])]:
+        e2e, queue = summary["e2e_s"], summary["queue_s"]
+        print(f"{endpoint:<22} {summary['requests']:>5} {summary['busy_rate'] * 100:>6.1f} {summary['error_rate'] * 100:>6.1f} "
+              f"{format_p(e2e['recorded'], 'p50')} {format_p(e2e['replayed'], 'p50')} "
+              f"{format_p(e2e['recorded'], 'p95')} {format_p(e2e['replayed'], 'p95')} "
+              f"{format_p(queue['recorded'], 'p95')} {format_p(queue['replayed'], 'p95')}")
+    lag = report["send_lag_s"]
+    print(f"(latencies in ms; send lag p95 {lag['p95'] * 1000:.1f} ms, raise --max-in-flight if it grows)")
+    print(f"Report saved to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
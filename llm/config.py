@@ -3,26 +3,74 @@ Configuration settings for the RKLLM server.
 This file centralizes all configurable parameters to make them easier to manage.
 """
 
+import os
+
 # Model Configuration
 SMALL_MODEL_PATH = "./model/Qwen3-0.6B-rk3588-w8a8-opt-0-hybrid-ratio-0.0.rkllm"
 LARGE_MODEL_PATH = "./model/Qwen3-0.6B-rk3588-w8a8-opt-0-hybrid-ratio-0.0.rkllm"
 TARGET_PLATFORM = "rk3588"
 
+# Models served by name in the `model` field; loaded on first use
+MODELS = {
+    "luna-small": SMALL_MODEL_PATH,
+    "luna-large": LARGE_MODEL_PATH,
+}
+MODEL_MEMORY_BUDGET_MB = 6000  # Least recently used idle models are released beyond this
+AUTO_MODEL_NAME = "luna-auto"  # Requests for this model are routed by difficulty
+AUTO_SMALL_MODEL = "luna-small"
+AUTO_LARGE_MODEL = "luna-large"  # Used for tool calls and prompts over AUTO_LARGE_PROMPT_TOKENS
+AUTO_LARGE_PROMPT_TOKENS = 1500
+
+# LoRA adapters selected per request as "<base>:<name>" (also registered at runtime via /v1/adapters)
+LORA_ADAPTERS = {
+    # "pirate": {"path": "./lora/pirate.rkllm", "base": "luna-large", "scale": 1.0},
+}
+
 # "../model/Gemma3-1B-w8a8-opt1.rkllm"
 LIBRARY_PATH = "./src/librkllmrt.so"  # Path to the RKLLM runtime library
+# "rkllm" loads LIBRARY_PATH; "simulated" runs without an NPU (simulated_runtime.py)
+RKLLM_BACKEND = os.environ.get("RKLLM_BACKEND", "rkllm")
+SIMULATED_PREFILL_TPS = 400.0  # Prompt tokens per second
+SIMULATED_DECODE_TPS = 15.0  # Generated tokens per second
+SIMULATED_REPLY_TOKENS = 48  # Tokens per reply, unless max_tokens ends it sooner
+SIMULATED_MEMORY_MB = 1200.0  # Reported in RKLLMPerfStat.memory_usage_mb
+SIMULATED_ERROR_RATE = 0.0  # Share of runs that fail with RKLLM_RUN_ERROR
+TOKENIZER_PATH = "./model/tokenizer.json"  # Hugging Face tokenizer.json of the model, used for token counting
+TOKEN_COUNT_CACHE_SIZE = 2048  # Token counts kept in the LRU cache
 
 # Server Configuration
 SERVER_HOST = "0.0.0.0"
 SERVER_PORT = 1306
 API_BASE_PATH = "/v1"
 API_KEY = "anything"  # Default API key for authentication (can be any string)
+ASGI_THREADS = 32  # Threads running request handlers under uvicorn; open streams hold none
+
+# Request Queue Configuration
+QUEUE_MAX_DEPTH = 16  # Requests allowed to wait for the model before answering 429
+QUEUE_WAIT_TIMEOUT = 120  # Seconds a queued request may wait before giving up
+QUEUE_DEFAULT_SERVICE_TIME = 5.0  # Seconds per request assumed for wait estimates until measured
+ADAPTER_AFFINITY_MAX_SKIPS = 4  # Queued requests for the adapter just used that may go ahead of the round-robin order in a row
 
 # Model Parameters
 MAX_CONTEXT_LENGTH = 16000  # Must be less than model's max_context_limit of 4096
 MAX_NEW_TOKENS = -1  # -1 means no limit
+DEFAULT_MAX_TOKENS = 1024  # Per-request token budget when a request sets no max_tokens
+MAX_STOP_SEQUENCES = 4  # Stop strings allowed per request (OpenAI allows 4)
 N_KEEP = 15999  # Must be less than MAX_CONTEXT_LENGTH
+CONTEXT_RESERVE_TOKENS = 64  # Context left for the chat template and message separators when fitting prompts
 CPU_CORE_COUNT = 4   # Number of CPU cores to use
 ENABLED_CPU_MASK = (1 << 4)|(1 << 5)|(1 << 6)|(1 << 7)
+
+# Worker pool: one model instance per entry can run at the same time, each
+# pinned to an NPU domain and a set of CPU cores. The RK3588 has three NPU
+# cores; add entries (e.g. domains 1 and 2 on cores 0-3) for small models
+# that fit in memory several times.
+NPU_WORKERS = [
+    {"base_domain_id": 0, "cpu_mask": ENABLED_CPU_MASK},
+]
+PRELOAD_INSTANCES = 1  # Instances of the default model loaded at startup
+WARMUP_PROMPT = "Hello"  # Generated once on each preloaded instance before the server reports ready; None skips the warm-up
+WARMUP_MAX_TOKENS = 4  # Tokens the warm-up generates
 USE_GPU = True
 IS_ASYNC = False
 
@@ -37,6 +85,55 @@ LOG_LEVEL = 2  # 0: Error, 1: Warning, 2: Info, 3: Debug
 # Inference Modes
 KEEP_HISTORY = 0 # 0 = no history, 1 = keep history
 
+# Conversation Sessions (runtime history reused across turns via session_id / previous_response_id)
+CONVERSATION_TTL = 600  # Seconds an idle conversation is kept
+CONVERSATION_MAX = 64  # Conversations tracked at once
+CONVERSATION_MAX_RESPONSES = 256  # Responses of requests without a session kept for previous_response_id
+CONVERSATION_MAX_HISTORY_TOKENS = 14000  # Full prefill (with truncation) once the runtime history is this long
+
+# Tools (--tools_dir)
+TOOL_TIMEOUT = 10.0  # Seconds a tool call may run unless the tool sets its own timeout
+TOOL_MAX_STUCK_CALLS = 4  # Timed-out calls of one tool still running before further calls to it are refused
+TOOL_RELOAD_INTERVAL = 2.0  # Seconds between checks for changed tool files; 0 disables hot reload
+
+# Embeddings (/v1/embeddings)
+EMBEDDING_POOLING = "mean"  # "mean" over all tokens or the "last" token's hidden state
+EMBEDDING_NORMALIZE = True  # L2-normalize vectors so dot product equals cosine similarity
+EMBEDDING_MAX_INPUTS = 64  # Inputs allowed per request
+EMBEDDING_CACHE_SIZE = 4096  # Vectors kept in memory by content hash
+
+# Scoring (/v1/score)
+SCORE_MAX_PROMPTS = 32  # Prompts scored per request
+SCORE_MAX_CANDIDATES = 32  # Candidates per prompt
+SCORE_MAX_CANDIDATE_TOKENS = 16  # Tokens per candidate; every token after the first costs a prefill of prompt + candidate prefix
+
+# Response Cache (sampling is greedy, so identical prompts give identical responses)
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_MAX_MB = 32  # Total size of cached responses kept in memory
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+RESPONSE_CACHE_DIR = None  # Directory to persist cached responses across restarts, e.g. "./cache/responses"
+RESPONSE_CACHE_REPLAY_CHUNK_CHARS = 16  # Characters per SSE chunk when streaming a cached response
+RESPONSE_CACHE_REPLAY_DELAY = 0.0  # Seconds between replayed chunks; 0 sends them at once
+
+# Streaming
+SSE_COALESCE_WINDOW_MS = 0  # Tokens arriving this long after the first go in the same frame; 0 only merges tokens that queued up
+SSE_COALESCE_MAX_BYTES = 1024  # A frame is sent once its text reaches this size
+
+# Metrics
+METRICS_WINDOW = 1024  # Recent samples per metric that /metrics percentiles are computed over
+
+# Request Recording (traffic captured for client/replay.py)
+REQUEST_LOG_PATH = None  # JSONL file every API request is appended to, e.g. "./logs/requests.jsonl"; None turns recording off
+REQUEST_LOG_MAX_MB = 64  # Rotate the file once it grows past this size
+REQUEST_LOG_BACKUPS = 5  # Rotated files kept: requests.jsonl.1 (newest) ... requests.jsonl.5
+REQUEST_LOG_CONTENT = True  # Record message and prompt text; False replaces it with filler of the same length
+
+# Prompt Prefix Cache (KV cache of the system prompt and tool instructions)
+PREFIX_CACHE_ENABLED = True
+PREFIX_CACHE_DIR = "./cache/prefix"  # Where runtime prompt-cache files are saved
+PREFIX_CACHE_MAX_MB = 512  # Total size of cache files kept on disk
+PREFIX_CACHE_MIN_CHARS = 200  # Shorter prefixes are not worth a cache file
+
 
 # Formatting
 
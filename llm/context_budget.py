@@ -0,0 +1,108 @@
+"""
+Context window budgeting for the RKLLM server.
+Prompts are fitted to MAX_CONTEXT_LENGTH minus the room the answer needs,
+counting real tokens. The system prompt and tool instructions are pinned,
+and the oldest turns are dropped first (replaced by a one-line note) so the
+latest messages always survive. Per-message counts come from the shared
+TokenCounter, whose cache keeps them across the turns of a conversation.
+"""
+
+import threading
+
+
+class ContextBudgeter:
+    def __init__(self, counter, max_context, reserve_tokens=64):
+        """
+        `reserve_tokens` covers what the runtime adds around the prompt
+        (chat template, special tokens) and the separators between messages.
+        """
+        self.counter = counter
+        self.max_context = max_context
+        self.reserve_tokens = reserve_tokens
+        self._lock = threading.Lock()
+        self.trimmed_prompts = 0
+        self.dropped_messages = 0
+        self.truncated_messages = 0
+
+    def prompt_budget(self, max_tokens=None):
+        """Tokens available for the prompt when `max_tokens` must still fit after it"""
+        answer = min(max_tokens or 0, self.max_context // 2)
+        return max(self.max_context - answer - self.reserve_tokens, 0)
+
+    def fits_after(self, history_tokens, text, max_tokens=None):
+        """Whether `text` can be prefilled on top of `history_tokens` of runtime history with room for `max_tokens`"""
+        return history_tokens + self.counter.count(text) <= self.prompt_budget(max_tokens)
+
+    def truncate_text(self, text, budget):
+        """Keep the end of `text` within `budget` tokens, cutting at a word boundary"""
+        if self.counter.count(text) <= budget:
+            return text
+        # Binary search for the earliest start offset whose tail fits
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high) // 2
+            if self.counter.count(text[middle:]) <= budget:
+                high = middle
+            else:
+                low = middle + 1
+        space = text.find(" ", low)
+        if 0 <= space < len(text) - 1:
+            low = space + 1
+        with self._lock:
+            self.truncated_messages += 1
+        return text[low:]
+
+    def fit(self, prefix, parts, suffix="", max_tokens=None):
+        """
+        Fit `prefix` + `parts` (rendered messages, oldest first) + `suffix` into
+        the budget. The prefix and suffix are kept whole, the newest parts are
+        kept first, and the newest part is cut from the front if it alone does
+        not fit. Returns the parts to use, with a note in place of dropped ones.
+        """
+        budget = self.prompt_budget(max_tokens) - self.counter.count(prefix) - self.counter.count(suffix)
+        counts = self.counter.count_batch(parts)
+        if sum(counts) + len(parts) <= budget:
+            return list(parts)
+
+        kept = []
+        used = 0
+        for part, count in zip(reversed(parts), reversed(counts)):
+            if used + count + 1 > budget:
+                break
+            kept.append(part)
+            used += count + 1
+        kept.reverse()
+
+        dropped = len(parts) - len(kept)
+        if not kept and parts:
+            # Even the newest message is too long: keep its role label and as much of its end as fits
+            label, separator, body = parts[-1].partition(": ")
+            if not separator or len(label) > 20:
+                label, separator, body = "", "", parts[-1]
+            head = label + separator
+            kept = [head + self.truncate_text(body, max(budget - 1 - self.counter.count(head), 0))]
+            dropped -= 1
+        elif dropped:
+            note = f"[{dropped} earlier message{'s' if dropped != 1 else ''} omitted to fit the context window]"
+            note_tokens = self.counter.count(note) + 1
+            # Make room for the note by dropping one more old message if needed
+            while kept[1:] and used + note_tokens > budget:
+                used -= self.counter.count(kept.pop(0)) + 1
+                dropped += 1
+                note = f"[{dropped} earlier messages omitted to fit the context window]"
+            kept.insert(0, note)
+
+        with self._lock:
+            self.trimmed_prompts += 1
+            self.dropped_messages += max(dropped, 0)
+        print(f"Prompt trimmed to fit the context window: dropped {max(dropped, 0)} of {len(parts)} messages")
+        return kept
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_context": self.max_context,
+                "trimmed_prompts": self.trimmed_prompts,
+                "dropped_messages": self.dropped_messages,
+                "truncated_messages": self.truncated_messages,
+            }
@@ -0,0 +1,157 @@
+"""
+Server-side conversation sessions for the RKLLM server.
+A conversation remembers which messages the runtime already holds in its
+history (keep_history=1), so the next turn only has to prefill the new
+messages. When the client edits earlier messages, or another request used
+the model in between, the turn falls back to a full prefill.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def message_fingerprint(message):
+    """Stable hash of the parts of a message that end up in the prompt"""
+    content = message.get('content') or ''
+    if isinstance(content, str):
+        content = content.strip()
+    data = json.dumps([message.get('role', ''), content, message.get('tool_calls')], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class Conversation:
+    def __init__(self, conversation_id):
+        self.id = conversation_id
+        self.messages = []  # Everything the runtime history holds, including our replies
+        self.fingerprints = []
+        self.history_tokens = 0
+        self.turns = 0
+        self.reused_turns = 0
+        self.last_used = time.time()
+        self.response_ids = []
+
+    def resolve_messages(self, messages, append_only=False):
+        """
+        Full message list for this turn. With previous_response_id the client
+        may send only the new messages; those are appended to the stored ones.
+        """
+        if append_only and not self.starts_with_history(messages):
+            return self.messages + list(messages)
+        return list(messages)
+
+    def starts_with_history(self, messages):
+        n = len(self.fingerprints)
+        if n == 0 or len(messages) <= n:
+            return False
+        return [message_fingerprint(m) for m in messages[:n]] == self.fingerprints
+
+    def new_messages(self, messages):
+        """Messages after the stored history, or None if the history diverged"""
+        if not self.starts_with_history(messages):
+            return None
+        return messages[len(self.fingerprints):]
+
+    def commit(self, messages, reply, history_tokens):
+        """Record what the runtime history holds after a turn"""
+        self.messages = list(messages) + [{"role": "assistant", "content": reply}]
+        self.fingerprints = [message_fingerprint(m) for m in self.messages]
+        self.history_tokens = history_tokens
+        self.turns += 1
+        self.last_used = time.time()
+
+
+class ConversationStore:
+    """
+    Conversations by id, expired after `ttl` seconds idle and capped at `max_conversations`.
+    Responses of requests without a conversation are kept apart, capped at
+    `max_responses`, and only become a conversation when a later request
+    continues them, so one-shot traffic does not evict live sessions.
+    """
+
+    def __init__(self, ttl=600, max_conversations=64, max_responses=256):
+        self.ttl = ttl
+        self.max_conversations = max_conversations
+        self.max_responses = max_responses
+        self._conversations = OrderedDict()
+        self._by_response_id = {}
+        self._responses = OrderedDict()  # response id -> (messages, reply, time) of stateless requests
+        self._lock = threading.Lock()
+        self.expired = 0
+
+    def _expire(self):
+        now = time.time()
+        while self._conversations:
+            conversation = next(iter(self._conversations.values()))
+            if now - conversation.last_used < self.ttl and len(self._conversations) <= self.max_conversations:
+                break
+            self._drop(conversation)
+        while self._responses:
+            _, _, created = next(iter(self._responses.values()))
+            if now - created < self.ttl and len(self._responses) <= self.max_responses:
+                break
+            self._responses.popitem(last=False)
+
+    def _drop(self, conversation):
+        self._conversations.pop(conversation.id, None)
+        for response_id in conversation.response_ids:
+            self._by_response_id.pop(response_id, None)
+        self.expired += 1
+
+    def _get_or_create(self, conversation_id):
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            conversation = Conversation(conversation_id)
+            self._conversations[conversation_id] = conversation
+        self._conversations.move_to_end(conversation_id)
+        self._expire()  # The new conversation may take the store past max_conversations
+        conversation.last_used = time.time()
+        return conversation
+
+    def get_or_create(self, conversation_id):
+        with self._lock:
+            self._expire()
+            return self._get_or_create(conversation_id)
+
+    def by_response_id(self, response_id):
+        with self._lock:
+            self._expire()
+            conversation = self._by_response_id.get(response_id)
+            if conversation is not None:
+                self._conversations.move_to_end(conversation.id)
+                conversation.last_used = time.time()
+                return conversation
+            response = self._responses.pop(response_id, None)
+            if response is None:
+                return None
+            # Continuing a stateless response starts a conversation; the runtime
+            # history does not hold it, so its first turn is prefilled in full
+            messages, reply, _ = response
+            conversation = self._get_or_create(response_id)
+            conversation.commit(messages, reply, 0)
+            conversation.response_ids.append(response_id)
+            self._by_response_id[response_id] = conversation
+            return conversation
+
+    def add_response_id(self, conversation, response_id):
+        with self._lock:
+            conversation.response_ids.append(response_id)
+            self._by_response_id[response_id] = conversation
+
+    def add_response(self, response_id, messages, reply):
+        """Keep a stateless request's messages and reply so `response_id` can be continued"""
+        with self._lock:
+            self._responses[response_id] = (list(messages), reply, time.time())
+            self._expire()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": len(self._conversations),
+                "responses": len(self._responses),
+                "expired": self.expired,
+                "turns": sum(c.turns for c in self._conversations.values()),
+                "reused_turns": sum(c.reused_turns for c in self._conversations.values()),
+            }
@@ -0,0 +1,89 @@
+"""
+Embeddings for the RKLLM server.
+Texts are prefilled in RKLLM_INFER_GET_LAST_HIDDEN_LAYER mode and the
+hidden states the runtime returns are pooled into one float32 vector per
+text. Vectors are cached by a hash of (model, pooling, text), since RAG
+ingestion often embeds the same chunks again.
+"""
+
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+POOLING_MODES = ("mean", "last")
+
+
+def hidden_states_to_array(hidden_layer):
+    """Copy an RKLLMResultLastHiddenLayer out of the runtime's buffer as a (num_tokens, embd_size) array"""
+    if not hidden_layer.hidden_states or hidden_layer.num_tokens <= 0 or hidden_layer.embd_size <= 0:
+        return None
+    shape = (hidden_layer.num_tokens, hidden_layer.embd_size)
+    # The buffer is only valid during the callback, so copy it
+    return np.ctypeslib.as_array(hidden_layer.hidden_states, shape=shape).astype(np.float32, copy=True)
+
+
+def pool(hidden_states, mode="mean", normalize=True):
+    """Pool (num_tokens, embd_size) hidden states into a single float32 vector"""
+    if mode == "last":
+        vector = hidden_states[-1]
+    else:
+        vector = hidden_states.mean(axis=0)
+    vector = vector.astype(np.float32, copy=False)
+    if normalize:
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+    return vector
+
+
+def encode_vector(vector, encoding_format="float"):
+    """Vector in the OpenAI response format: a list of floats, or base64 of little-endian float32"""
+    if encoding_format == "base64":
+        return base64.b64encode(vector.astype('<f4').tobytes()).decode('ascii')
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """LRU of pooled vectors keyed by a hash of (model, pooling, text)."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model, pooling, text):
+        return hashlib.blake2b(f"{model}\0{pooling}\0{text}".encode('utf-8'), digest_size=16).digest()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._vectors.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._vectors[key] = vector
+            self._vectors.move_to_end(key)
+            while len(self._vectors) > self.max_entries:
+                self._vectors.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._vectors),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
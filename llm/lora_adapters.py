@@ -0,0 +1,133 @@
+"""
+LoRA adapter registry for the RKLLM server.
+Adapters are registered by name together with the base model they were
+trained for, from LORA_ADAPTERS in config.py or through /v1/adapters, so
+persona and task variants share one loaded base model. A request selects
+one with `"model": "<base>:<adapter>"`, `"model": "<adapter>"` or the
+`adapter` extension field.
+
+Each RKLLM instance loads an adapter (rkllm_load_lora) the first time it
+runs with it and keeps it for the life of the handle. The runtime cannot
+unload an adapter, so removing one only stops new requests from selecting it.
+"""
+
+import os
+import re
+import threading
+
+RESERVED_NAMES = ("default",)  # Runtime name of the --lora_model_path adapter
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+class Adapter:
+    def __init__(self, name, path, base, scale=1.0):
+        self.name = name
+        self.path = path
+        self.base = base  # Model name (key of MODELS) the adapter applies to
+        self.scale = scale
+        self.requests = 0
+
+    @property
+    def model_id(self):
+        """Name under which the adapter is listed by /v1/models"""
+        return f"{self.base}:{self.name}"
+
+    def to_dict(self):
+        return {
+            "id": self.name,
+            "object": "adapter",
+            "model": self.model_id,
+            "base": self.base,
+            "path": self.path,
+            "scale": self.scale,
+            "requests": self.requests,
+        }
+
+
+class AdapterRegistry:
+    def __init__(self, models):
+        """`models` maps base model names to model paths (the model registry's mapping)"""
+        self.models = models
+        self._adapters = {}
+        self._lock = threading.Lock()
+        self.loads = 0  # rkllm_load_lora calls across all instances
+        self.switches = 0  # Runs whose adapter differed from the instance's previous run
+
+    def register(self, name, path, base, scale=1.0):
+        """Add an adapter; raises ValueError for a bad name, base, path or scale"""
+        if not isinstance(name, str) or not _NAME_PATTERN.match(name):
+            raise ValueError("Adapter names may only contain letters, digits, '_', '.' and '-'")
+        if name in RESERVED_NAMES or name in self.models:
+            raise ValueError(f"'{name}' is reserved or already a model name")
+        if base not in self.models:
+            raise ValueError(f"Unknown base model '{base}'; expected one of {list(self.models)}")
+        if not isinstance(path, str) or not os.path.exists(path):
+            raise ValueError(f"Adapter file not found: {path}")
+        if not isinstance(scale, (int, float)) or isinstance(scale, bool) or not 0.0 < scale <= 4.0:
+            raise ValueError("'scale' must be a number in (0, 4]")
+        with self._lock:
+            if name in self._adapters:
+                raise ValueError(f"Adapter '{name}' is already registered")
+            adapter = Adapter(name, path, base, float(scale))
+            self._adapters[name] = adapter
+        return adapter
+
+    def remove(self, name):
+        """Unregister an adapter; returns it, or None if it was not registered"""
+        with self._lock:
+            return self._adapters.pop(name, None)
+
+    def get(self, name):
+        return self._adapters.get(name)
+
+    def for_base(self, base):
+        with self._lock:
+            return [adapter for adapter in self._adapters.values() if adapter.base == base]
+
+    def list(self):
+        with self._lock:
+            return list(self._adapters.values())
+
+    def resolve(self, model, adapter=None):
+        """
+        Split a request's `model` and `adapter` fields into (model, adapter)
+        where adapter is an Adapter or None. `model` may be "<base>:<adapter>"
+        or an adapter name; the adapter's base model is used either way. Other
+        names, including ones with a colon such as "qwen3:0.6b", are returned
+        unchanged for the usual model selection.
+        Raises KeyError for an unknown `adapter` field and ValueError when
+        `model` names a different base model than the adapter's.
+        """
+        if adapter is None and isinstance(model, str):
+            base, _, name = model.rpartition(":")
+            if base and name in self._adapters:
+                model, adapter = base, name
+            elif model in self._adapters:
+                model, adapter = None, model
+        if adapter is None:
+            return model, None
+        selected = self._adapters.get(adapter)
+        if selected is None:
+            raise KeyError(f"Adapter '{adapter}' is not registered")
+        if model in self.models and model != selected.base:
+            raise ValueError(f"Adapter '{adapter}' is for {selected.base}, not {model}")
+        with self._lock:
+            selected.requests += 1
+        return selected.base, selected
+
+    def record_load(self):
+        with self._lock:
+            self.loads += 1
+
+    def record_switch(self):
+        with self._lock:
+            self.switches += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "registered": [adapter.model_id for adapter in self._adapters.values()],
+                "requests": {adapter.name: adapter.requests for adapter in self._adapters.values()},
+                "loads": self.loads,
+                "switches": self.switches,
+            }
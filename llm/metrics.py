@@ -0,0 +1,180 @@
+"""
+Request metrics for the RKLLM server, exported in Prometheus text format.
+Latency and throughput samples go into fixed-size ring buffers backed by
+`array`, so recording one is an index bump and a store, and percentiles
+cover the most recent samples instead of only the last request.
+Inter-token latency is also kept as a cumulative histogram.
+"""
+
+import bisect
+import math
+import threading
+from array import array
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Seconds between consecutive tokens of a generation
+INTER_TOKEN_BUCKETS = (0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0)
+
+
+class RingBuffer:
+    """The last `size` float samples"""
+
+    def __init__(self, size):
+        self.size = size
+        self.samples = array('d', bytes(8 * size))
+        self.index = 0
+        self.count = 0  # Samples ever added
+
+    def add(self, value):
+        self.samples[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count += 1
+
+    def sorted(self):
+        return sorted(self.samples[:min(self.count, self.size)])
+
+
+def quantile(sorted_samples, q):
+    """Nearest-rank quantile of already sorted samples; NaN without samples"""
+    if not sorted_samples:
+        return math.nan
+    rank = max(math.ceil(q * len(sorted_samples)), 1)
+    return sorted_samples[rank - 1]
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def format_value(value):
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metric(name, metric_type, help_text, samples):
+    """
+    Prometheus text lines for one metric. `samples` is a list of
+    (suffix, labels, value); suffix is appended to the name (e.g. "_sum").
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+    return lines
+
+
+class Summary:
+    """Quantiles of the recent samples, plus the all-time sum and count"""
+
+    def __init__(self, name, help_text, window=1024):
+        self.name = name
+        self.help_text = help_text
+        self.ring = RingBuffer(window)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.ring.add(value)
+            self.sum += value
+
+    def quantiles(self):
+        with self._lock:
+            samples = self.ring.sorted()
+        return {q: quantile(samples, q) for q in QUANTILES}
+
+    def render(self):
+        quantiles = self.quantiles()
+        with self._lock:
+            total, count = self.sum, self.ring.count
+        samples = [("", {"quantile": q}, value) for q, value in quantiles.items()]
+        samples += [("_sum", None, total), ("_count", None, count)]
+        return render_metric(self.name, "summary", self.help_text, samples)
+
+
+class Histogram:
+    """Cumulative bucket counts, for latencies recorded too often to keep every sample"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = array('Q', bytes(8 * (len(self.buckets) + 1)))  # Last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(("_bucket", {"le": "+Inf" if math.isinf(bound) else repr(bound)}, cumulative))
+        samples += [("_sum", None, total), ("_count", None, cumulative)]
+        return render_metric(self.name, "histogram", self.help_text, samples)
+
+
+class RequestMetrics:
+    """Per-generation and per-request samples recorded by the server"""
+
+    def __init__(self, window=1024):
+        self.ttft = Summary("luna_time_to_first_token_seconds", "Time from the start of prefill to the first token", window)
+        self.prefill_tps = Summary("luna_prefill_tokens_per_second", "Prefill speed of a generation", window)
+        self.decode_tps = Summary("luna_decode_tokens_per_second", "Decode speed of a generation", window)
+        self.queue_wait = Summary("luna_queue_wait_seconds", "Time a request waited in the admission queue", window)
+        self.memory = Summary("luna_memory_usage_mb", "Runtime memory usage reported after a generation", window)
+        self.inter_token = Histogram("luna_inter_token_latency_seconds", "Time between consecutive tokens", INTER_TOKEN_BUCKETS)
+        self._lock = threading.Lock()
+        self.generations = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+
+    def record_generation(self, ttft, prefill_tps, decode_tps, prompt_tokens, generated_tokens, memory_mb=0.0):
+        self.ttft.observe(ttft)
+        if prefill_tps > 0:
+            self.prefill_tps.observe(prefill_tps)
+        if decode_tps > 0:
+            self.decode_tps.observe(decode_tps)
+        if memory_mb > 0:
+            self.memory.observe(memory_mb)
+        with self._lock:
+            self.generations += 1
+            self.prompt_tokens += prompt_tokens
+            self.generated_tokens += generated_tokens
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def render(self):
+        """Prometheus text lines for the recorded samples and counters"""
+        lines = []
+        for metric in (self.ttft, self.inter_token, self.prefill_tps, self.decode_tps, self.queue_wait, self.memory):
+            lines += metric.render()
+        with self._lock:
+            counters = (
+                ("luna_generations_total", "Finished generations", self.generations),
+                ("luna_generation_errors_total", "Generations that failed in the runtime", self.errors),
+                ("luna_prompt_tokens_total", "Prompt tokens prefilled", self.prompt_tokens),
+                ("luna_generated_tokens_total", "Tokens decoded", self.generated_tokens),
+            )
+        for name, help_text, value in counters:
+            lines += render_metric(name, "counter", help_text, [("", None, value)])
+        return lines
@@ -0,0 +1,225 @@
+"""
+Model registry for the RKLLM server.
+Holds several RKLLM handles at once, keyed by the OpenAI `model` name.
+Each model can run as a pool of up to `instances` handles, one per worker
+slot (NPU domain and CPU mask), so small models serve requests in parallel.
+Requests go to the least-loaded idle instance; new instances are loaded on
+first use and the least recently used idle ones are released when loading
+another would exceed the memory budget. Memory is tracked with the
+memory_usage_mb the runtime reports after each run, and estimated from the
+model file size until then.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class LoadedModel:
+    def __init__(self, name, path, worker, memory_mb):
+        self.name = name
+        self.path = path
+        self.worker = worker  # Worker slot the instance is pinned to
+        self.model = None  # RKLLM instance, None while loading
+        self.memory_mb = memory_mb
+        self.busy = True
+        self.busy_since = time.time()
+        self.busy_time = 0.0
+        self.loaded_at = self.busy_since
+        self.last_used = self.loaded_at
+        self.runs = 0
+        self.errors = 0
+
+    @property
+    def key(self):
+        return (self.name, self.worker)
+
+    def to_dict(self):
+        return {
+            "model": self.name,
+            "worker": self.worker,
+            "loaded": self.model is not None,
+            "busy": self.busy,
+            "memory_mb": round(self.memory_mb, 2),
+            "runs": self.runs,
+            "errors": self.errors,
+            "busy_s": round(self.busy_time, 2),
+            "idle_s": round(time.time() - self.last_used, 1),
+        }
+
+
+class ModelRegistry:
+    def __init__(self, models, loader, memory_budget_mb, default_model, instances=1):
+        """
+        `models` maps model names to model file paths. `loader(name, path, worker)`
+        returns an initialized RKLLM instance with a release() method, pinned
+        to worker slot `worker` (0 <= worker < instances).
+        """
+        self.models = dict(models)
+        self.loader = loader
+        self.memory_budget_mb = memory_budget_mb
+        self.default_model = default_model
+        self.instances = max(1, instances)
+        self._loaded = OrderedDict()  # (name, worker) -> LoadedModel, least recently used first
+        self._cond = threading.Condition()
+        self.loads = 0
+        self.evictions = 0
+
+    def resolve(self, name):
+        """Registered model name for a request's `model` field; unknown names get the default model"""
+        return name if name in self.models else self.default_model
+
+    def estimate_memory_mb(self, name):
+        try:
+            return os.path.getsize(self.models[name]) / (1024 * 1024) * 1.2
+        except OSError:
+            return 0.0
+
+    def _take_victims(self, needed_mb):
+        """Remove idle instances, least recently used first, until `needed_mb` fits in the budget"""
+        victims = []
+        used = sum(loaded.memory_mb for loaded in self._loaded.values())
+        for key, loaded in list(self._loaded.items()):
+            if used + needed_mb <= self.memory_budget_mb:
+                break
+            if loaded.busy or loaded.model is None:
+                continue
+            del self._loaded[key]
+            used -= loaded.memory_mb
+            victims.append(loaded)
+        if used + needed_mb > self.memory_budget_mb:
+            print(f"Warning: loading {needed_mb:.0f} MB exceeds the model memory budget "
+                  f"({used:.0f}/{self.memory_budget_mb} MB in use by busy models)")
+        return victims
+
+    def _busy_workers(self):
+        return {loaded.worker for loaded in self._loaded.values() if loaded.busy}
+
+    def _pick_idle(self, name, prefer):
+        """Least-loaded idle instance of `name`, preferring ones `prefer` accepts and free worker slots"""
+        busy_workers = self._busy_workers()
+        idle = [loaded for loaded in self._loaded.values()
+                if loaded.name == name and not loaded.busy and loaded.model is not None]
+        if not idle:
+            return None
+        return min(idle, key=lambda loaded: (
+            not (prefer is not None and prefer(loaded.model)),
+            loaded.worker in busy_workers,
+            loaded.busy_time,
+        ))
+
+    def _free_worker(self, name):
+        """
+        Worker slot for a new instance of `name`, or None if every slot already has one.
+        Slots are NPU domains shared by all models: an idle domain holding no
+        other model's instance is picked before one that would have to share.
+        """
+        taken = {loaded.worker for loaded in self._loaded.values() if loaded.name == name}
+        free = [worker for worker in range(self.instances) if worker not in taken]
+        if not free:
+            return None
+        busy_workers = self._busy_workers()
+        occupancy = {}
+        for loaded in self._loaded.values():
+            occupancy[loaded.worker] = occupancy.get(loaded.worker, 0) + 1
+        return min(free, key=lambda worker: (worker in busy_workers, occupancy.get(worker, 0), worker))
+
+    def _mark_busy(self, loaded):
+        loaded.busy = True
+        loaded.busy_since = time.time()
+        self._loaded.move_to_end(loaded.key)
+        return loaded
+
+    def checkout(self, name, prefer=None):
+        """
+        Return a LoadedModel for `name`, loading a new instance if all loaded
+        ones are busy and a worker slot is free, and mark it busy until checkin().
+        `prefer(model)` picks among idle instances, e.g. the one holding a
+        conversation's history.
+        """
+        name = self.resolve(name)
+        with self._cond:
+            while True:
+                loaded = self._pick_idle(name, prefer)
+                if loaded is not None:
+                    return self._mark_busy(loaded)
+                worker = self._free_worker(name)
+                if worker is not None:
+                    break
+                self._cond.wait()
+
+            # Reserve the slot so concurrent requests wait for this load instead of starting another
+            loaded = LoadedModel(name, self.models[name], worker, self.estimate_memory_mb(name))
+            victims = self._take_victims(loaded.memory_mb)
+            self._loaded[loaded.key] = loaded
+
+        for victim in victims:
+            print(f"Releasing model {victim.name} (worker {victim.worker}) to stay within the memory budget")
+            victim.model.release()
+            self.evictions += 1
+
+        try:
+            print(f"Loading model {name} from {loaded.path} on worker {worker}")
+            loaded.model = self.loader(name, loaded.path, worker)
+        except Exception:
+            with self._cond:
+                del self._loaded[loaded.key]
+                self._cond.notify_all()
+            raise
+        self.loads += 1
+        return loaded
+
+    def checkin(self, loaded, failed=False):
+        with self._cond:
+            loaded.busy = False
+            loaded.runs += 1
+            if failed or getattr(loaded.model, 'last_run_failed', False):
+                loaded.errors += 1
+            loaded.last_used = time.time()
+            loaded.busy_time += loaded.last_used - loaded.busy_since
+            # Prefer what the runtime reported over the file-size estimate
+            if getattr(loaded.model, 'memory_usage_mb', 0) > 0:
+                loaded.memory_mb = loaded.model.memory_usage_mb
+            self._cond.notify_all()
+
+    @contextmanager
+    def use(self, name, prefer=None):
+        """Context manager around checkout()/checkin() yielding the RKLLM instance"""
+        loaded = self.checkout(name, prefer)
+        failed = True
+        try:
+            yield loaded.model
+            failed = False
+        finally:
+            self.checkin(loaded, failed)
+
+    def preload(self, name, instances=1):
+        """Load up to `instances` instances of `name` ahead of the first request"""
+        checked_out = []
+        try:
+            for _ in range(min(instances, self.instances)):
+                checked_out.append(self.checkout(name))
+        finally:
+            for loaded in checked_out:
+                self.checkin(loaded)
+
+    def release_all(self):
+        with self._cond:
+            loaded_models = list(self._loaded.values())
+            self._loaded.clear()
+        for loaded in loaded_models:
+            if loaded.model is not None:
+                loaded.model.release()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "instances_per_model": self.instances,
+                "memory_budget_mb": self.memory_budget_mb,
+                "memory_used_mb": round(sum(loaded.memory_mb for loaded in self._loaded.values()), 2),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "loaded": [loaded.to_dict() for loaded in self._loaded.values()],
+            }
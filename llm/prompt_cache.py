@@ -0,0 +1,187 @@
+"""
+Prompt-prefix cache manager for the RKLLM server.
+The system prompt and tool instructions are the same on most requests, so
+their KV cache is saved to disk once with RKLLMPromptCacheParam and loaded
+with rkllm_load_prompt_cache before later runs, skipping that part of prefill.
+Cache files are kept in an LRU bounded by total size on disk; files a run
+is about to load are held and never evicted from under it.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class PrefixCacheEntry:
+    def __init__(self, digest, path, size=0, prefill_ms=0.0, prefill_tokens=0, hits=0, last_used=None):
+        self.digest = digest
+        self.path = path
+        self.size = size
+        self.prefill_ms = prefill_ms  # Prefill time the cached prefix cost when it was saved
+        self.prefill_tokens = prefill_tokens
+        self.hits = hits
+        self.last_used = last_used or time.time()
+        self.in_use = 0  # Runs holding this entry, between lookup/record_save and release
+
+    def to_dict(self):
+        return {
+            "digest": self.digest,
+            "size": self.size,
+            "prefill_ms": self.prefill_ms,
+            "prefill_tokens": self.prefill_tokens,
+            "hits": self.hits,
+            "last_used": self.last_used,
+        }
+
+
+class PrefixCacheManager:
+    """
+    Maps hashes of (model, rendered prefix) to prompt-cache files.
+    Entries survive restarts through an index.json next to the cache files.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, cache_dir, max_bytes, min_chars=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.min_chars = min_chars
+        self._entries = OrderedDict()  # digest -> PrefixCacheEntry, least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.evictions = 0
+        self.load_failures = 0
+        self.prefill_ms_saved = 0.0
+        self.prefill_tokens_saved = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, self.INDEX_FILE)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        for item in sorted(saved, key=lambda item: item.get("last_used", 0)):
+            path = os.path.join(self.cache_dir, f"{item['digest']}.bin")
+            if os.path.exists(path):
+                entry = PrefixCacheEntry(path=path, **item)
+                entry.size = os.path.getsize(path)
+                self._entries[entry.digest] = entry
+
+    def _save_index(self):
+        tmp_path = self._index_path() + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump([entry.to_dict() for entry in self._entries.values()], f)
+        os.replace(tmp_path, self._index_path())
+
+    def digest(self, model_id, prefix):
+        return hashlib.sha256(f"{model_id}\0{prefix}".encode('utf-8')).hexdigest()[:32]
+
+    def eligible(self, prefix):
+        """Whether a prefix is long enough to be worth a cache file"""
+        return bool(prefix) and len(prefix) >= self.min_chars
+
+    def lookup(self, model_id, prefix):
+        """
+        Return the entry for this prefix, or None (a miss) if it has not been
+        saved yet. The entry is held until release() so it is not evicted.
+        """
+        digest = self.digest(model_id, prefix)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or not os.path.exists(entry.path):
+                self._entries.pop(digest, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            entry.last_used = time.time()
+            entry.in_use += 1
+            return entry
+
+    def release(self, entry):
+        """Let go of an entry returned by lookup() or record_save()"""
+        with self._lock:
+            entry.in_use -= 1
+            if entry.in_use == 0 and self._evict():
+                self._save_index()
+
+    def record_load_failure(self, entry):
+        """Forget an entry whose file the runtime could not load; the next miss saves it again"""
+        with self._lock:
+            self.load_failures += 1
+            if self._entries.get(entry.digest) is entry:
+                del self._entries[entry.digest]
+                self._save_index()
+
+    def path_for(self, model_id, prefix):
+        """File the runtime should save this prefix's cache to"""
+        return os.path.join(self.cache_dir, f"{self.digest(model_id, prefix)}.bin")
+
+    def record_hit(self, entry):
+        with self._lock:
+            entry.hits += 1
+            self.hits += 1
+            self.prefill_ms_saved += entry.prefill_ms
+            self.prefill_tokens_saved += entry.prefill_tokens
+
+    def record_save(self, model_id, prefix, prefill_ms, prefill_tokens):
+        """
+        Register a cache file the runtime has just written, evicting old ones
+        over the size limit. The entry is held until release().
+        """
+        digest = self.digest(model_id, prefix)
+        path = self.path_for(model_id, prefix)
+        if not os.path.exists(path):
+            return None
+        entry = PrefixCacheEntry(digest, path, os.path.getsize(path), prefill_ms, prefill_tokens)
+        entry.in_use = 1
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            self.saves += 1
+            self._evict()
+            self._save_index()
+        return entry
+
+    def _evict(self):
+        """Remove least recently used files that no run holds until the total fits; True if any were removed"""
+        total = sum(entry.size for entry in self._entries.values())
+        evicted = False
+        for digest, entry in list(self._entries.items()):
+            if total <= self.max_bytes or len(self._entries) <= 1:
+                break
+            if entry.in_use:
+                continue
+            del self._entries[digest]
+            total -= entry.size
+            self.evictions += 1
+            evicted = True
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_mb": round(sum(entry.size for entry in self._entries.values()) / (1024 * 1024), 2),
+                "max_size_mb": round(self.max_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "saves": self.saves,
+                "evictions": self.evictions,
+                "load_failures": self.load_failures,
+                "prefill_ms_saved": round(self.prefill_ms_saved, 2),
+                "prefill_tokens_saved": self.prefill_tokens_saved,
+            }
@@ -0,0 +1,120 @@
+"""
+Request recorder for the RKLLM server.
+Every API request is appended to a JSONL file as one record: its arrival
+time, endpoint, body (messages and parameters), status, queue wait and the
+per-phase timing block. client/replay.py re-issues the captured traffic
+with its original arrival pattern.
+
+Records are written by a background thread, so a request only pays for a
+queue put; when the writer falls behind, records are dropped and counted
+rather than slowing requests down. The file is rotated like a logrotate
+set: requests.jsonl, requests.jsonl.1 (newest backup) ... requests.jsonl.N.
+"""
+
+import json
+import os
+import threading
+from queue import Full, Queue
+
+FILLER = "lorem ipsum dolor sit amet "
+
+
+def filler(text):
+    """Placeholder of the same length as `text`, so replays keep prompt sizes"""
+    return (FILLER * (len(text) // len(FILLER) + 1))[:len(text)]
+
+
+def redact(body):
+    """Copy of a request body with message, prompt and embedding input text replaced by filler"""
+    body = dict(body)
+    if isinstance(body.get("messages"), list):
+        messages = []
+        for message in body["messages"]:
+            if isinstance(message, dict) and isinstance(message.get("content"), str):
+                message = dict(message, content=filler(message["content"]))
+            messages.append(message)
+        body["messages"] = messages
+    for key in ("prompt", "input"):
+        if isinstance(body.get(key), str):
+            body[key] = filler(body[key])
+        elif isinstance(body.get(key), list):
+            body[key] = [filler(item) if isinstance(item, str) else item for item in body[key]]
+    return body
+
+
+class RequestRecorder:
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backups=5, include_content=True, max_pending=1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.include_content = include_content
+        self.recorded = 0
+        self.dropped = 0
+        self.rotations = 0
+        self._queue = Queue(maxsize=max_pending)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+        self._thread = threading.Thread(target=self._run, name="request-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, entry):
+        """Queue one record for writing; never blocks"""
+        if not self.include_content and isinstance(entry.get("request"), dict):
+            entry = dict(entry, request=redact(entry["request"]))
+        try:
+            self._queue.put_nowait(entry)
+        except Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            self._write(entry)
+            # Flush once the backlog is written instead of after every record
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def _write(self, entry):
+        try:
+            line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        except (TypeError, ValueError) as e:
+            print(f"Could not record request: {e}")
+            self.dropped += 1
+            return
+        data = line.encode("utf-8")
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+        self._size += len(data)
+        self.recorded += 1
+
+    def _rotate(self):
+        self._file.close()
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{index}"):
+                    os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._size = 0
+        self.rotations += 1
+
+    def close(self):
+        """Write what is queued and close the file"""
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "pending": self._queue.qsize(),
+            "rotations": self.rotations,
+            "include_content": self.include_content,
+        }
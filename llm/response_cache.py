@@ -0,0 +1,176 @@
+"""
+Exact-match response cache for the RKLLM server.
+Sampling is greedy (top_k = 1), so the same final prompt on the same model
+and adapter always produces the same text. Finished responses are kept in an
+LRU bounded by entry count and total size, optionally mirrored to disk, and
+replayed instead of running the NPU again. Streaming clients get the cached
+text back as chunks at a configurable pace.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedResponse:
+    def __init__(self, key, text, finish_reason, usage, created=None):
+        self.key = key
+        self.text = text
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.created = created or time.time()
+
+    @property
+    def size(self):
+        return len(self.text.encode('utf-8')) + 256  # Rough allowance for the rest of the entry
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "text": self.text,
+            "finish_reason": self.finish_reason,
+            "usage": self.usage,
+            "created": self.created,
+        }
+
+
+class ReplaySession:
+    """
+    Stands in for a GenerationSession when the response comes from the cache:
+    iterating yields the cached text in chunks of `chunk_chars`, `delay`
+    seconds apart, and each chunk is its own batch.
+    """
+
+    def __init__(self, cached, chunk_chars=16, delay=0.0):
+        self.cached = cached
+        self.chunk_chars = max(1, chunk_chars)
+        self.delay = delay
+        self.finish_reason = cached.finish_reason
+        self.error = None
+        self.is_generating = False
+
+    def __iter__(self):
+        text = self.cached.text
+        for start in range(0, len(text), self.chunk_chars):
+            if start and self.delay > 0:
+                time.sleep(self.delay)
+            yield text[start:start + self.chunk_chars]
+
+    async def __aiter__(self):
+        text = self.cached.text
+        for start in range(0, len(text), self.chunk_chars):
+            if start and self.delay > 0:
+                await asyncio.sleep(self.delay)
+            yield text[start:start + self.chunk_chars]
+
+    def batches(self, window=0.0, max_bytes=1024):
+        for chunk in self:
+            yield [chunk]
+
+    async def abatches(self, window=0.0, max_bytes=1024):
+        async for chunk in self:
+            yield [chunk]
+
+    def wait(self):
+        return self.cached.text
+
+    def usage(self):
+        return dict(self.cached.usage)
+
+    def cancel(self):
+        pass
+
+
+class ResponseCache:
+    def __init__(self, max_bytes, max_entries=1024, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()  # key -> CachedResponse, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_dir()
+
+    @staticmethod
+    def key(model, adapter, prompt, max_tokens=None, stop=None):
+        """Everything that can change the generated text for a prompt"""
+        data = json.dumps([model, adapter, prompt, max_tokens, stop])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load_dir(self):
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+        for path in sorted(paths, key=os.path.getmtime):
+            try:
+                with open(path, 'r') as f:
+                    cached = CachedResponse(**json.load(f))
+            except (OSError, ValueError, TypeError):
+                continue
+            self._add(cached)
+
+    def _add(self, cached):
+        old = self._entries.pop(cached.key, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[cached.key] = cached
+        self._bytes += cached.size
+        while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            self.evictions += 1
+            if self.cache_dir:
+                try:
+                    os.remove(self._path(evicted.key))
+                except OSError:
+                    pass
+
+    def get(self, key):
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return cached
+
+    def put(self, key, text, finish_reason, usage):
+        cached = CachedResponse(key, text, finish_reason, usage)
+        if cached.size > self.max_bytes:
+            return None
+        with self._lock:
+            self._add(cached)
+            self.stores += 1
+        if self.cache_dir:
+            tmp_path = self._path(key) + ".tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(cached.to_dict(), f)
+                os.replace(tmp_path, self._path(key))
+            except OSError as e:
+                print(f"Could not persist cached response: {e}")
+        return cached
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_mb": round(self._bytes / (1024 * 1024), 2),
+                "max_size_mb": round(self.max_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
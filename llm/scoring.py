@@ -0,0 +1,73 @@
+"""
+Logit scoring for the RKLLM server.
+Prompts are prefilled as token ids in RKLLM_INFER_GET_LOGITS mode, and the
+logits are turned into log-probabilities over the vocabulary. A candidate
+continuation (a label, or "Yes"/"No" for reranking) is scored teacher-forced:
+each of its tokens is looked up in the distribution that follows the prompt
+and the candidate tokens before it, and the candidate's log-probability is
+their sum. Nothing is decoded; single-token candidates share the prompt's
+one prefill, and each longer candidate prefix costs one more.
+"""
+
+import numpy as np
+
+
+def logits_to_array(logits):
+    """Copy an RKLLMResultLogits out of the runtime's buffer as a (num_tokens, vocab_size) float32 array"""
+    if not logits.logits or logits.num_tokens <= 0 or logits.vocab_size <= 0:
+        return None
+    shape = (logits.num_tokens, logits.vocab_size)
+    # The buffer is only valid during the callback, so copy it
+    return np.ctypeslib.as_array(logits.logits, shape=shape).astype(np.float32, copy=True)
+
+
+def log_softmax(logits):
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+def score_continuations(logprobs_for, prompt_ids, candidate_ids):
+    """
+    Teacher-forced scores of token sequences continuing `prompt_ids`.
+    `logprobs_for(ids)` prefills `ids` and returns log-probability rows for
+    its last positions, the last row being the distribution of the token
+    after `ids`. When the runtime returns a row per position, one prefill
+    covers every prefix of a candidate; contexts shared by candidates are
+    prefilled once either way.
+    Returns (scores, next_token_logprobs, prefills): scores are
+    {"logprob", "token_logprobs", "prob"} dicts in candidate order with
+    "prob" renormalized over the candidates, and next_token_logprobs is the
+    distribution right after the prompt.
+    """
+    rows = {}  # Candidate prefix -> log-probabilities of the token after prompt + prefix
+    prefills = 0
+
+    def next_token(prefix):
+        nonlocal prefills
+        if prefix not in rows:
+            result = logprobs_for(list(prompt_ids) + list(prefix))
+            prefills += 1
+            for back, row in enumerate(result[::-1][:len(prefix) + 1]):
+                rows.setdefault(prefix[:len(prefix) - back], row)
+        return rows[prefix]
+
+    scores = []
+    for ids in candidate_ids:
+        ids = tuple(ids)
+        next_token(ids[:-1])  # Longest context first, so a row per position fills in the shorter ones
+        token_logprobs = [float(next_token(ids[:k])[token_id]) for k, token_id in enumerate(ids)]
+        scores.append({"logprob": sum(token_logprobs), "token_logprobs": token_logprobs})
+    totals = np.array([scored["logprob"] for scored in scores])
+    relative = np.exp(totals - totals.max())
+    relative /= relative.sum()
+    for scored, prob in zip(scores, relative):
+        scored["prob"] = float(prob)
+    return scores, next_token(()), prefills
+
+
+def top_tokens(logprobs, n):
+    """Token ids and log-probabilities of the `n` most likely next tokens, most likely first"""
+    n = min(n, logprobs.shape[0])
+    ids = np.argpartition(-logprobs, n - 1)[:n]
+    ids = ids[np.argsort(-logprobs[ids])]
+    return [(int(token_id), float(logprobs[token_id])) for token_id in ids]
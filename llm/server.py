@@ -1,54 +1,54 @@
+import asyncio
 import ctypes
 import sys
 import os
 import subprocess
 import resource
+import signal
 import threading
 import time
 import argparse
+import hashlib
 import json
-import re
 import uuid
 import importlib.util
+import math
 from datetime import datetime
 
-# -------- Token counting helper --------
-def count_tokens(text: str) -> int:
-    """
-    Return the number of tokens in `text` using tiktoken's GPT-2 encoding if
-    available. Falls back to a simple whitespace split when tiktoken isn't
-    installed so the server continues to run.
-    """
-    try:
-        import tiktoken  # type: ignore
-        try:
-            encoding = tiktoken.get_encoding("qwen")
-            print('qwen encoding found')
-        except Exception:
-            encoding = tiktoken.get_encoding("gpt2")
-            print('gpt2 encoding found')
-        return len(encoding.encode(text))
-    except Exception:
-        # Fallback keeps the server functional even without tiktoken
-        return len(text.split())
-
-def truncate_to_last_words(text: str, max_words: int = 4000) -> str:
-    """
-    Truncate text to the last max_words words if it exceeds the limit.
-    Preserves word boundaries and adds an ellipsis to indicate truncation.
-    """
-    words = text.split()
-    if len(words) <= max_words:
-        return text
-    
-    # Take the last max_words words
-    truncated_words = words[-max_words:]
-    print(f"Prompt truncated from {len(words)} words to {len(truncated_words)} words")
-    return "... " + " ".join(truncated_words)
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
 from jinja2 import Template
 from config import *
+from admission import AdmissionQueue, QueueFull, QueueTimeout
+from asgi import ASGIApp, SessionStream, stream_error_events
+from token_counter import TokenCounter
+from prompt_cache import PrefixCacheManager
+from conversations import ConversationStore
+from stop_sequences import StopSequenceMatcher
+from tool_call_parser import StreamingToolCallParser, ToolCallDelta
+from tool_registry import ToolRegistry, tool
+from model_registry import ModelRegistry
+from context_budget import ContextBudgeter
+from embeddings import POOLING_MODES, EmbeddingCache, encode_vector, hidden_states_to_array, pool
+from response_cache import ReplaySession, ResponseCache
+from scoring import log_softmax, logits_to_array, score_continuations, top_tokens
+from sse import SSE_HEADERS, ChunkEncoder, StreamStats
+from metrics import RequestMetrics, render_metric
+from simulated_runtime import SimulatedRuntime
+from request_log import RequestRecorder
+from startup import StartupPipeline
+from lora_adapters import AdapterRegistry
+
+# -------- Token counting helper --------
+# Loaded once at startup; counts are cached by text hash
+token_counter = TokenCounter(TOKENIZER_PATH, cache_size=TOKEN_COUNT_CACHE_SIZE)
+
+# Fits prompts into MAX_CONTEXT_LENGTH with real token counts
+context_budgeter = ContextBudgeter(token_counter, MAX_CONTEXT_LENGTH, reserve_tokens=CONTEXT_RESERVE_TOKENS)
+
+def count_tokens(text: str) -> int:
+    """Return the number of tokens in `text` using the shared token counter"""
+    return token_counter.count(text)
 
 app = Flask(__name__)
 # Enable CORS for all routes
@@ -57,13 +57,23 @@ CORS(app, resources={
         "origins": "*",
         "methods": ["GET", "POST", "OPTIONS", "PUT", "DELETE", "PATCH"],
         "allow_headers": ["Content-Type", "Authorization", "X-Requested-With"],
+        "expose_headers": ["Retry-After", "X-Queue-Position", "X-Queue-Estimated-Wait", "X-Queue-Wait", "X-Session-Id", "X-Response-Cache", "X-Tool-Path", "Server-Timing"],
         "supports_credentials": True,
         "max_age": 3600
     }
 })
 
-# Set the dynamic library path
-rkllm_lib = ctypes.CDLL(LIBRARY_PATH)
+# Load the runtime library, or its simulation to run without an NPU
+if RKLLM_BACKEND == "simulated":
+    rkllm_lib = SimulatedRuntime(
+        prefill_tps=SIMULATED_PREFILL_TPS,
+        decode_tps=SIMULATED_DECODE_TPS,
+        reply_tokens=SIMULATED_REPLY_TOKENS,
+        memory_mb=SIMULATED_MEMORY_MB,
+        error_rate=SIMULATED_ERROR_RATE
+    )
+else:
+    rkllm_lib = ctypes.CDLL(LIBRARY_PATH)
 
 # Define the structures from the library
 RKLLM_Handle_t = ctypes.c_void_p
@@ -217,45 +227,358 @@ class RKLLMResult(ctypes.Structure):
     ]
 
 # OpenAI API Configuration
-DEFAULT_MODEL_NAME = "luna-small"
-
-# Tool calling configuration
-TOOL_REGISTRY = {}  # Will store dynamically loaded tools
+DEFAULT_MODEL_NAME = "luna-large"  # Served when a request names no registered model
 
 # Jinja2 templates for tool formatting
 TOOL_SYSTEM_TEMPLATE = Template(SYSTEM_TEMPLATE)
 
-# Create a lock to control multi-user access to the server.
-lock = threading.Lock()
-
-# Create a global variable to indicate whether the server is currently in a blocked state.
-is_blocking = False
+# Requests wait here for the model instead of failing while it is busy
+admission_queue = AdmissionQueue(
+    slots=len(NPU_WORKERS),
+    max_depth=QUEUE_MAX_DEPTH,
+    wait_timeout=QUEUE_WAIT_TIMEOUT,
+    default_service_time=QUEUE_DEFAULT_SERVICE_TIME,
+    affinity_limit=ADAPTER_AFFINITY_MAX_SKIPS
+)
 
-# Thread-safe queue for streaming output
-from queue import Queue
+from queue import Empty, Queue
 
-# Define global variables to store the callback function output
-class GlobalState:
-    def __init__(self):
+class GenerationSession:
+    """
+    State for one rkllm_run call: the token channel the callback writes to,
+    a completion event, perf stats and a cancellation flag.
+    The callback finds its session through the `userdata` key passed to rkllm_run.
+    Readers either iterate it on a thread or use `async for`, which moves the
+    channel onto an asyncio queue fed through call_soon_threadsafe.
+    """
+    _next_key = 1
+    _key_lock = threading.Lock()
+
+    def __init__(self, prompt, request_id=None, max_tokens=None, stop=None, tool_parser=None, adapter=None):
+        with GenerationSession._key_lock:
+            self.key = GenerationSession._next_key
+            GenerationSession._next_key += 1
+        self.prompt = prompt
+        self.request_id = request_id
+        self.adapter = adapter  # Name of the LoRA adapter to run with; None for the model's default
         self.text_queue = Queue()
-        self.finished = True  # Start as idle
-        self.lock = threading.Lock()
-        self.reset_perf_metrics()
+        self._loop = None  # Event loop of the async reader, once one is attached
+        self._async_queue = None
+        self._channel_lock = threading.Lock()
+        self.finished = threading.Event()
+        self.cancelled = False
+        self.error = None
+        self.chunks = []
+        self.finish_reason = "stop"
+        self.model = None  # RKLLM instance while the session is inside rkllm_run
+        self.aborted_tokens = 0  # Tokens decoded after the abort was requested
+        self.max_tokens = max_tokens
+        self.stop_matcher = StopSequenceMatcher(stop) if stop else None
+        self.limit_reached = False  # max_tokens or a stop string ended the run
+        self.tool_parser = tool_parser  # Splits <tool_call> blocks out of the output when tools are offered
+        self.capture_hidden_states = False  # Keep the hidden states the runtime returns
+        self.hidden_states = None
+        self.capture_logits = False  # Keep the logits the runtime returns
+        self.logits = None
 
-    def reset_perf_metrics(self):
         self.prompt_eval_start_time = 0
         self.first_token_time = 0
+        self.last_token_time = 0
         self.generation_finish_time = 0
-        self.prompt_word_count = 0
-        self.generated_word_count = 0
-        self.prompt_eval_speed_wps = 0.0
-        self.generation_speed_wps = 0.0
+        self.generated_tokens = 0  # The runtime calls back once per token
+        self.perf_prefill_tokens = 0
+        self.perf_generate_tokens = 0
+        self.perf_prefill_ms = 0.0
+        self.perf_generate_ms = 0.0
+        self.prefix_cache = None  # "hit" or "miss" when the prompt prefix went through the prefix cache
+        self.prefill_ms_saved = 0.0
+        self.history_reused = False  # Only the new turn was prefilled on top of the runtime history
         self.prefill_tps = 0.0
         self.generation_tps = 0.0
         self.memory_usage_mb = 0.0
 
-global_state = GlobalState()
-split_byte_data = bytes(b"")
+    def on_token(self, text_chunk):
+        # Runs on the runtime's callback thread: no tokenization here
+        now = time.time()
+        if self.first_token_time == 0:
+            self.first_token_time = now
+        else:
+            request_metrics.inter_token.observe(now - self.last_token_time)
+        self.last_token_time = now
+        self.generated_tokens += 1
+        if self.cancelled or self.limit_reached:
+            self.aborted_tokens += 1
+            return
+        if self.tool_parser is not None:
+            self.emit(self.tool_parser.feed(text_chunk))
+            if self.tool_parser.done:
+                # The last tool call has closed; whatever the model says next is not needed
+                self.stop_generation("tool_calls")
+        else:
+            if self.stop_matcher is not None:
+                text_chunk, matched = self.stop_matcher.feed(text_chunk)
+                if matched:
+                    self.stop_generation("stop")
+            if text_chunk:
+                self.emit([text_chunk])
+        if not self.limit_reached and self.max_tokens and self.generated_tokens >= self.max_tokens:
+            self.stop_generation("length")
+
+    def emit(self, events):
+        """Hand output to readers: content strings, and ToolCallDeltas when a tool parser is set"""
+        with self._channel_lock:
+            for event in events:
+                if isinstance(event, str):
+                    self.chunks.append(event)
+                self._deliver(event)
+
+    def _deliver(self, item):
+        if self._loop is None:
+            self.text_queue.put(item)
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._async_queue.put_nowait, item)
+        except RuntimeError:
+            pass  # The event loop has shut down
+
+    def stop_generation(self, finish_reason):
+        """End the run early because a request limit was hit; tokens already sent stay valid"""
+        self.limit_reached = True
+        self.finish_reason = finish_reason
+        model = self.model
+        if model is not None:
+            model.abort()
+
+    def on_finish(self, perf):
+        if self.stop_matcher is not None and self.stop_matcher.matched is None and not self.cancelled:
+            # No stop string matched (natural end or a length/tool limit): release the text held back for partial matches
+            tail = self.stop_matcher.flush()
+            if tail:
+                self.emit([tail])
+        if self.tool_parser is not None and not self.cancelled:
+            self.emit(self.tool_parser.finish())
+            if self.tool_parser.calls and not self.limit_reached:
+                self.finish_reason = "tool_calls"
+        self.generation_finish_time = time.time()
+        # Ensure first_token_time is set, even for empty responses
+        if self.first_token_time == 0:
+            self.first_token_time = self.generation_finish_time
+
+        # Capture RKLLM perf stats
+        if perf is not None:
+            self.perf_prefill_tokens = perf.prefill_tokens
+            self.perf_generate_tokens = perf.generate_tokens
+            self.perf_prefill_ms = perf.prefill_time_ms
+            self.perf_generate_ms = perf.generate_time_ms
+            if self.model is not None and perf.memory_usage_mb > 0:
+                self.model.memory_usage_mb = perf.memory_usage_mb
+            if perf.prefill_time_ms > 0:
+                self.prefill_tps = perf.prefill_tokens / (perf.prefill_time_ms / 1000.0)
+            else:
+                self.prefill_tps = 0.0
+            if perf.generate_time_ms > 0:
+                self.generation_tps = perf.generate_tokens / (perf.generate_time_ms / 1000.0)
+            else:
+                self.generation_tps = 0.0
+            self.memory_usage_mb = perf.memory_usage_mb
+            print(f"\nPrefill: {perf.prefill_tokens} tokens ({self.prefill_tps:.2f} TPS), "
+                  f"generate: {perf.generate_tokens} tokens ({self.generation_tps:.2f} TPS), "
+                  f"memory: {self.memory_usage_mb:.2f} MB", flush=True)
+        else:
+            # Fallback stats computed in Python
+            gen_duration_ms = (self.generation_finish_time - self.first_token_time) * 1000.0
+            if gen_duration_ms > 0:
+                self.generation_tps = self.generated_tokens / (gen_duration_ms/1000.0)
+            print(f"\nGenerate: {self.generated_tokens} tokens in {gen_duration_ms:.2f} ms ({self.generation_tps:.2f} TPS)", flush=True)
+
+        if self.generated_tokens and self.prompt_eval_start_time:
+            request_metrics.record_generation(
+                ttft=self.first_token_time - self.prompt_eval_start_time,
+                prefill_tps=self.prefill_tps,
+                decode_tps=self.generation_tps,
+                prompt_tokens=self.perf_prefill_tokens,
+                generated_tokens=self.perf_generate_tokens or self.generated_tokens,
+                memory_mb=self.memory_usage_mb
+            )
+        self.close()
+
+    def on_error(self, message="run error"):
+        self.error = message
+        request_metrics.record_error()
+        self.close()
+
+    def close(self):
+        """Mark the session finished and wake up any reader. Idempotent."""
+        with self._channel_lock:
+            if not self.finished.is_set():
+                self.finished.set()
+                self._deliver(None)
+
+    def cancel(self):
+        """
+        Stop the generation: readers get no more tokens and the runtime is
+        told to abort, releasing the NPU for the next request. Idempotent.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.finish_reason = "abort"
+        model = self.model
+        if model is not None and self.is_generating:
+            model.abort()
+        record_abort()
+        self.close()
+
+    def __iter__(self):
+        """Yield text chunks (and ToolCallDeltas) as the callback produces them, until the run ends."""
+        while True:
+            chunk = self.text_queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    async def __aiter__(self):
+        """Like __iter__, but waits on the event loop instead of blocking a thread"""
+        queue = self._attach_loop()
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def _attach_loop(self):
+        """Move the channel onto an asyncio queue of the running loop"""
+        with self._channel_lock:
+            if self._loop is None:
+                self._async_queue = asyncio.Queue()
+                while not self.text_queue.empty():
+                    self._async_queue.put_nowait(self.text_queue.get_nowait())
+                self._loop = asyncio.get_running_loop()
+        return self._async_queue
+
+    def batches(self, window=0.0, max_bytes=1024):
+        """
+        Yield lists of text chunks: each batch starts with the next chunk and
+        takes whatever else arrives within `window` seconds, up to `max_bytes`.
+        Chunks that queued up while the reader was busy (a slow client) always
+        go out together.
+        """
+        while True:
+            chunk = self.text_queue.get()
+            if chunk is None:
+                return
+            batch, size = [chunk], len(chunk.encode('utf-8'))
+            deadline = time.monotonic() + window
+            while size < max_bytes:
+                remaining = deadline - time.monotonic()
+                try:
+                    chunk = self.text_queue.get(timeout=remaining) if remaining > 0 else self.text_queue.get_nowait()
+                except Empty:
+                    break
+                if chunk is None:
+                    yield batch
+                    return
+                batch.append(chunk)
+                size += len(chunk.encode('utf-8'))
+            yield batch
+
+    async def abatches(self, window=0.0, max_bytes=1024):
+        """Like batches, but waits on the event loop instead of blocking a thread"""
+        queue = self._attach_loop()
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            batch, size = [chunk], len(chunk.encode('utf-8'))
+            deadline = loop.time() + window
+            while size < max_bytes:
+                remaining = deadline - loop.time()
+                try:
+                    if not queue.empty() or remaining <= 0:
+                        chunk = queue.get_nowait()
+                    else:
+                        chunk = await asyncio.wait_for(queue.get(), remaining)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if chunk is None:
+                    yield batch
+                    return
+                batch.append(chunk)
+                size += len(chunk.encode('utf-8'))
+            yield batch
+
+    def wait(self):
+        """Block until the run ends and return the full generated text"""
+        self.finished.wait()
+        return "".join(self.chunks)
+
+    def usage(self):
+        """
+        OpenAI usage block. Token counts come from RKLLMPerfStat when the
+        runtime reported them, otherwise from the token counter and the
+        number of token callbacks.
+        """
+        if self.prefix_cache is not None or self.history_reused:
+            # The runtime only prefilled the part after the cached prefix or history
+            prompt_tokens = count_tokens(self.prompt)
+        else:
+            prompt_tokens = self.perf_prefill_tokens or count_tokens(self.prompt)
+        completion_tokens = self.perf_generate_tokens or self.generated_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+    @property
+    def is_generating(self):
+        return not self.finished.is_set()
+
+# Sessions currently inside rkllm_run, keyed by the userdata value the callback receives
+active_sessions = {}
+active_sessions_lock = threading.Lock()
+
+# Sessions by completion id, so /v1/abort can find the running request
+running_requests = {}
+
+# Frame and byte counters of chat streams, for /health
+stream_stats = StreamStats()
+
+# Latency and throughput samples for /metrics
+request_metrics = RequestMetrics(window=METRICS_WINDOW)
+
+# Abort counters for /health
+abort_stats = {"aborts": 0, "aborted_tokens": 0}
+abort_stats_lock = threading.Lock()
+
+def record_abort(aborted_tokens=0, count=True):
+    with abort_stats_lock:
+        if count:
+            abort_stats["aborts"] += 1
+        abort_stats["aborted_tokens"] += aborted_tokens
+
+# Most recently finished session, used for the last-run stats in /health
+last_session = None
+
+# Runtime prompt caches of system/tool prefixes; set up in __main__ when enabled
+prefix_cache = None
+
+# Exact-match cache of finished responses; set up in __main__ when enabled
+response_cache = None
+
+# Startup phases and readiness; the inference endpoints answer 503 until it is ready
+startup = StartupPipeline()
+
+# Appends every API request to a JSONL file for client/replay.py; set up in __main__ when enabled
+request_recorder = None
+RECORDED_PATHS = ('/v1/chat/completions', '/v1/completions', '/v1/embeddings', '/v1/score')
+
+# LoRA adapter and static prompt cache each model runs with, part of the response cache key
+model_adapters = {}
+
+# Server-side conversations whose history is kept in the runtime (keep_history=1)
+conversation_store = ConversationStore(ttl=CONVERSATION_TTL, max_conversations=CONVERSATION_MAX, max_responses=CONVERSATION_MAX_RESPONSES)
 
 def openai_error_response(message, error_type="invalid_request_error", param=None, code=None, status_code=400):
     """Generate OpenAI-compatible error response"""
@@ -268,92 +591,112 @@ def openai_error_response(message, error_type="invalid_request_error", param=Non
         }
     }), status_code
 
+def request_api_key():
+    """Key used for fair queueing: the bearer token, or the client address without one"""
+    auth = request.headers.get('Authorization', '')
+    if auth.lower().startswith('bearer ') and auth[7:].strip():
+        return auth[7:].strip()
+    return request.remote_addr or "anonymous"
+
+@app.before_request
+def start_request_record():
+    """Start the record of an API request when requests are being recorded"""
+    if request_recorder is None or request.method != 'POST' or request.path not in RECORDED_PATHS:
+        return
+    g.request_record = {
+        "arrival": time.time(),
+        "endpoint": request.path,
+        # Stands in for the API key, so a replay keeps fair queueing per client without the secret
+        "client": hashlib.sha256(request_api_key().encode('utf-8')).hexdigest()[:12],
+        "request": request.get_json(silent=True),
+    }
+
+@app.after_request
+def finish_request_record(response):
+    """Write the request's record once its response, streamed or not, has been sent"""
+    record = g.get('request_record')
+    if record is not None:
+        record["status"] = response.status_code
+        def write_record():
+            record["duration_ms"] = round((time.time() - record["arrival"]) * 1000.0, 2)
+            request_recorder.record(record)
+        response.call_on_close(write_record)
+    return response
+
+@app.before_request
+def require_ready():
+    """Turn inference requests away while the model is still loading or warming up"""
+    if startup.ready or request.path not in RECORDED_PATHS:
+        return None
+    response, status = openai_error_response(
+        "The server is starting up, retry shortly" if startup.state != "failed" else "The server failed to start",
+        error_type="server_starting",
+        status_code=503
+    )
+    response.headers['Retry-After'] = "5"
+    return response, status
+
+def admit_request(group=None):
+    """
+    Wait in the admission queue for the model.
+    `group` (model and adapter) lets requests for the same adapter run back to back.
+    Returns (ticket, None) once admitted, or (None, error_response) when the
+    queue is full (429) or the wait timed out (503).
+    """
+    record = g.get('request_record', {})
+    try:
+        ticket = admission_queue.acquire(request_api_key(), group=group)
+        request_metrics.queue_wait.observe(ticket.wait_time)
+        record["queue_ms"] = round(ticket.wait_time * 1000.0, 2)
+        return ticket, None
+    except QueueFull as e:
+        response, status = openai_error_response(
+            "Too many requests are waiting for the model, retry later",
+            error_type="rate_limit_exceeded",
+            status_code=429
+        )
+        response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+        return None, (response, status)
+    except QueueTimeout as e:
+        response, status = openai_error_response(
+            str(e),
+            error_type="server_busy",
+            status_code=503
+        )
+        response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+        return None, (response, status)
+
+def with_queue_headers(response, ticket):
+    """Attach the ticket's queue position and wait estimate to a response (none for cache hits)"""
+    if ticket is None:
+        return response
+    for name, value in ticket.headers().items():
+        response.headers[name] = value
+    return response
+
 # Define the callback function
 def callback_impl(result, userdata, state):
-    global global_state, split_byte_data
-    with global_state.lock:
-        current_time = time.time()
-
-        if state == 0:  # Normal text output (RKLLM_RUN_NORMAL)
-            if global_state.first_token_time == 0:
-                global_state.first_token_time = current_time
-                eval_duration = global_state.first_token_time - global_state.prompt_eval_start_time
-                if eval_duration > 0.001: # Avoid division by zero
-                    global_state.prompt_eval_speed_wps = global_state.prompt_word_count / eval_duration
-                else:
-                    global_state.prompt_eval_speed_wps = float('inf')
-
-            if result.contents.text:
-                text_chunk = result.contents.text.decode('utf-8')
-                # Count tokens in the generated chunk
-                global_state.generated_word_count += count_tokens(text_chunk)
-                global_state.text_queue.put(text_chunk)
-                print(text_chunk, end="", flush=True)
-
-        elif state == 2:  # Generation finished (RKLLM_RUN_FINISH)
-            global_state.generation_finish_time = current_time
-            # Ensure first_token_time is set, even for empty responses
-            if global_state.first_token_time == 0:
-                global_state.first_token_time = current_time
-
-            gen_duration = global_state.generation_finish_time - global_state.first_token_time
-            if gen_duration > 0.001 and global_state.generated_word_count > 0:
-                global_state.generation_speed_wps = global_state.generated_word_count / gen_duration
-            elif global_state.generated_word_count > 0:
-                global_state.generation_speed_wps = float('inf')
-            else:
-                global_state.generation_speed_wps = 0.0
-            # Capture RKLLM perf stats
-            if result and hasattr(result.contents, 'perf'):
-                perf = result.contents.perf
-                if perf.prefill_time_ms > 0:
-                    global_state.prefill_tps = perf.prefill_tokens / (perf.prefill_time_ms / 1000.0)
-                else:
-                    global_state.prefill_tps = 0.0
-                if perf.generate_time_ms > 0:
-                    global_state.generation_tps = perf.generate_tokens / (perf.generate_time_ms / 1000.0)
-                else:
-                    global_state.generation_tps = 0.0
-                global_state.memory_usage_mb = perf.memory_usage_mb
-
-                # Print to CLI for debugging (RKLLM native stats + deep debug)
-                print("--- RKLLM Performance Stats (native) ---")
-                print(f"Prefill: {perf.prefill_tokens} tokens in {perf.prefill_time_ms:.2f} ms  ({global_state.prefill_tps:.2f} TPS)")
-                print(f"Generate: {perf.generate_tokens} tokens in {perf.generate_time_ms:.2f} ms  ({global_state.generation_tps:.2f} TPS)")
-                print(f"Memory Usage: {global_state.memory_usage_mb:.2f} MB")
+    with active_sessions_lock:
+        session = active_sessions.get(userdata)
+    if session is None:
+        return
 
-                # --- Deep Debug -------------------------------------------------
-                try:
-                    perf_size = ctypes.sizeof(RKLLMPerfStat)
-                    perf_bytes = bytes(ctypes.string_at(ctypes.byref(perf), perf_size))
-                    print(f"Perf struct size: {perf_size} bytes")
-                    print(f"First 32 bytes (hex): {perf_bytes[:32].hex()}")
-                except Exception as dbg_e:
-                    print(f"[debug] could not dump perf bytes: {dbg_e}")
-
-                print("Token comparison (SDK vs Python):")
-                print(f"  Prefill tokens  – SDK: {perf.prefill_tokens}  | Python: {global_state.prompt_word_count}")
-                print(f"  Generate tokens – SDK: {perf.generate_tokens} | Python: {global_state.generated_word_count}")
-                print("------------------------------------------------------------")
-            else:
-                # Fallback CLI stats computed in Python
-                eval_duration_ms = (global_state.first_token_time - global_state.prompt_eval_start_time) * 1000.0 if global_state.first_token_time > 0 else 0
-                gen_duration_ms = (global_state.generation_finish_time - global_state.first_token_time) * 1000.0 if global_state.generation_finish_time > 0 else 0
-                if eval_duration_ms > 0:
-                    global_state.prefill_tps = global_state.prompt_word_count / (eval_duration_ms/1000.0)
-                if gen_duration_ms > 0:
-                    global_state.generation_tps = global_state.generated_word_count / (gen_duration_ms/1000.0)
-                print("--- RKLLM Performance Stats (fallback) ---")
-                print(f"Prefill: {global_state.prompt_word_count} tokens in {eval_duration_ms:.2f} ms  ({global_state.prefill_tps:.2f} TPS)")
-                print(f"Generate: {global_state.generated_word_count} tokens in {gen_duration_ms:.2f} ms  ({global_state.generation_tps:.2f} TPS)")
-
-
-            print("\n", end="", flush=True)
-            global_state.finished = True
-
-        elif state == 3:  # Error state (RKLLM_RUN_ERROR)
-            print("run error", file=sys.stderr)
-            global_state.finished = True
+    if state == 0:  # Normal text output (RKLLM_RUN_NORMAL)
+        if session.capture_hidden_states and result.contents.last_hidden_layer.hidden_states:
+            session.hidden_states = hidden_states_to_array(result.contents.last_hidden_layer)
+        if session.capture_logits and result.contents.logits.logits:
+            session.logits = logits_to_array(result.contents.logits)
+        if result.contents.text:
+            text_chunk = result.contents.text.decode('utf-8')
+            session.on_token(text_chunk)
+            print(text_chunk, end="", flush=True)
+
+    elif state == 2:  # Generation finished (RKLLM_RUN_FINISH)
+        session.on_finish(result.contents.perf if result else None)
+
+    elif state == 3:  # Error state (RKLLM_RUN_ERROR)
+        print("run error", file=sys.stderr)
+        session.on_error()
     return
 
 # Connect the callback function between the Python side and the C++ side
@@ -363,6 +706,7 @@ callback = callback_type(callback_impl)
 
 # ADD THESE FUNCTIONS TO YOUR RKLLM SERVER (after the imports, around line 200):
 
+@tool(response_template="{report}")
 def get_profession(name: str) -> dict:
     """Returns the profession of a person given their name."""
     people_professions = {
@@ -390,6 +734,7 @@ def get_profession(name: str) -> dict:
             "error_message": f"No profession information found for '{name}'."
         }
 
+@tool(response_template="It is {result}.")
 def get_current_time_string() -> str:
     """Returns the current time in the format 'H:MMam/pm' (e.g., '1:30pm')."""
     import datetime
@@ -402,63 +747,19 @@ BUILTIN_TOOLS = {
     'get_current_time_string': get_current_time_string
 }
 
-# REPLACE your existing execute_tool_call function with this:
+# Built-in tools plus the tools loaded from --tools_dir in __main__
+tool_registry = ToolRegistry(builtin_tools=BUILTIN_TOOLS, default_timeout=TOOL_TIMEOUT, max_stuck=TOOL_MAX_STUCK_CALLS)
+
 def execute_tool_call(tool_name, arguments):
     """Execute a tool call and return the result"""
-    
-    # Check built-in tools first (for Google ADK)
-    if tool_name in BUILTIN_TOOLS:
-        try:
-            result = BUILTIN_TOOLS[tool_name](**arguments)
-            return result
-        except Exception as e:
-            return {"error": f"Built-in tool execution failed: {str(e)}"}
-    
-    # Fall back to file-based tools (existing functionality)
-    if tool_name in TOOL_REGISTRY:
-        try:
-            result = TOOL_REGISTRY[tool_name](**arguments)
-            return result
-        except Exception as e:
-            return {"error": f"File tool execution failed: {str(e)}"}
-    
-    return {"error": f"Tool '{tool_name}' not found"}
-
-def parse_tool_calls(text):
-    """Parse tool calls from model response"""
-    tool_call_pattern = r'<tool_call>\s*(\{.*?\})\s*</tool_call>'
-    matches = re.findall(tool_call_pattern, text, re.DOTALL)
-    
-    tool_calls = []
-    for match in matches:
-        try:
-            tool_data = json.loads(match)
-            tool_call_id = f"call_{str(uuid.uuid4())}"
-            tool_calls.append({
-                "id": tool_call_id,
-                "type": "function",
-                "function": {
-                    "name": tool_data.get("name"),
-                    "arguments": json.dumps(tool_data.get("arguments", {}))
-                }
-            })
-        except json.JSONDecodeError as e:
-            print(f"Error parsing tool call: {e}")
-            continue
-    
-    return tool_calls
-
-def extract_text_without_tool_calls(text):
-    """Remove tool call tags from text and return clean content"""
-    tool_call_pattern = r'<tool_call>.*?</tool_call>'
-    clean_text = re.sub(tool_call_pattern, '', text, flags=re.DOTALL)
-    return clean_text.strip()
+    return tool_registry.execute(tool_name, arguments)
 
 # Define the RKLLM class
 class RKLLM(object):
-    def __init__(self, model_path, lora_model_path=None, prompt_cache_path=None):
+    def __init__(self, model_path, lora_model_path=None, prompt_cache_path=None, worker=0, adapters=()):
+        self.model_path = model_path if model_path else MODEL_PATH
         rkllm_param = RKLLMParam()
-        rkllm_param.model_path = bytes(model_path if model_path else MODEL_PATH, 'utf-8')
+        rkllm_param.model_path = bytes(self.model_path, 'utf-8')
 
         rkllm_param.max_context_len = MAX_CONTEXT_LENGTH
         rkllm_param.max_new_tokens = MAX_NEW_TOKENS
@@ -480,16 +781,24 @@ class RKLLM(object):
         rkllm_param.img_end = "".encode('utf-8')
         rkllm_param.img_content = "".encode('utf-8')
 
-        rkllm_param.extend_param.base_domain_id = 0
-        rkllm_param.extend_param.enabled_cpus_num = CPU_CORE_COUNT
-        rkllm_param.extend_param.enabled_cpus_mask = ENABLED_CPU_MASK
+        # Pin the instance to its worker slot's NPU domain and CPU cores
+        placement = NPU_WORKERS[worker % len(NPU_WORKERS)]
+        self.worker = worker
+        rkllm_param.extend_param.base_domain_id = placement["base_domain_id"]
+        rkllm_param.extend_param.enabled_cpus_num = bin(placement["cpu_mask"]).count("1")
+        rkllm_param.extend_param.enabled_cpus_mask = placement["cpu_mask"]
 
         self.handle = RKLLM_Handle_t()
 
         self.rkllm_init = rkllm_lib.rkllm_init
         self.rkllm_init.argtypes = [ctypes.POINTER(RKLLM_Handle_t), ctypes.POINTER(RKLLMParam), callback_type]
         self.rkllm_init.restype = ctypes.c_int
-        self.rkllm_init(ctypes.byref(self.handle), ctypes.byref(rkllm_param), callback)
+        ret = self.rkllm_init(ctypes.byref(self.handle), ctypes.byref(rkllm_param), callback)
+        if ret != 0:
+            raise RuntimeError(f"rkllm_init failed for {self.model_path} (error {ret})")
+        # Last memory usage and run outcome, reported to the model registry
+        self.memory_usage_mb = 0.0
+        self.last_run_failed = False
 
         self.rkllm_run = rkllm_lib.rkllm_run
         self.rkllm_run.argtypes = [RKLLM_Handle_t, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p]
@@ -499,57 +808,589 @@ class RKLLM(object):
         self.set_chat_template.argtypes = [RKLLM_Handle_t, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p]
         self.set_chat_template.restype = ctypes.c_int
 
+        self.rkllm_abort = rkllm_lib.rkllm_abort
+        self.rkllm_abort.argtypes = [RKLLM_Handle_t]
+        self.rkllm_abort.restype = ctypes.c_int
+
         self.rkllm_destroy = rkllm_lib.rkllm_destroy
         self.rkllm_destroy.argtypes = [RKLLM_Handle_t]
         self.rkllm_destroy.restype = ctypes.c_int
 
-        # Handle LoRA adapter if provided
-        rkllm_lora_params = None
+        self.rkllm_load_lora = rkllm_lib.rkllm_load_lora
+        self.rkllm_load_lora.argtypes = [RKLLM_Handle_t, ctypes.POINTER(RKLLMLoraAdapter)]
+        self.rkllm_load_lora.restype = ctypes.c_int
+
+        # LoRA adapters loaded into this handle (name -> path). The --lora_model_path
+        # adapter runs whenever a request selects none; registered adapters load on first use.
+        self.loaded_adapters = {}
+        self.default_adapter = None
+        self.current_adapter = None  # Adapter of the last run, for adapter affinity
         if lora_model_path:
-            lora_adapter_name = "test"
-            lora_adapter = RKLLMLoraAdapter()
-            ctypes.memset(ctypes.byref(lora_adapter), 0, ctypes.sizeof(RKLLMLoraAdapter))
-            lora_adapter.lora_adapter_path = ctypes.c_char_p((lora_model_path).encode('utf-8'))
-            lora_adapter.lora_adapter_name = ctypes.c_char_p((lora_adapter_name).encode('utf-8'))
-            lora_adapter.scale = 1.0
-
-            rkllm_load_lora = rkllm_lib.rkllm_load_lora
-            rkllm_load_lora.argtypes = [RKLLM_Handle_t, ctypes.POINTER(RKLLMLoraAdapter)]
-            rkllm_load_lora.restype = ctypes.c_int
-            rkllm_load_lora(self.handle, ctypes.byref(lora_adapter))
-            rkllm_lora_params = RKLLMLoraParam()
-            rkllm_lora_params.lora_adapter_name = ctypes.c_char_p((lora_adapter_name).encode('utf-8'))
+            self.load_adapter("default", lora_model_path)
+            self.default_adapter = "default"
+        for adapter in adapters:
+            self.load_adapter(adapter.name, adapter.path, adapter.scale)
         
+        # lora_params is set per run for the adapter the session selects
         self.rkllm_infer_params = RKLLMInferParam()
         ctypes.memset(ctypes.byref(self.rkllm_infer_params), 0, ctypes.sizeof(RKLLMInferParam))
         self.rkllm_infer_params.mode = RKLLMInferMode.RKLLM_INFER_GENERATE
-        self.rkllm_infer_params.lora_params = ctypes.pointer(rkllm_lora_params) if rkllm_lora_params else None
         self.rkllm_infer_params.keep_history = KEEP_HISTORY
 
+        # Same parameters with the runtime history kept, for conversation sessions
+        self.history_infer_params = RKLLMInferParam()
+        ctypes.memset(ctypes.byref(self.history_infer_params), 0, ctypes.sizeof(RKLLMInferParam))
+        self.history_infer_params.mode = RKLLMInferMode.RKLLM_INFER_GENERATE
+        self.history_infer_params.keep_history = 1
+        # Conversation whose turns the runtime history currently holds, and the adapter they ran with
+        self.history_owner = None
+        self.history_adapter = None
+
+        self.rkllm_clear_kv_cache = rkllm_lib.rkllm_clear_kv_cache
+        self.rkllm_clear_kv_cache.argtypes = [RKLLM_Handle_t, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+        self.rkllm_clear_kv_cache.restype = ctypes.c_int
+
+        self.rkllm_load_prompt_cache = rkllm_lib.rkllm_load_prompt_cache
+        self.rkllm_load_prompt_cache.argtypes = [RKLLM_Handle_t, ctypes.c_char_p]
+        self.rkllm_load_prompt_cache.restype = ctypes.c_int
+
+        self.rkllm_release_prompt_cache = rkllm_lib.rkllm_release_prompt_cache
+        self.rkllm_release_prompt_cache.argtypes = [RKLLM_Handle_t]
+        self.rkllm_release_prompt_cache.restype = ctypes.c_int
+
         # Handle prompt cache if provided
         self.prompt_cache_path = None
         if prompt_cache_path:
             self.prompt_cache_path = prompt_cache_path
-            rkllm_load_prompt_cache = rkllm_lib.rkllm_load_prompt_cache
-            rkllm_load_prompt_cache.argtypes = [RKLLM_Handle_t, ctypes.c_char_p]
-            rkllm_load_prompt_cache.restype = ctypes.c_int
-            rkllm_load_prompt_cache(self.handle, ctypes.c_char_p((prompt_cache_path).encode('utf-8')))
+            self.rkllm_load_prompt_cache(self.handle, ctypes.c_char_p((prompt_cache_path).encode('utf-8')))
+
+    def run(self, prompt, session, prefix=None, keep_history=False):
+        """
+        Run one generation, delivering its output to `session`. Blocks until done.
+        When `prefix` starts the prompt and the prefix cache is enabled, the
+        prefix's KV cache is loaded from disk (saved there first on a miss) and
+        only the rest of the prompt is prefilled.
+        With `keep_history` the prompt continues the runtime history instead.
+        """
+        if keep_history:
+            self._run_prompt(prompt, session, self.history_infer_params)
+            return
+
+        # Nothing in the runtime history is reusable after a run without it
+        self.history_owner = None
+        cache_entry, hit = None, False
+        if prefix_cache is not None and prefix and prompt.startswith(prefix) and prefix_cache.eligible(prefix):
+            cache_entry = prefix_cache.lookup(self.cache_model_id(session.adapter), prefix)
+            hit = cache_entry is not None
+            if not hit:
+                cache_entry = self.save_prefix_cache(prefix, session.adapter)
+
+        if cache_entry is None:
+            self._run_prompt(prompt, session, self.rkllm_infer_params)
+            return
 
-    def run(self, prompt):
+        try:
+            ret = self.rkllm_load_prompt_cache(self.handle, ctypes.c_char_p(cache_entry.path.encode('utf-8')))
+            if ret != 0:
+                # Without the cached KV state the prefix must be prefilled with the rest
+                print(f"rkllm_load_prompt_cache failed for {cache_entry.path} (error {ret}), prefilling the full prompt")
+                prefix_cache.record_load_failure(cache_entry)
+                self._run_prompt(prompt, session, self.rkllm_infer_params)
+                return
+            if hit:
+                prefix_cache.record_hit(cache_entry)
+                session.prefill_ms_saved = cache_entry.prefill_ms
+            session.prefix_cache = "hit" if hit else "miss"
+            try:
+                self._run_prompt(prompt[len(prefix):], session, self.rkllm_infer_params)
+            finally:
+                self.rkllm_release_prompt_cache(self.handle)
+        finally:
+            prefix_cache.release(cache_entry)
+
+    def clear_history(self):
+        """Drop the runtime's conversation history (KV cache)"""
+        self.rkllm_clear_kv_cache(self.handle, 0, None, None)
+        self.history_owner = None
+
+    def load_adapter(self, name, path, scale=1.0):
+        """Load a LoRA adapter into this handle under `name`"""
+        lora_adapter = RKLLMLoraAdapter()
+        ctypes.memset(ctypes.byref(lora_adapter), 0, ctypes.sizeof(RKLLMLoraAdapter))
+        lora_adapter.lora_adapter_path = ctypes.c_char_p(path.encode('utf-8'))
+        lora_adapter.lora_adapter_name = ctypes.c_char_p(name.encode('utf-8'))
+        lora_adapter.scale = scale
+        ret = self.rkllm_load_lora(self.handle, ctypes.byref(lora_adapter))
+        if ret != 0:
+            raise RuntimeError(f"rkllm_load_lora failed for adapter {name} (error {ret})")
+        self.loaded_adapters[name] = path
+        adapter_registry.record_load()
+
+    def lora_params_for(self, name):
+        """
+        RKLLMLoraParam for a run with adapter `name` (None: the default adapter, if any),
+        loading a registered adapter the first time this handle runs it.
+        """
+        name = name or self.default_adapter
+        if name != self.current_adapter:
+            if self.current_adapter is not None or name is not None:
+                adapter_registry.record_switch()
+            self.current_adapter = name
+        if name is None:
+            return None
+        if name not in self.loaded_adapters:
+            adapter = adapter_registry.get(name)
+            if adapter is None or model_registry.models.get(adapter.base) != self.model_path:
+                raise RuntimeError(f"Adapter {name} is not registered for {self.model_path}")
+            self.load_adapter(adapter.name, adapter.path, adapter.scale)
+        elif adapter_registry.get(name) is not None and adapter_registry.get(name).path != self.loaded_adapters[name]:
+            # The runtime cannot unload or replace an adapter in a loaded handle
+            raise RuntimeError(f"Adapter {name} was re-registered with a different file; register it under a new name")
+        lora_params = RKLLMLoraParam()
+        lora_params.lora_adapter_name = ctypes.c_char_p(name.encode('utf-8'))
+        return ctypes.pointer(lora_params)
+
+    def runs_adapter(self, name):
+        """True if the last run used adapter `name` (None: the default), so selecting it costs no switch"""
+        return self.current_adapter == (name or self.default_adapter)
+
+    def cache_model_id(self, adapter):
+        """Prefix cache identity: a prefix's KV cache depends on the adapter it was computed with"""
+        return f"{self.model_path}#lora={adapter}" if adapter else self.model_path
+
+    def save_prefix_cache(self, prefix, adapter=None):
+        """
+        Prefill `prefix` alone and have the runtime save its KV cache to disk.
+        Runs in last-hidden-layer mode so nothing is decoded.
+        """
+        cache_id = self.cache_model_id(adapter)
+        cache_params = RKLLMPromptCacheParam()
+        cache_params.save_prompt_cache = 1
+        cache_params.prompt_cache_path = ctypes.c_char_p(prefix_cache.path_for(cache_id, prefix).encode('utf-8'))
+
+        infer_params = RKLLMInferParam()
+        ctypes.memset(ctypes.byref(infer_params), 0, ctypes.sizeof(RKLLMInferParam))
+        infer_params.mode = RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER
+        infer_params.prompt_cache_params = ctypes.pointer(cache_params)
+        infer_params.keep_history = 0
+
+        prefill = GenerationSession(prefix, adapter=adapter)
+        self._run_prompt(prefix, prefill, infer_params)
+        if prefill.error:
+            return None
+        return prefix_cache.record_save(cache_id, prefix, prefill.perf_prefill_ms, prefill.perf_prefill_tokens)
+
+    def get_hidden_states(self, text):
+        """Prefill `text` in last-hidden-layer mode and return its (num_tokens, embd_size) hidden states"""
+        infer_params = RKLLMInferParam()
+        ctypes.memset(ctypes.byref(infer_params), 0, ctypes.sizeof(RKLLMInferParam))
+        infer_params.mode = RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER
+        infer_params.keep_history = 0
+
+        self.history_owner = None
+        session = GenerationSession(text)
+        session.capture_hidden_states = True
+        self._run_prompt(text, session, infer_params)
+        if session.error or session.hidden_states is None:
+            raise RuntimeError(session.error or "the runtime returned no hidden states")
+        return session.hidden_states, session.perf_prefill_tokens
+
+    def get_logprobs(self, token_ids):
+        """
+        Prefill `token_ids` in logits mode and return log-probabilities over the
+        vocabulary for the positions the runtime reports (the last row is the next token).
+        """
+        infer_params = RKLLMInferParam()
+        ctypes.memset(ctypes.byref(infer_params), 0, ctypes.sizeof(RKLLMInferParam))
+        infer_params.mode = RKLLMInferMode.RKLLM_INFER_GET_LOGITS
+        infer_params.keep_history = 0
+
+        self.history_owner = None
+        session = GenerationSession(token_ids)
+        session.capture_logits = True
+        self._run_prompt(token_ids, session, infer_params)
+        if session.error or session.logits is None:
+            raise RuntimeError(session.error or "the runtime returned no logits")
+        return log_softmax(session.logits), session.perf_prefill_tokens or len(token_ids)
+
+    def _run_prompt(self, prompt, session, infer_params):
+        """Run `prompt` (text, or a list of token ids fed as they are) through rkllm_run for `session`"""
         rkllm_input = RKLLMInput()
-        rkllm_input.input_mode = RKLLMInputMode.RKLLM_INPUT_PROMPT
-        rkllm_input.input_data.prompt_input = ctypes.c_char_p(prompt.encode('utf-8'))
-        self.rkllm_run(self.handle, ctypes.byref(rkllm_input), ctypes.byref(self.rkllm_infer_params), None)
-        return
+        if isinstance(prompt, list):
+            input_ids = (ctypes.c_int32 * len(prompt))(*prompt)
+            rkllm_input.input_mode = RKLLMInputMode.RKLLM_INPUT_TOKEN
+            rkllm_input.input_data.token_input.input_ids = input_ids
+            rkllm_input.input_data.token_input.n_tokens = len(prompt)
+        else:
+            rkllm_input.input_mode = RKLLMInputMode.RKLLM_INPUT_PROMPT
+            rkllm_input.input_data.prompt_input = ctypes.c_char_p(prompt.encode('utf-8'))
+        try:
+            infer_params.lora_params = self.lora_params_for(session.adapter)
+        except RuntimeError as e:
+            self.last_run_failed = True
+            session.on_error(str(e))
+            return
+        with active_sessions_lock:
+            active_sessions[session.key] = session
+        session.model = self
+        try:
+            session.prompt_eval_start_time = time.time()
+            if not session.cancelled:
+                self.rkllm_run(self.handle, ctypes.byref(rkllm_input), ctypes.byref(infer_params), ctypes.c_void_p(session.key))
+        finally:
+            session.model = None
+            self.last_run_failed = session.error is not None
+            with active_sessions_lock:
+                active_sessions.pop(session.key, None)
+            if session.aborted_tokens:
+                record_abort(aborted_tokens=session.aborted_tokens, count=False)
+            # Make sure readers wake up even if the runtime never reported FINISH
+            session.close()
+
+    def abort(self):
+        """Ask the runtime to stop the current rkllm_run as soon as possible"""
+        self.rkllm_abort(self.handle)
 
     def release(self):
         self.rkllm_destroy(self.handle)
 
-def format_messages_to_prompt(messages, tools=None):
-    """Convert OpenAI messages format to a prompt string with tool support"""
-    prompt_parts = []
-    
-    # Add system message with tool information
+def run_conversation_turn(rkllm_model, conversation, messages, session):
+    """
+    Run one turn of a server-side conversation with keep_history=1.
+    Only the new messages are prefilled when the runtime history still holds
+    this conversation and they fit on top of it with room for max_tokens;
+    otherwise the history is cleared and the full prompt (session.prompt,
+    already fitted to the context window) is prefilled.
+    `rkllm_model` must be checked out of the registry.
+    """
+    new_messages = None
+    if (rkllm_model.history_owner == conversation.id and rkllm_model.history_adapter == session.adapter
+            and conversation.history_tokens < CONVERSATION_MAX_HISTORY_TOKENS):
+        new_messages = conversation.new_messages(messages)
+    prompt = None
+    if new_messages and not any(message.get('role') == 'system' for message in new_messages):
+        parts = [part for part in map(render_message, new_messages) if part is not None]
+        prompt = "\n" + "\n".join(parts) + "\nAssistant:"
+        if not context_budgeter.fits_after(conversation.history_tokens, prompt, session.max_tokens or DEFAULT_MAX_TOKENS):
+            print(f"Conversation {conversation.id}: new turn does not fit on top of the history, prefilling in full")
+            prompt = None
+    if prompt is not None:
+        session.history_reused = True
+        conversation.reused_turns += 1
+        history_tokens = conversation.history_tokens
+    else:
+        rkllm_model.clear_history()
+        prompt = session.prompt
+        history_tokens = 0
+
+    rkllm_model.run(prompt, session, keep_history=True)
+
+    if session.error is None and not session.cancelled:
+        history_tokens += session.perf_prefill_tokens + session.perf_generate_tokens
+        conversation.commit(messages, "".join(session.chunks), history_tokens)
+        rkllm_model.history_owner = conversation.id
+        rkllm_model.history_adapter = session.adapter
+    else:
+        # Aborted or failed turns leave history the conversation does not know about
+        rkllm_model.history_owner = None
+
+def remember_turn(conversation, completion_id, messages, reply):
+    """
+    Make `completion_id` usable as previous_response_id once its turn has
+    finished. Conversation turns are committed by run_conversation_turn; for
+    any other request the store keeps its messages and reply, and starts a
+    conversation from them only if a later request continues it.
+    """
+    if conversation is None:
+        conversation_store.add_response(completion_id, messages, reply)
+    else:
+        conversation_store.add_response_id(conversation, completion_id)
+
+def start_generation(prompt, model_name=None, prefix=None, conversation=None, messages=None, request_id=None, max_tokens=None, stop=None, tool_parser=None, adapter=None):
+    """
+    Start generating for `prompt` with `model_name` on a model thread and return its GenerationSession.
+    `prefix` is the rendered system/tool prefix of the prompt, if any, for the prefix cache.
+    With a `conversation`, `messages` is the full conversation and the turn reuses
+    the runtime history where possible. `request_id` makes the run abortable via /v1/abort.
+    `max_tokens` and `stop` end the run early with finish_reason "length"/"stop".
+    A `tool_parser` splits tool calls out of the output and stops the run once they are complete.
+    `adapter` names the LoRA adapter to run with.
+    """
+    session = GenerationSession(prompt, request_id=request_id, max_tokens=max_tokens, stop=stop, tool_parser=tool_parser, adapter=adapter)
+    if request_id:
+        with active_sessions_lock:
+            running_requests[request_id] = session
+
+    def run():
+        global last_session
+        try:
+            # Conversations go back to the instance that holds their history when it is idle,
+            # other requests to one that last ran the same adapter
+            if conversation is not None:
+                prefer = lambda model: model.history_owner == conversation.id
+            else:
+                prefer = lambda model: model.runs_adapter(adapter)
+            with model_registry.use(model_name, prefer) as rkllm_model:
+                if conversation is not None:
+                    run_conversation_turn(rkllm_model, conversation, messages, session)
+                else:
+                    rkllm_model.run(prompt, session, prefix=prefix)
+        except Exception as e:
+            print(f"Generation failed: {e}", file=sys.stderr)
+            session.on_error(str(e))
+        finally:
+            if request_id:
+                with active_sessions_lock:
+                    if running_requests.get(request_id) is session:
+                        del running_requests[request_id]
+        last_session = session
+
+    threading.Thread(target=run, daemon=True).start()
+    return session
+
+def warm_up(model_name, instances):
+    """
+    Generate WARMUP_PROMPT once on each preloaded instance of `model_name`,
+    through the same prompt rendering as a chat request, so the first real
+    request does not pay for the runtime's lazy allocations.
+    """
+    messages = [{"role": "user", "content": WARMUP_PROMPT}]
+    prompt = format_messages_to_prompt(messages, max_tokens=WARMUP_MAX_TOKENS)
+    prefix = render_system_prefix(messages)
+    checked_out = []
+    try:
+        for _ in range(min(instances, model_registry.instances)):
+            checked_out.append(model_registry.checkout(model_name))
+        for loaded in checked_out:
+            session = GenerationSession(prompt, max_tokens=WARMUP_MAX_TOKENS)
+            loaded.model.run(prompt, session, prefix=prefix)
+            session.wait()
+            if session.error:
+                raise RuntimeError(f"Warm-up generation failed on worker {loaded.worker}: {session.error}")
+    finally:
+        for loaded in checked_out:
+            model_registry.checkin(loaded)
+
+def select_model(requested, messages=None, prompt=None, tools=None):
+    """
+    Registered model name for a request. AUTO_MODEL_NAME routes by difficulty:
+    tool use or a long prompt goes to the large model, everything else to the small one.
+    """
+    if requested == AUTO_MODEL_NAME:
+        if tools:
+            return AUTO_LARGE_MODEL
+        if prompt is None:
+            prompt = " ".join(str(message.get('content') or '') for message in messages or [])
+        return AUTO_LARGE_MODEL if count_tokens(prompt) > AUTO_LARGE_PROMPT_TOKENS else AUTO_SMALL_MODEL
+    return model_registry.resolve(requested)
+
+def select_model_and_adapter(data, messages=None, prompt=None, tools=None):
+    """
+    (model, adapter, error_response) for a request. The `model` field may
+    select a LoRA adapter as "<base>:<adapter>" or by the adapter's name, or
+    the `adapter` field names it; the adapter's base model then serves it.
+    """
+    if data.get('adapter') is not None and not isinstance(data['adapter'], str):
+        return None, None, openai_error_response("'adapter' must be a string", param="adapter")
+    try:
+        requested, adapter = adapter_registry.resolve(data.get('model', DEFAULT_MODEL_NAME), data.get('adapter'))
+    except KeyError as e:
+        return None, None, openai_error_response(e.args[0], param="adapter", code="adapter_not_found", status_code=404)
+    except ValueError as e:
+        return None, None, openai_error_response(str(e), param="adapter")
+    if adapter is not None:
+        return requested, adapter.name, None
+    return select_model(requested, messages=messages, prompt=prompt, tools=tools), None, None
+
+def model_id(model, adapter=None):
+    """The `model` reported in responses: "<base>:<adapter>" when an adapter ran"""
+    return f"{model}:{adapter}" if adapter else model
+
+def lookup_cached_response(model, prompt, max_tokens, stop, adapter=None):
+    """
+    Response cache key for a request and a ReplaySession if its response is cached.
+    Returns (None, None) when the cache is disabled.
+    """
+    if response_cache is None:
+        return None, None
+    adapters = model_adapters.get(model)
+    if adapter:
+        registered = adapter_registry.get(adapter)
+        adapters = [adapters, registered.path if registered else None]
+    key = ResponseCache.key(model_id(model, adapter), adapters, prompt, max_tokens, stop)
+    cached = response_cache.get(key)
+    if cached is None:
+        return key, None
+    return key, ReplaySession(cached, RESPONSE_CACHE_REPLAY_CHUNK_CHARS, RESPONSE_CACHE_REPLAY_DELAY)
+
+def remember_response(cache_key, session):
+    """Cache a finished generation; aborted, failed and replayed runs are skipped"""
+    if cache_key is None or isinstance(session, ReplaySession):
+        return
+    text = "".join(session.chunks)
+    if session.error or session.cancelled or session.finish_reason not in ("stop", "length") or not text:
+        return
+    response_cache.put(cache_key, text, session.finish_reason, session.usage())
+
+def with_cache_header(response, cache_key, session):
+    if cache_key is not None:
+        response.headers['X-Response-Cache'] = "hit" if isinstance(session, ReplaySession) else "miss"
+    return response
+
+def request_timings(ticket=None, render_ms=0.0):
+    """The part of a timing block known before generation starts: queue wait and prompt render"""
+    return {
+        "queue_ms": round(ticket.wait_time * 1000.0, 2) if ticket is not None else 0.0,
+        "render_ms": round(render_ms, 2),
+    }
+
+def generation_timings(sessions, ticket=None, render_ms=0.0, tool_ms=None, cache_key=None):
+    """
+    Timing block for a response, in milliseconds: queue wait, prompt render,
+    prefill and decode of the generations in `sessions` (two for a tool turn
+    the model answered), tool execution, and which caches were used.
+    """
+    prefill_ms = decode_ms = prefill_ms_saved = 0.0
+    prefill_tokens = decode_tokens = 0
+    prefix_cache, history_reused, replayed = None, False, False
+    for session in sessions:
+        if isinstance(session, ReplaySession):
+            replayed = True
+            continue
+        if session.perf_prefill_ms or session.perf_generate_ms:
+            prefill_ms += session.perf_prefill_ms
+            decode_ms += session.perf_generate_ms
+        elif session.prompt_eval_start_time and session.first_token_time:
+            # The runtime reported no perf stats: use the callback times
+            prefill_ms += (session.first_token_time - session.prompt_eval_start_time) * 1000.0
+            decode_ms += max(session.generation_finish_time - session.first_token_time, 0.0) * 1000.0
+        prefill_tokens += session.perf_prefill_tokens
+        decode_tokens += session.perf_generate_tokens or session.generated_tokens
+        prefix_cache = prefix_cache or session.prefix_cache
+        history_reused = history_reused or session.history_reused
+        prefill_ms_saved += session.prefill_ms_saved
+
+    timings = request_timings(ticket, render_ms)
+    timings.update({
+        "prefill_ms": round(prefill_ms, 2),
+        "decode_ms": round(decode_ms, 2),
+        "prefill_tps": round(prefill_tokens / (prefill_ms / 1000.0), 2) if prefill_ms > 0 else 0.0,
+        "decode_tps": round(decode_tokens / (decode_ms / 1000.0), 2) if decode_ms > 0 else 0.0,
+        "response_cache": "hit" if replayed else ("miss" if cache_key is not None else None),
+        "prefix_cache": prefix_cache,
+        "history_reused": history_reused,
+        "prefill_ms_saved": round(prefill_ms_saved, 2),
+    })
+    if tool_ms is not None:
+        timings["tool_ms"] = round(tool_ms, 2)
+    return timings
+
+def server_timing(timings):
+    """Server-Timing header value for a timing block, or the part of one known so far"""
+    entries = [
+        f"{name};dur={timings[key]}"
+        for name, key in (("queue", "queue_ms"), ("render", "render_ms"), ("prefill", "prefill_ms"),
+                          ("decode", "decode_ms"), ("tool", "tool_ms"))
+        if key in timings
+    ]
+    for name, key in (("response-cache", "response_cache"), ("prefix-cache", "prefix_cache")):
+        if timings.get(key):
+            entries.append(f'{name};desc="{timings[key]}"')
+    if timings.get("history_reused"):
+        entries.append('kv-history;desc="reused"')
+    return ", ".join(entries)
+
+def with_timings(response, timings):
+    response.headers['Server-Timing'] = server_timing(timings)
+    return response
+
+def chat_chunk(completion_id, created_timestamp, model, delta, finish_reason=None, **extra):
+    """One chat.completion.chunk server-sent event; `extra` adds top-level fields"""
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created_timestamp,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "delta": delta,
+            "finish_reason": finish_reason
+        }],
+        **extra
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+def usage_chunk(completion_id, created_timestamp, model, usage):
+    """The extra last chunk sent with stream_options.include_usage: no choices, just usage"""
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created_timestamp,
+        "model": model,
+        "choices": [],
+        "usage": usage
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+def parse_generation_limits(data):
+    """
+    Read max_tokens and stop from a request body.
+    Returns (max_tokens, stop, None), or (None, None, error_response) when invalid.
+    Requests without max_tokens get DEFAULT_MAX_TOKENS so no answer runs unbounded.
+    """
+    max_tokens = data.get('max_completion_tokens', data.get('max_tokens'))
+    if max_tokens is None:
+        max_tokens = DEFAULT_MAX_TOKENS
+    elif isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1:
+        return None, None, openai_error_response("max_tokens must be a positive integer", param="max_tokens")
+
+    stop = data.get('stop')
+    if stop is None:
+        stop = []
+    elif isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, list) or len(stop) > MAX_STOP_SEQUENCES or not all(isinstance(s, str) and s for s in stop):
+        return None, None, openai_error_response(
+            f"stop must be a non-empty string or a list of up to {MAX_STOP_SEQUENCES} non-empty strings",
+            param="stop"
+        )
+
+    # Sampling is fixed when the model is initialized; reject values the runtime could never use
+    for name, low, high in (('temperature', 0.0, 2.0), ('top_p', 0.0, 1.0)):
+        value = data.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high):
+            return None, None, openai_error_response(f"{name} must be a number between {low} and {high}", param=name)
+
+    return max_tokens, stop, None
+
+def combine_usage(*usages):
+    """Sum the usage blocks of several generations"""
+    total = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    for usage in usages:
+        for key in total:
+            total[key] += usage[key]
+    return total
+
+# Rendered tool instructions, keyed by the JSON of the tool list
+tool_instruction_cache = {}
+
+def render_tool_instructions(tools):
+    """Render TOOL_SYSTEM_TEMPLATE for `tools`, reusing earlier renders of the same tool list"""
+    key = json.dumps(tools, sort_keys=True)
+    instruction = tool_instruction_cache.get(key)
+    if instruction is None:
+        instruction = TOOL_SYSTEM_TEMPLATE.render(tools=tools)
+        if len(tool_instruction_cache) >= 64:
+            tool_instruction_cache.clear()
+        tool_instruction_cache[key] = instruction
+    return instruction
+
+def render_system_prefix(messages, tools=None):
+    """
+    Render the system message and tool instructions that start the prompt.
+    Returns "" when there is neither. Requests with the same system prompt
+    and tools get the same prefix, which is what the prefix cache keys on.
+    """
     system_message = None
     for message in messages:
         if message.get('role') == 'system':
@@ -559,143 +1400,205 @@ def format_messages_to_prompt(messages, tools=None):
     if system_message:
         if tools:
             # Combine original system message with tool instructions
-            tool_instruction = TOOL_SYSTEM_TEMPLATE.render(tools=tools)
-            combined_system = f"{system_message}\n\n{tool_instruction}"
-            prompt_parts.append(f"System: {combined_system}")
-        else:
-            prompt_parts.append(f"System: {system_message}")
+            tool_instruction = render_tool_instructions(tools)
+            return f"System: {system_message}\n\n{tool_instruction}\n"
+        return f"System: {system_message}\n"
     elif tools:
         # No system message, but we have tools
-        tool_instruction = TOOL_SYSTEM_TEMPLATE.render(tools=tools)
-        prompt_parts.append(f"System: {tool_instruction}")
+        return f"System: {render_tool_instructions(tools)}\n"
+    return ""
+
+def render_message(message):
+    """Render one non-system message as a prompt line, or None for messages that are skipped"""
+    role = message.get('role', '')
+    content = message.get('content', '')
+    
+    if role == 'user':
+        return f"User: {content}"
+    elif role == 'assistant':
+        # Handle assistant messages with tool calls
+        if message.get('tool_calls'):
+            tool_calls_text = content if content else ""
+            for tool_call in message['tool_calls']:
+                func_name = tool_call['function']['name']
+                func_args = tool_call['function']['arguments']
+                tool_calls_text += f"\n<tool_call>\n{{'name': '{func_name}', 'arguments': {func_args}}}\n</tool_call>"
+            return f"Assistant: {tool_calls_text}"
+        return f"Assistant: {content}"
+    elif role == 'tool':
+        return f"Tool Result: {content}\n\nBased on this tool result, please provide a helpful response to the user. Do not make additional tool calls."
+    # System messages are rendered into the prefix
+    return None
+
+def format_messages_to_prompt(messages, tools=None, max_tokens=None):
+    """
+    Convert OpenAI messages format to a prompt string with tool support.
+    The prompt is fitted to the context window with room for `max_tokens`;
+    the system prefix is always kept and the oldest turns go first.
+    """
+    prompt_parts = []
+    
+    # System message with tool information
+    prefix = render_system_prefix(messages, tools)
     
     # Add other messages
     for message in messages:
-        role = message.get('role', '')
-        content = message.get('content', '')
-        
-        if role == 'system':
-            continue  # Already handled above
-        elif role == 'user':
-            prompt_parts.append(f"User: {content}")
-        elif role == 'assistant':
-            # Handle assistant messages with tool calls
-            if message.get('tool_calls'):
-                tool_calls_text = content if content else ""
-                for tool_call in message['tool_calls']:
-                    func_name = tool_call['function']['name']
-                    func_args = tool_call['function']['arguments']
-                    tool_calls_text += f"\n<tool_call>\n{{'name': '{func_name}', 'arguments': {func_args}}}\n</tool_call>"
-                prompt_parts.append(f"Assistant: {tool_calls_text}")
-            else:
-                prompt_parts.append(f"Assistant: {content}")
-        elif role == 'tool':
-            tool_call_id = message.get('tool_call_id', '')
-            prompt_parts.append(f"Tool Result: {content}\n\nBased on this tool result, please provide a helpful response to the user. Do not make additional tool calls.")
+        part = render_message(message)
+        if part is not None:
+            prompt_parts.append(part)
     
-    # Combine all parts and truncate if necessary
-    full_prompt = "\n".join(prompt_parts) + "\nAssistant:"
-    return truncate_to_last_words(full_prompt, 4000)
-
-def process_conversation_with_tools(messages, tools):
-    """Process a conversation with a single tool call iteration"""
-    conversation_messages = messages.copy()
+    # Combine all parts, dropping old turns that do not fit
+    prompt_parts = context_budgeter.fit(prefix, prompt_parts, "\nAssistant:", max_tokens or DEFAULT_MAX_TOKENS)
+    if prompt_parts:
+        return prefix + "\n".join(prompt_parts) + "\nAssistant:"
+    return prefix.rstrip("\n") + "\nAssistant:"
+
+class ToolTurn:
+    """Outcome of a tool-enabled turn, filled in while its events are consumed"""
+
+    def __init__(self, messages):
+        self.messages = messages.copy()
+        self.tool_calls = []
+        self.usage = None
+        self.finish_reason = "stop"
+        self.path = "none"  # "direct" when the tools answered, "synthesis" when a second pass did
+        self.sessions = []  # The generations of the turn, for its timing block
+        self.render_ms = 0.0
+        self.tool_ms = None
+        self.answer = ""  # The final assistant text, after any tool calls
+
+def tool_turn_events(turn, tools, model_name=None, request_id=None, max_tokens=None, stop=None, adapter=None):
+    """
+    Run a conversation turn with a single tool call iteration, yielding content
+    strings and ToolCallDeltas as they are generated. Decoding stops as soon as
+    the model's tool calls are complete; the tools are executed and a second
+    pass answers from their results. Usage and finish_reason end up on `turn`.
+    """
+    render_started = time.time()
+    prompt = format_messages_to_prompt(turn.messages, tools, max_tokens)
+    prefix = render_system_prefix(turn.messages, tools)
+    turn.render_ms += (time.time() - render_started) * 1000.0
     
-    # First call: Check if model wants to use tools
-    prompt = format_messages_to_prompt(conversation_messages, tools)
+    # First call: content streams through while tool calls are parsed out of the output
+    first_pass = start_generation(
+        prompt, model_name, prefix=prefix, request_id=request_id, max_tokens=max_tokens,
+        tool_parser=StreamingToolCallParser(), adapter=adapter
+    )
+    turn.sessions.append(first_pass)
+    # The first pass runs without stop strings so tool calls cannot be cut; apply them to its content here
+    matcher = StopSequenceMatcher(stop) if stop else None
+    content = []
+    try:
+        for event in first_pass:
+            if isinstance(event, str):
+                if matcher is not None:
+                    event, matched = matcher.feed(event)
+                    if matched:
+                        first_pass.stop_generation("stop")
+                if event:
+                    content.append(event)
+                    yield event
+            elif not first_pass.limit_reached or first_pass.finish_reason == "tool_calls":
+                yield event
+    finally:
+        if first_pass.is_generating:
+            first_pass.cancel()
+    if matcher is not None and matcher.matched is None:
+        # No stop string matched: release the text held back for partial matches
+        tail = matcher.flush()
+        if tail:
+            content.append(tail)
+            yield tail
     
-    # Run the model
-    global global_text, global_state
-    global_text = []
-    global_state = -1
+    tool_calls = first_pass.tool_parser.calls if first_pass.finish_reason in ("tool_calls", "length") else []
+    if not tool_calls:
+        turn.answer = "".join(content).strip()
+        turn.usage = first_pass.usage()
+        turn.finish_reason = first_pass.finish_reason if first_pass.finish_reason != "tool_calls" else "stop"
+        return
     
-    model_thread = threading.Thread(target=rkllm_model.run, args=(prompt,))
-    model_thread.start()
+    # Add assistant message with tool calls
+    turn.tool_calls = tool_calls
+    text = "".join(content).strip()
+    turn.messages.append({
+        "role": "assistant",
+        "content": text if text else None,
+        "tool_calls": tool_calls
+    })
     
-    full_response = ""
-    model_thread_finished = False
+    # Execute the tool calls in parallel and add their results
+    calls = [
+        (tool_call['function']['name'], json.loads(tool_call['function']['arguments']))
+        for tool_call in tool_calls
+    ]
+    tools_started = time.time()
+    tool_results = tool_registry.execute_many(calls)
+    turn.tool_ms = (time.time() - tools_started) * 1000.0
+    for tool_call, tool_result in zip(tool_calls, tool_results):
+        turn.messages.append({
+            "role": "tool",
+            "tool_call_id": tool_call['id'],
+            "content": json.dumps(tool_result)
+        })
     
-    while not model_thread_finished:
-        while len(global_text) > 0:
-            full_response += global_text.pop(0)
-            time.sleep(0.005)
-        
-        model_thread.join(timeout=0.005)
-        model_thread_finished = not model_thread.is_alive()
+    # Tools with a response template answer directly, skipping the second pass
+    answer = tool_registry.direct_response(calls, tool_results)
+    if answer is not None:
+        if text:
+            answer = "\n" + answer
+        if stop:
+            # The answer is complete, so text held back for a partial match belongs to it
+            answer_matcher = StopSequenceMatcher(stop)
+            answer, matched = answer_matcher.feed(answer)
+            if not matched:
+                answer += answer_matcher.flush()
+        yield answer
+        turn.answer = answer.strip()
+        turn.path = "direct"
+        tool_registry.record_turn(turn.path)
+        turn.usage = first_pass.usage()
+        turn.finish_reason = "stop"
+        return
     
-    # Check if the response contains tool calls
-    tool_calls = parse_tool_calls(full_response)
+    # Second call: Get final response after tool execution
+    render_started = time.time()
+    final_prompt = format_messages_to_prompt(turn.messages, tools, max_tokens)
+    final_prompt += "\n\nPlease provide a natural language response based on the tool results above. Do not make any more tool calls."
+    turn.render_ms += (time.time() - render_started) * 1000.0
     
-    if tool_calls:
-        # Extract text content without tool calls
-        content = extract_text_without_tool_calls(full_response)
-        
-        # Add assistant message with tool calls
-        conversation_messages.append({
-            "role": "assistant",
-            "content": content.strip() if content.strip() else None,
-            "tool_calls": tool_calls
-        })
-        
-        # Execute tool calls and add results
-        for tool_call in tool_calls:
-            func_name = tool_call['function']['name']
-            func_args = json.loads(tool_call['function']['arguments'])
-            
-            # Execute the tool
-            tool_result = execute_tool_call(func_name, func_args)
-            
-            # Add tool result message
-            conversation_messages.append({
-                "role": "tool",
-                "tool_call_id": tool_call['id'],
-                "content": json.dumps(tool_result)
-            })
-        
-        # Second call: Get final response after tool execution
-        final_prompt = format_messages_to_prompt(conversation_messages, tools)
-        final_prompt += "\n\nPlease provide a natural language response based on the tool results above. Do not make any more tool calls."
-        
-        global_text = []
-        global_state = -1
-        
-        final_thread = threading.Thread(target=rkllm_model.run, args=(final_prompt,))
-        final_thread.start()
-        
-        final_response = ""
-        final_thread_finished = False
-        
-        while not final_thread_finished:
-            while len(global_text) > 0:
-                final_response += global_text.pop(0)
-                time.sleep(0.005)
-            
-            final_thread.join(timeout=0.005)
-            final_thread_finished = not final_thread.is_alive()
-        
-        return final_response.strip(), conversation_messages
-    else:
-        # No tool calls, return the response directly
-        return full_response.strip(), conversation_messages
+    final_pass = start_generation(final_prompt, model_name, prefix=prefix, request_id=request_id, max_tokens=max_tokens, stop=stop, adapter=adapter)
+    turn.sessions.append(final_pass)
+    answer = []
+    try:
+        for chunk in final_pass:
+            answer.append(chunk)
+            yield chunk
+    finally:
+        if final_pass.is_generating:
+            final_pass.cancel()
+    turn.answer = "".join(answer).strip()
+    turn.path = "synthesis"
+    tool_registry.record_turn(turn.path)
+    turn.usage = combine_usage(first_pass.usage(), final_pass.usage())
+    turn.finish_reason = final_pass.finish_reason
+
+def process_conversation_with_tools(messages, tools, model_name=None, request_id=None, max_tokens=None, stop=None, adapter=None):
+    """
+    Process a conversation with a single tool call iteration.
+    Returns (final_response, turn); the ToolTurn holds the messages, usage,
+    finish_reason, tool path and timings.
+    """
+    turn = ToolTurn(messages)
+    response = "".join(
+        event for event in tool_turn_events(turn, tools, model_name, request_id, max_tokens, stop, adapter)
+        if isinstance(event, str)
+    )
+    return response.strip(), turn
 
 # OpenAI API Endpoints
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
-    global global_state, is_blocking
-    
-    # Create a lock for the blocking state
-    blocking_lock = threading.Lock()
-    
-    with blocking_lock:
-        if is_blocking or not global_state.finished:
-            return openai_error_response(
-                "Model is running another process, wait for it to finish to start using",
-                error_type="server_busy",
-                status_code=503
-            )
-        is_blocking = True
-    
     try:
         data = request.json
         if not data:
@@ -709,190 +1612,219 @@ def chat_completions():
         if not isinstance(messages, list) or len(messages) == 0:
             return openai_error_response("Messages must be a non-empty array", param="messages")
         
+        # Server-side conversation, continued by session_id or previous_response_id
+        conversation = None
+        if data.get('previous_response_id'):
+            conversation = conversation_store.by_response_id(data['previous_response_id'])
+            if conversation is None:
+                return openai_error_response(
+                    "previous_response_id not found or expired",
+                    param="previous_response_id",
+                    status_code=404
+                )
+            messages = conversation.resolve_messages(messages, append_only=True)
+        elif data.get('session_id'):
+            if data.get('tools'):
+                # Tool turns run two passes without the runtime history
+                return openai_error_response(
+                    "session_id cannot be combined with tools; continue tool conversations with previous_response_id",
+                    param="session_id"
+                )
+            conversation = conversation_store.get_or_create(str(data['session_id']))
+        
         # Get other parameters
-        model = data.get('model', DEFAULT_MODEL_NAME)
+        record = g.get('request_record', {})
         stream = data.get('stream', False)
+        include_usage = bool(stream and (data.get('stream_options') or {}).get('include_usage'))
         tools = data.get('tools', [])
+        model, adapter, error = select_model_and_adapter(data, messages=messages, tools=tools)
+        if error:
+            return error
+        response_model = model_id(model, adapter)
         tool_choice = data.get('tool_choice')
-        max_tokens = data.get('max_tokens')
-        temperature = data.get('temperature')
-        top_p = data.get('top_p')
+        max_tokens, stop, error = parse_generation_limits(data)
+        if error:
+            return error
+        
+        # Plain (no tools, no conversation) requests can be answered from the response cache
+        prompt = None
+        render_ms = 0.0
+        cache_key, cached_session = None, None
+        if not tools and conversation is None:
+            render_started = time.time()
+            prompt = format_messages_to_prompt(messages, max_tokens=max_tokens)
+            render_ms = (time.time() - render_started) * 1000.0
+            cache_key, cached_session = lookup_cached_response(model, prompt, max_tokens, stop, adapter)
+        
+        ticket = None
+        if cached_session is None:
+            ticket, error = admit_request(group=response_model)
+            if error:
+                return error
+        streaming_started = False
         
-        lock.acquire()
         try:
-            is_blocking = True
-            
             # Generate unique ID and timestamp
             completion_id = f"chatcmpl-{str(uuid.uuid4())}"
             created_timestamp = int(datetime.now().timestamp())
+            record.update(id=completion_id, model=response_model)
             
-            if tools:
+            if tools and stream:
+                turn = ToolTurn(messages)
+                events = tool_turn_events(turn, tools, model, completion_id, max_tokens, stop, adapter)
+                encoder = ChunkEncoder(completion_id, created_timestamp, response_model, stream_stats)
+                
+                def generate_with_tools():
+                    try:
+                        for event in events:
+                            if isinstance(event, ToolCallDelta):
+                                yield chat_chunk(completion_id, created_timestamp, response_model, {"tool_calls": [event.to_dict()]})
+                            else:
+                                yield encoder.content([event])
+                        timings = generation_timings(turn.sessions, ticket, turn.render_ms, turn.tool_ms)
+                        record.update(finish_reason=turn.finish_reason, usage=turn.usage, tool_path=turn.path, timings=timings)
+                        if not any(session.error for session in turn.sessions):
+                            remember_turn(None, completion_id, turn.messages, turn.answer)
+                        yield chat_chunk(completion_id, created_timestamp, response_model, {}, turn.finish_reason, tool_path=turn.path, timings=timings)
+                        if include_usage:
+                            yield usage_chunk(completion_id, created_timestamp, response_model, turn.usage)
+                        yield "data: [DONE]\n\n"
+                        encoder.done()
+                    except Exception as e:
+                        yield from stream_error_events(e)
+                    finally:
+                        # Stops any generation still running when the client goes away
+                        events.close()
+                
+                response = Response(generate_with_tools(), content_type='text/event-stream; charset=utf-8', headers=SSE_HEADERS)
+                response.call_on_close(ticket.release)
+                streaming_started = True
+                # Only the queue wait is known when the headers go out; the full block is in the final chunk
+                return with_queue_headers(with_timings(response, request_timings(ticket)), ticket)
+            elif tools:
                 # Process conversation with tools (single iteration)
-                final_response, final_messages = process_conversation_with_tools(messages, tools)
+                final_response, turn = process_conversation_with_tools(
+                    messages, tools, model_name=model, request_id=completion_id, max_tokens=max_tokens, stop=stop,
+                    adapter=adapter
+                )
+                timings = generation_timings(turn.sessions, ticket, turn.render_ms, turn.tool_ms)
+                record.update(finish_reason=turn.finish_reason, usage=turn.usage, tool_path=turn.path, timings=timings)
+                if not any(session.error for session in turn.sessions):
+                    remember_turn(None, completion_id, turn.messages, turn.answer)
                 
                 # Always return the final response (no tool_calls in the final response)
                 response = {
                     "id": completion_id,
                     "object": "chat.completion",
                     "created": created_timestamp,
-                    "model": model,
+                    "model": response_model,
                     "choices": [{
                         "index": 0,
                         "message": {
                             "role": "assistant",
                             "content": final_response
                         },
-                        "finish_reason": "stop"
+                        "finish_reason": turn.finish_reason
                     }],
-                    "usage": {
-                        "prompt_tokens": count_tokens(str(final_messages)),
-                        "completion_tokens": count_tokens(final_response),
-                        "total_tokens": count_tokens(str(final_messages)) + count_tokens(final_response)
-                    }
+                    "usage": turn.usage,
+                    "tool_path": turn.path,
+                    "timings": timings
                 }
                 
-                return jsonify(response), 200
+                response = jsonify(response)
+                response.headers['X-Tool-Path'] = turn.path
+                return with_queue_headers(with_timings(response, timings), ticket), 200
             else:
                 # No tools, use original logic
-                prompt = format_messages_to_prompt(messages)
+                render_started = time.time()
+                if prompt is None:
+                    prompt = format_messages_to_prompt(messages, max_tokens=max_tokens)
+                prefix = render_system_prefix(messages)
+                render_ms += (time.time() - render_started) * 1000.0
                 
                 if stream:
-                    def generate():
-                        global global_state
-                        try:
-                            # Reset the global state for this new request
-                            with global_state.lock:
-                                global_state.reset_perf_metrics()
-                                global_state.finished = False
-                                global_state.prompt_word_count = count_tokens(prompt)
-                                global_state.prompt_eval_start_time = time.time()
-
-                            model_thread = threading.Thread(target=rkllm_model.run, args=(prompt,))
-                            model_thread.start()
-                            
-                            full_content = ""
-                            
-                            while True:
-                                try:
-                                    # Wait for new content with timeout
-                                    chunk = global_state.text_queue.get(timeout=0.1)
-                                    full_content += chunk
-                                    
-                                    chunk_response = {
-                                        "id": completion_id,
-                                        "object": "chat.completion.chunk",
-                                        "created": created_timestamp,
-                                        "model": model,
-                                        "choices": [{
-                                            "index": 0,
-                                            "delta": {
-                                                "content": chunk
-                                            },
-                                            "finish_reason": None
-                                        }]
-                                    }
-                                    yield f"data: {json.dumps(chunk_response)}\n\n"
-                                    
-                                except Exception as e:
-                                    # Check if generation is finished
-                                    with global_state.lock:
-                                        if global_state.finished and global_state.text_queue.empty():
-                                            break
-                                    
-                                    # Check if model thread is still running
-                                    if not model_thread.is_alive() and global_state.text_queue.empty():
-                                        with global_state.lock:
-                                            global_state.finished = True
-                                            break
-                            
-                            # Send final chunk with finish_reason
-                            final_chunk = {
-                                "id": completion_id,
-                                "object": "chat.completion.chunk", 
-                                "created": created_timestamp,
-                                "model": model,
-                                "choices": [{
-                                    "index": 0,
-                                    "delta": {},
-                                    "finish_reason": "stop"
-                                }]
-                            }
-                            yield f"data: {json.dumps(final_chunk)}\n\n"
-                            yield "data: [DONE]\n\n"
-                            
-                        except Exception as e:
-                            print(f"Error in streaming: {str(e)}")
-                            yield f"data: {{'error': 'Stream error: {str(e)}'}}\n\n"
-                            yield "data: [DONE]\n\n"
+                    def start():
+                        return cached_session or start_generation(
+                            prompt, model, prefix=prefix, conversation=conversation, messages=messages,
+                            request_id=completion_id, max_tokens=max_tokens, stop=stop, adapter=adapter
+                        )
                     
-                    return Response(generate(), content_type='text/plain; charset=utf-8')
+                    encoder = ChunkEncoder(completion_id, created_timestamp, response_model, stream_stats)
+                    
+                    def finish(session):
+                        # Send final chunk with finish_reason and the timing block
+                        timings = generation_timings([session], ticket, render_ms, cache_key=cache_key)
+                        record.update(finish_reason=session.finish_reason, usage=session.usage(), timings=timings)
+                        if not session.error:
+                            remember_turn(conversation, completion_id, messages, session.wait())
+                        yield chat_chunk(completion_id, created_timestamp, response_model, {}, session.finish_reason, timings=timings)
+                        if include_usage:
+                            yield usage_chunk(completion_id, created_timestamp, response_model, session.usage())
+                        yield "data: [DONE]\n\n"
+                        encoder.done()
+                        remember_response(cache_key, session)
+                    
+                    # Tokens are coalesced into frames; a client that goes away or a failed stream aborts the run
+                    stream_body = SessionStream(
+                        start, encoder.content, finish,
+                        window=SSE_COALESCE_WINDOW_MS / 1000.0,
+                        max_bytes=SSE_COALESCE_MAX_BYTES
+                    )
+                    response = Response(stream_body, content_type='text/event-stream; charset=utf-8', headers=SSE_HEADERS)
+                    # Keep the model slot until the stream has been fully sent or dropped
+                    if ticket is not None:
+                        response.call_on_close(ticket.release)
+                    streaming_started = True
+                    if conversation is not None:
+                        response.headers['X-Session-Id'] = conversation.id
+                    with_cache_header(response, cache_key, cached_session)
+                    return with_queue_headers(with_timings(response, request_timings(ticket, render_ms)), ticket)
                 
                 else:
                     # Non-streaming response
-                    global_state = GlobalState()
-                    
-                    model_thread = threading.Thread(target=rkllm_model.run, args=(prompt,))
-                    model_thread.start()
-                    
-                    full_content = ""
-                    
-                    while True:
-                        try:
-                            # Get content with timeout
-                            chunk = global_state.text_queue.get(timeout=0.1)
-                            full_content += chunk
-                        except:
-                            # Check if generation is finished
-                            with global_state.lock:
-                                if global_state.finished and global_state.text_queue.empty():
-                                    break
-                            
-                            # Check if model thread is still running
-                            if not model_thread.is_alive() and global_state.text_queue.empty():
-                                with global_state.lock:
-                                    if global_state.finished:
-                                        break
+                    session = cached_session or start_generation(
+                        prompt, model, prefix=prefix, conversation=conversation, messages=messages,
+                        request_id=completion_id, max_tokens=max_tokens, stop=stop, adapter=adapter
+                    )
+                    full_content = session.wait()
+                    if session.error and not full_content:
+                        return openai_error_response(f"Generation failed: {session.error}", error_type="server_error", status_code=500)
+                    remember_response(cache_key, session)
+                    if not session.error:
+                        remember_turn(conversation, completion_id, messages, full_content)
                     
                     response = {
                         "id": completion_id,
                         "object": "chat.completion",
                         "created": created_timestamp,
-                        "model": model,
+                        "model": response_model,
                         "choices": [{
                             "index": 0,
                             "message": {
                                 "role": "assistant",
                                 "content": full_content.strip()
                             },
-                            "finish_reason": "stop"
+                            "finish_reason": session.finish_reason
                         }],
-                        "usage": {
-                            "prompt_tokens": count_tokens(prompt),
-                            "completion_tokens": count_tokens(full_content),
-                            "total_tokens": count_tokens(prompt) + count_tokens(full_content)
-                        }
+                        "usage": session.usage(),
+                        "timings": generation_timings([session], ticket, render_ms, cache_key=cache_key)
                     }
+                    if conversation is not None:
+                        response["session_id"] = conversation.id
+                    record.update(finish_reason=session.finish_reason, usage=response["usage"], timings=response["timings"])
                     
-                    return jsonify(response), 200
+                    response = with_timings(with_cache_header(jsonify(response), cache_key, session), response["timings"])
+                    return with_queue_headers(response, ticket), 200
                 
         finally:
-            lock.release()
-            is_blocking = False
+            if ticket is not None and not streaming_started:
+                ticket.release()
             
     except Exception as e:
         return openai_error_response(f"Internal server error: {str(e)}", error_type="server_error", status_code=500)
 
 @app.route('/v1/completions', methods=['POST'])
 def completions():
-    global global_text, global_state, is_blocking
-
-    if is_blocking or not global_state.finished:
-        return openai_error_response(
-            "Model is running another process, wait for it to finish to start using",
-            error_type="server_busy",
-            status_code=503
-        )
-    
     try:
         data = request.json
         if not data:
@@ -906,66 +1838,246 @@ def completions():
         if not isinstance(prompt, str):
             return openai_error_response("Prompt must be a string", param="prompt")
         
-        # Truncate prompt to last 4000 words if it exceeds the limit
-        truncated_prompt = truncate_to_last_words(prompt, 4000)
+        max_tokens, stop, error = parse_generation_limits(data)
+        if error:
+            return error
+        
+        # Keep the end of the prompt that fits the context window with room for the answer
+        render_started = time.time()
+        truncated_prompt = context_budgeter.truncate_text(prompt, context_budgeter.prompt_budget(max_tokens))
+        render_ms = (time.time() - render_started) * 1000.0
         
         # Get other parameters
-        model = data.get('model', DEFAULT_MODEL_NAME)
-        max_tokens = data.get('max_tokens')
-        temperature = data.get('temperature')
-        top_p = data.get('top_p')
+        model, adapter, error = select_model_and_adapter(data, prompt=truncated_prompt)
+        if error:
+            return error
+        response_model = model_id(model, adapter)
+        
+        cache_key, session = lookup_cached_response(model, truncated_prompt, max_tokens, stop, adapter)
+        ticket = None
+        if session is None:
+            ticket, error = admit_request(group=response_model)
+            if error:
+                return error
         
-        lock.acquire()
         try:
-            is_blocking = True
-            global_text = []
-            global_state = -1
-            
             # Generate unique ID and timestamp
             completion_id = f"cmpl-{str(uuid.uuid4())}"
             created_timestamp = int(datetime.now().timestamp())
+            record = g.get('request_record', {})
+            record.update(id=completion_id, model=response_model)
             
-            model_thread = threading.Thread(target=rkllm_model.run, args=(truncated_prompt,))
-            model_thread.start()
-            
-            full_completion = ""
-            model_thread_finished = False
-            
-            while not model_thread_finished:
-                while len(global_text) > 0:
-                    full_completion += global_text.pop(0)
-                    time.sleep(0.005)
-                
-                model_thread.join(timeout=0.005)
-                model_thread_finished = not model_thread.is_alive()
+            if session is None:
+                session = start_generation(truncated_prompt, model, request_id=completion_id, max_tokens=max_tokens, stop=stop, adapter=adapter)
+            full_completion = session.wait()
+            if session.error and not full_completion:
+                return openai_error_response(f"Generation failed: {session.error}", error_type="server_error", status_code=500)
+            remember_response(cache_key, session)
             
             response = {
                 "id": completion_id,
                 "object": "text_completion",
                 "created": created_timestamp,
-                "model": model,
+                "model": response_model,
                 "choices": [{
                     "text": full_completion,
                     "index": 0,
                     "logprobs": None,
-                    "finish_reason": "stop"
+                    "finish_reason": session.finish_reason
                 }],
-                "usage": {
-                    "prompt_tokens": count_tokens(truncated_prompt),
-                    "completion_tokens": count_tokens(full_completion),
-                    "total_tokens": count_tokens(truncated_prompt) + count_tokens(full_completion)
-                }
+                "usage": session.usage(),
+                "timings": generation_timings([session], ticket, render_ms, cache_key=cache_key)
             }
+            record.update(finish_reason=session.finish_reason, usage=response["usage"], timings=response["timings"])
             
-            return jsonify(response), 200
+            response = with_timings(with_cache_header(jsonify(response), cache_key, session), response["timings"])
+            return with_queue_headers(response, ticket), 200
             
         finally:
-            lock.release()
-            is_blocking = False
+            if ticket is not None:
+                ticket.release()
             
     except Exception as e:
         return openai_error_response(f"Internal server error: {str(e)}", error_type="server_error", status_code=500)
 
+@app.route('/v1/embeddings', methods=['POST'])
+def embeddings():
+    """
+    OpenAI-compatible embeddings. Each input is prefilled once on the NPU in
+    last-hidden-layer mode and its hidden states are pooled into a vector
+    (EMBEDDING_POOLING, or `pooling` in the request: "mean" or "last").
+    """
+    data = request.get_json(silent=True)
+    if not data or 'input' not in data:
+        return openai_error_response("Missing 'input' in request body", param="input")
+
+    inputs = data['input']
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not isinstance(inputs, list) or not inputs or not all(isinstance(text, str) and text for text in inputs):
+        return openai_error_response("'input' must be a non-empty string or a list of non-empty strings", param="input")
+    if len(inputs) > EMBEDDING_MAX_INPUTS:
+        return openai_error_response(f"At most {EMBEDDING_MAX_INPUTS} inputs are allowed per request", param="input")
+
+    pooling = data.get('pooling', EMBEDDING_POOLING)
+    if pooling not in POOLING_MODES:
+        return openai_error_response(f"'pooling' must be one of {list(POOLING_MODES)}", param="pooling")
+    encoding_format = data.get('encoding_format', 'float')
+    if encoding_format not in ('float', 'base64'):
+        return openai_error_response("'encoding_format' must be 'float' or 'base64'", param="encoding_format")
+    model = model_registry.resolve(data.get('model', DEFAULT_MODEL_NAME))
+
+    keys = [EmbeddingCache.key(model, pooling, text) for text in inputs]
+    vectors = [embedding_cache.get(key) for key in keys]
+    prompt_tokens = sum(count_tokens(text) for text in inputs)
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    ticket = None
+    if missing:
+        ticket, error = admit_request()
+        if error:
+            return error
+        try:
+            with model_registry.use(model) as rkllm_model:
+                for i in missing:
+                    hidden_states, _ = rkllm_model.get_hidden_states(inputs[i])
+                    vectors[i] = pool(hidden_states, pooling, EMBEDDING_NORMALIZE)
+                    embedding_cache.put(keys[i], vectors[i])
+        except Exception as e:
+            print(f"Embedding failed: {e}", file=sys.stderr)
+            response, status = openai_error_response(f"Embedding failed: {e}", error_type="server_error", status_code=500)
+            return with_queue_headers(response, ticket), status
+        finally:
+            ticket.release()
+
+    response = jsonify({
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": encode_vector(vector, encoding_format)}
+            for i, vector in enumerate(vectors)
+        ],
+        "model": model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+    })
+    return with_queue_headers(response, ticket) if ticket else response
+
+@app.route('/v1/score', methods=['POST'])
+def score():
+    """
+    Score candidate continuations of one or more prompts without generating,
+    e.g. labels for classification or "Yes"/"No" after a passage for reranking.
+    Prompts and candidates are tokenized here and prefilled as token ids in
+    logits mode; a candidate's score is the sum of its tokens' log-probabilities,
+    each given the prompt and the candidate tokens before it.
+    """
+    data = request.get_json(silent=True)
+    if not data or 'prompt' not in data or 'candidates' not in data:
+        return openai_error_response("Request body must contain 'prompt' and 'candidates'")
+
+    prompts = data['prompt']
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p for p in prompts):
+        return openai_error_response("'prompt' must be a non-empty string or a list of non-empty strings", param="prompt")
+    if len(prompts) > SCORE_MAX_PROMPTS:
+        return openai_error_response(f"At most {SCORE_MAX_PROMPTS} prompts are allowed per request", param="prompt")
+
+    candidates = data['candidates']
+    if (not isinstance(candidates, list) or not candidates or len(candidates) > SCORE_MAX_CANDIDATES
+            or not all(isinstance(c, str) and c for c in candidates)):
+        return openai_error_response(f"'candidates' must be a list of 1 to {SCORE_MAX_CANDIDATES} non-empty strings", param="candidates")
+
+    top_n = data.get('top_logprobs', 0)
+    if not isinstance(top_n, int) or isinstance(top_n, bool) or not 0 <= top_n <= 20:
+        return openai_error_response("'top_logprobs' must be an integer between 0 and 20", param="top_logprobs")
+
+    if not token_counter.has_model_tokenizer:
+        return openai_error_response(
+            f"Scoring needs the model's tokenizer at {TOKENIZER_PATH}", error_type="server_error", status_code=501
+        )
+    candidate_ids = []
+    for candidate in candidates:
+        ids = token_counter.encode(candidate)
+        if not ids:
+            return openai_error_response(f"Candidate {candidate!r} has no tokens", param="candidates")
+        if len(ids) > SCORE_MAX_CANDIDATE_TOKENS:
+            return openai_error_response(
+                f"Candidate {candidate!r} has {len(ids)} tokens; at most {SCORE_MAX_CANDIDATE_TOKENS} are allowed",
+                param="candidates"
+            )
+        candidate_ids.append(ids)
+    prompt_ids = [token_counter.encode(prompt) for prompt in prompts]
+    if not all(prompt_ids):
+        return openai_error_response("Every prompt must have at least one token", param="prompt")
+    model = model_registry.resolve(data.get('model', DEFAULT_MODEL_NAME))
+
+    ticket, error = admit_request()
+    if error:
+        return error
+    try:
+        results = []
+        prompt_tokens = 0
+        with model_registry.use(model) as rkllm_model:
+            def logprobs_for(ids):
+                nonlocal prompt_tokens
+                logprobs, prefill_tokens = rkllm_model.get_logprobs(ids)
+                prompt_tokens += prefill_tokens
+                return logprobs
+
+            for i, ids in enumerate(prompt_ids):
+                scores, logprobs, prefills = score_continuations(logprobs_for, ids, candidate_ids)
+                result = {
+                    "index": i,
+                    "scores": [
+                        {"candidate": candidate, "tokens": [token_counter.decode([token_id]) for token_id in token_ids], **scored}
+                        for candidate, token_ids, scored in zip(candidates, candidate_ids, scores)
+                    ],
+                    "best": candidates[max(range(len(scores)), key=lambda j: scores[j]["logprob"])],
+                    "prefills": prefills,
+                }
+                if top_n:
+                    result["top_logprobs"] = [
+                        {"token": token_counter.decode([token_id]), "token_id": token_id, "logprob": logprob}
+                        for token_id, logprob in top_tokens(logprobs, top_n)
+                    ]
+                results.append(result)
+    except Exception as e:
+        print(f"Scoring failed: {e}", file=sys.stderr)
+        response, status = openai_error_response(f"Scoring failed: {e}", error_type="server_error", status_code=500)
+        return with_queue_headers(response, ticket), status
+    finally:
+        ticket.release()
+
+    return with_queue_headers(jsonify({
+        "object": "list",
+        "data": results,
+        "model": model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+    }), ticket)
+
+@app.route('/v1/abort', methods=['POST'])
+def abort():
+    """
+    Abort running generations. With {"id": "<completion id>"} only that
+    request is aborted; without a body every running request is.
+    """
+    data = request.get_json(silent=True) or {}
+    request_id = data.get('id')
+    with active_sessions_lock:
+        if request_id:
+            session = running_requests.get(request_id)
+            if session is None:
+                return openai_error_response(f"No running request with id '{request_id}'", param="id", status_code=404)
+            sessions = [session]
+        else:
+            sessions = list(running_requests.values())
+    for session in sessions:
+        session.cancel()
+    return jsonify({
+        "status": "aborted" if sessions else "idle",
+        "aborted": [session.request_id for session in sessions]
+    }), 200
+
 # Compatibility route for /v1/ endpoint
 @app.route('/luna', methods=['GET'])
 def luna_recognition():
@@ -982,36 +2094,133 @@ def v1_compatibility():
 @app.route('/v1/models', methods=['GET'])
 def models():
     """Return a list of available models mimicking OpenAI's API format"""
+    created = int(time.time())
     return jsonify({
         "object": "list",
         "data": [
             {
-                "id": "luna-large",
+                "id": name,
                 "object": "model",
-                "created": int(time.time()),
+                "created": created,
                 "owned_by": "rkllm",
                 "permission": [],
-                "root": "luna-large",
+                "root": name,
                 "parent": None
             }
+            for name in list(model_registry.models) + [AUTO_MODEL_NAME]
+        ] + [
+            {
+                "id": adapter.model_id,
+                "object": "model",
+                "created": created,
+                "owned_by": "rkllm",
+                "permission": [],
+                "root": adapter.base,
+                "parent": adapter.base
+            }
+            for adapter in adapter_registry.list()
         ]
     })
 
+# LoRA adapter management
+@app.route('/v1/adapters', methods=['GET'])
+def list_adapters():
+    return jsonify({"object": "list", "data": [adapter.to_dict() for adapter in adapter_registry.list()]})
+
+@app.route('/v1/adapters', methods=['POST'])
+def register_adapter():
+    """
+    Register a LoRA adapter: {"name", "path", "base" (default model), "scale"}.
+    Each instance of the base model loads it the first time a request selects it.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return openai_error_response("Missing JSON body")
+    for field in ('name', 'path'):
+        if not data.get(field):
+            return openai_error_response(f"Missing required parameter: {field}", param=field)
+    if adapter_registry.get(data['name']) is not None:
+        return openai_error_response(f"Adapter '{data['name']}' is already registered", param="name", code="adapter_exists", status_code=409)
+    try:
+        adapter = adapter_registry.register(data['name'], data['path'], data.get('base', DEFAULT_MODEL_NAME), data.get('scale', 1.0))
+    except ValueError as e:
+        return openai_error_response(str(e))
+    print(f"Registered LoRA adapter {adapter.model_id} from {adapter.path}")
+    return jsonify(adapter.to_dict()), 201
+
+@app.route('/v1/adapters/<name>', methods=['DELETE'])
+def remove_adapter(name):
+    """Unregister an adapter; handles that loaded it keep it until they are released"""
+    adapter = adapter_registry.remove(name)
+    if adapter is None:
+        return openai_error_response(f"Adapter '{name}' is not registered", param="name", code="adapter_not_found", status_code=404)
+    print(f"Removed LoRA adapter {adapter.model_id}")
+    return jsonify({"id": name, "object": "adapter", "deleted": True}), 200
+
 # Health check endpoint
 @app.route('/health', methods=['GET'])
 def health():
-    with global_state.lock:
-        generation_status = "idle" if global_state.finished else "generating"
-        response_data = {
-            "status": "healthy",
-            "generation_status": generation_status,
-            "tools_loaded": list(TOOL_REGISTRY.keys()),
-            "prefill_speed_tps": f"{global_state.prefill_tps:.2f}",
-            "generation_speed_tps": f"{global_state.generation_tps:.2f}",
-            "memory_usage_mb": f"{global_state.memory_usage_mb:.2f}"
-        }
+    with active_sessions_lock:
+        generation_status = "generating" if active_sessions else "idle"
+    stats = last_session
+    response_data = {
+        "status": "healthy" if startup.ready else startup.state,
+        "startup": startup.stats(),
+        "generation_status": generation_status,
+        "tools_loaded": tool_registry.names(),
+        "tools": tool_registry.stats(),
+        "queue": admission_queue.stats(),
+        "token_counter": token_counter.stats(),
+        "context": context_budgeter.stats(),
+        "prefix_cache": prefix_cache.stats() if prefix_cache is not None else None,
+        "conversations": conversation_store.stats(),
+        "aborts": dict(abort_stats),
+        "models": model_registry.stats(),
+        "adapters": adapter_registry.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "response_cache": response_cache.stats() if response_cache else None,
+        "streaming": stream_stats.stats(),
+        "request_log": request_recorder.stats() if request_recorder else None,
+        "prefill_speed_tps": f"{stats.prefill_tps if stats else 0.0:.2f}",
+        "generation_speed_tps": f"{stats.generation_tps if stats else 0.0:.2f}",
+        "memory_usage_mb": f"{stats.memory_usage_mb if stats else 0.0:.2f}"
+    }
     return jsonify(response_data), 200
 
+@app.route('/livez', methods=['GET'])
+def livez():
+    """The process is up and serving HTTP; true from the start of startup"""
+    return jsonify({"status": "alive"}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Ready for inference traffic once startup, including the warm-up, has finished"""
+    stats = startup.stats()
+    return jsonify({"status": stats["state"], "startup": stats}), 200 if startup.ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of the request metrics and current server state"""
+    lines = request_metrics.render()
+    queue = admission_queue.stats()
+    for name, metric_type, help_text, value in (
+        ("luna_queue_waiting", "gauge", "Requests waiting for a model slot", queue["waiting"]),
+        ("luna_queue_active", "gauge", "Requests holding a model slot", queue["active"]),
+        ("luna_queue_rejected_total", "counter", "Requests rejected because the queue was full", queue["rejected"]),
+        ("luna_queue_timed_out_total", "counter", "Requests that gave up waiting in the queue", queue["timed_out"]),
+        ("luna_aborts_total", "counter", "Generations aborted by clients", abort_stats["aborts"]),
+        ("luna_aborted_tokens_total", "counter", "Tokens decoded after an abort was requested", abort_stats["aborted_tokens"]),
+    ):
+        lines += render_metric(name, metric_type, help_text, [("", None, value)])
+    loaded = model_registry.stats()["loaded"]
+    lines += render_metric("luna_model_memory_mb", "gauge", "Memory used by each loaded model instance", [
+        ("", {"model": instance["model"], "worker": instance["worker"]}, instance["memory_mb"]) for instance in loaded
+    ])
+    lines += render_metric("luna_model_busy", "gauge", "Whether each loaded model instance is generating", [
+        ("", {"model": instance["model"], "worker": instance["worker"]}, int(instance["busy"])) for instance in loaded
+    ])
+    return Response("\n".join(lines) + "\n", content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # App version endpoint
 @app.route('/version', methods=['GET'])
 def get_version():
@@ -1056,24 +2265,43 @@ def wifi_connect():
     except Exception as e:
         return openai_error_response(f"Failed to execute nmcli: {str(e)}", error_type="server_error", status_code=500)
 
-# Global model instance
-rkllm_model = None
+# Pooled embedding vectors by content hash
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE)
+
+# Loaded RKLLM handles by model name
+model_registry = ModelRegistry(
+    MODELS,
+    loader=lambda name, path, worker: RKLLM(path, worker=worker),
+    memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+    default_model=DEFAULT_MODEL_NAME,
+    instances=len(NPU_WORKERS)
+)
+
+# LoRA adapters selectable per request, by base model
+adapter_registry = AdapterRegistry(model_registry.models)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--rkllm_model_path', type=str, default=LARGE_MODEL_PATH, help='Absolute path of the converted RKLLM model on the Linux board (default from config.py)')
+    parser.add_argument('--rkllm_model_path', type=str, help=f'Absolute path of the converted RKLLM model on the Linux board, served as {DEFAULT_MODEL_NAME} (default from config.py)')
     parser.add_argument('--target_platform', type=str, default=TARGET_PLATFORM, help='Target platform: e.g., rk3588/rk3576 (default from config.py)')
     parser.add_argument('--lora_model_path', type=str, help='Absolute path of the lora_model on the Linux board')
     parser.add_argument('--prompt_cache_path', type=str, help='Absolute path of the prompt_cache file on the Linux board')
     parser.add_argument('--tools_dir', type=str, default='tools', help='Directory containing tool Python files')
     parser.add_argument('--port', type=int, default=SERVER_PORT, help='Port to run the server on (default from config.py)')
+    parser.add_argument('--request_log', type=str, default=REQUEST_LOG_PATH, help='JSONL file to record API requests to, for client/replay.py (default from config.py)')
     args = parser.parse_args()
+    if args.rkllm_model_path:
+        model_registry.models[DEFAULT_MODEL_NAME] = args.rkllm_model_path
+    else:
+        args.rkllm_model_path = model_registry.models[DEFAULT_MODEL_NAME]
     
     print(f"Using model path: {args.rkllm_model_path}")
     print(f"Using target platform: {args.target_platform}")
     print(f"Using tools directory: {args.tools_dir}")
+    print(f"Using runtime backend: {RKLLM_BACKEND}")
+    simulated = RKLLM_BACKEND == "simulated"
 
-    if not os.path.exists(args.rkllm_model_path):
+    if not simulated and not os.path.exists(args.rkllm_model_path):
         print("Error: Please provide the correct rkllm model path, and ensure it is the absolute path on the board.")
         sys.stdout.flush()
         exit()
@@ -1094,32 +2322,124 @@ if __name__ == "__main__":
         exit()
 
 
-    # Fix frequency
-    command = "sudo bash fix_freq_{}.sh".format(args.target_platform)
-    subprocess.run(command, shell=True)
-
     # Set resource limit
-    resource.setrlimit(resource.RLIMIT_NOFILE, (102400, 102400))
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (102400, 102400))
+    except (ValueError, OSError) as e:
+        print(f"Could not raise the open file limit: {e}")
+
+    # A static --prompt_cache_path stays loaded for every run, so it replaces the prefix cache
+    if PREFIX_CACHE_ENABLED and not args.prompt_cache_path:
+        prefix_cache = PrefixCacheManager(
+            PREFIX_CACHE_DIR,
+            max_bytes=PREFIX_CACHE_MAX_MB * 1024 * 1024,
+            min_chars=PREFIX_CACHE_MIN_CHARS
+        )
+
+    if RESPONSE_CACHE_ENABLED:
+        response_cache = ResponseCache(
+            max_bytes=RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+            max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+            cache_dir=RESPONSE_CACHE_DIR
+        )
+
+    if args.request_log:
+        request_recorder = RequestRecorder(
+            args.request_log,
+            max_bytes=REQUEST_LOG_MAX_MB * 1024 * 1024,
+            backups=REQUEST_LOG_BACKUPS,
+            include_content=REQUEST_LOG_CONTENT
+        )
+        print(f"Recording requests to {args.request_log}")
+
+    for name, adapter in LORA_ADAPTERS.items():
+        try:
+            adapter_registry.register(name, adapter["path"], adapter.get("base", DEFAULT_MODEL_NAME), adapter.get("scale", 1.0))
+        except (KeyError, ValueError) as e:
+            print(f"Error: Invalid LoRA adapter {name} in LORA_ADAPTERS: {e}")
+            sys.stdout.flush()
+            exit()
+
+    # The LoRA adapter and static prompt cache belong to the default model; others load on first use.
+    # Registered adapters are loaded with their base model so the first request does not pay for it.
+    model_adapters[DEFAULT_MODEL_NAME] = [args.lora_model_path, args.prompt_cache_path]
+    def load_model(name, path, worker):
+        adapters = adapter_registry.for_base(name)
+        if name == DEFAULT_MODEL_NAME:
+            return RKLLM(path, args.lora_model_path, args.prompt_cache_path, worker=worker, adapters=adapters)
+        return RKLLM(path, worker=worker, adapters=adapters)
+    model_registry.loader = load_model
+
+    def fix_frequency():
+        subprocess.run("sudo bash fix_freq_{}.sh".format(args.target_platform), shell=True)
+
+    def load_tools():
+        # Import tool modules once and pick up later edits without a restart
+        tool_registry.tools_dir = args.tools_dir
+        tool_registry.load()
+        if TOOL_RELOAD_INTERVAL:
+            tool_registry.watch(TOOL_RELOAD_INTERVAL)
+
+    def run_startup():
+        """Load everything the first request needs; the HTTP server is already up meanwhile"""
+        try:
+            # Independent of each other, so they overlap; the model init takes the longest
+            phases = [
+                ("tokenizer", token_counter.load),
+                ("tools", load_tools),
+                ("model", lambda: model_registry.preload(DEFAULT_MODEL_NAME, PRELOAD_INSTANCES)),
+            ]
+            if not simulated:
+                phases.insert(0, ("fix_freq", fix_frequency))
+            startup.run_parallel(phases)
+            print("RKLLM Model has been initialized successfully!")
+            if WARMUP_PROMPT:
+                startup.run_phase("warmup", lambda: warm_up(DEFAULT_MODEL_NAME, PRELOAD_INSTANCES))
+            startup.mark_ready()
+        except Exception as e:
+            startup.fail(e)
+            # Stop serving so the service manager restarts the server
+            os.kill(os.getpid(), signal.SIGTERM)
+        sys.stdout.flush()
 
-    # Initialize RKLLM model
     print("=========init....===========")
-    sys.stdout.flush()
-    model_path = args.rkllm_model_path
-    rkllm_model = RKLLM(model_path, args.lora_model_path, args.prompt_cache_path)
-    print("RKLLM Model has been initialized successfully!")
     print("OpenAI-compatible API server with tool support is starting...")
     print(f"API Endpoints:")
     print(f"  POST /v1/chat/completions (with tool support)")
     print(f"  POST /v1/completions") 
-    print(f"  GET /health")
-    print(f"Loaded tools: {list(TOOL_REGISTRY.keys())}")
+    print(f"  POST /v1/embeddings")
+    print(f"  POST /v1/score")
+    print(f"  GET/POST /v1/adapters, DELETE /v1/adapters/<name>")
+    print(f"  GET /health, /livez, /readyz")
+    print(f"Models: {list(model_registry.models)} (+ {AUTO_MODEL_NAME})")
+    if adapter_registry.list():
+        print(f"LoRA adapters: {[adapter.model_id for adapter in adapter_registry.list()]}")
     print("==============================")
     sys.stdout.flush()
+    threading.Thread(target=run_startup, name="startup", daemon=True).start()
+
+    # Serve through the ASGI front end; Flask's threaded server is the fallback without uvicorn
+    try:
+        import uvicorn
+    except ImportError:
+        uvicorn = None
+    if uvicorn is not None:
+        uvicorn.run(
+            ASGIApp(app, max_threads=ASGI_THREADS),
+            host=SERVER_HOST,
+            port=args.port,
+            log_level="debug" if DEBUG_MODE else "info"
+        )
+    else:
+        print("uvicorn is not installed, falling back to Flask's threaded server")
+        app.run(host=SERVER_HOST, port=args.port, threaded=True, debug=DEBUG_MODE)
 
-    # Start the Flask application
-    app.run(host=SERVER_HOST, port=args.port, threaded=True, debug=DEBUG_MODE)
+    if request_recorder is not None:
+        request_recorder.close()
 
     print("====================")
     print("RKLLM model inference completed, releasing RKLLM model resources...")
-    rkllm_model.release()
-    print("====================")
\ No newline at end of file
+    model_registry.release_all()
+    print("====================")
+    if startup.state == "failed":
+        sys.exit(1)
\ No newline at end of file
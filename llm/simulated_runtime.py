@@ -0,0 +1,226 @@
+"""
+Simulated librkllmrt for running the server without an NPU.
+SimulatedRuntime exposes the C functions the server loads from the real
+library (rkllm_init, rkllm_run, rkllm_abort, ...) and drives the server's
+callback the way the runtime does: a NORMAL call per decoded token, then
+FINISH with RKLLMPerfStat filled in, or ERROR when the prompt does not fit
+the context. Prefill and decode take as long as the configured speeds say
+and rkllm_abort stops decoding at the next token, so scheduling, streaming
+and caching changes can be load-tested on any Linux box.
+
+Text is "tokenized" at about four bytes per token, and the reply is a
+deterministic function of the prompt, like greedy sampling on the device.
+"""
+
+import ctypes
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+
+RUN_NORMAL = 0
+RUN_FINISH = 2
+RUN_ERROR = 3
+
+INPUT_PROMPT = 0
+INPUT_TOKEN = 1
+
+INFER_GENERATE = 0
+INFER_GET_LAST_HIDDEN_LAYER = 1
+INFER_GET_LOGITS = 2
+
+_WORDS = (
+    "the", "model", "answer", "is", "running", "on", "a", "simulated", "runtime", "so", "these",
+    "words", "only", "stand", "in", "for", "real", "tokens", "and", "take", "as", "long", "to",
+    "decode", "as", "the", "configured", "speed", "says",
+)
+
+PROMPT_CACHE_BYTES_PER_TOKEN = 256  # Size of the prompt cache files it writes
+
+
+def count_tokens(text):
+    return max(1, math.ceil(len(text.encode('utf-8')) / 4))
+
+
+def _seed(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _arg(value):
+    """The ctypes object behind a byref() argument"""
+    return getattr(value, '_obj', value)
+
+
+def _handle_id(handle):
+    return handle.value if hasattr(handle, 'value') else handle
+
+
+class _Function:
+    """Stands in for a ctypes function pointer, so the server can set argtypes and restype"""
+
+    def __init__(self, func):
+        self.func = func
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        return self.func(*args)
+
+
+class _Instance:
+    def __init__(self, callback, max_context_len, max_new_tokens):
+        self.callback = callback
+        self.max_context_len = max_context_len
+        self.max_new_tokens = max_new_tokens
+        self.aborted = False
+        self.history_tokens = 0
+
+
+class SimulatedRuntime:
+    def __init__(self, prefill_tps=400.0, decode_tps=15.0, reply_tokens=48, memory_mb=1200.0,
+                 embed_size=64, vocab_size=151936, error_rate=0.0):
+        self.prefill_tps = prefill_tps
+        self.decode_tps = decode_tps
+        self.reply_tokens = reply_tokens
+        self.memory_mb = memory_mb
+        self.embed_size = embed_size
+        self.vocab_size = vocab_size
+        self.error_rate = error_rate  # Share of runs that fail with RKLLM_RUN_ERROR, for error handling tests
+        self._instances = {}
+        self._next_handle = 1
+        self._lock = threading.Lock()
+        for name in ("rkllm_init", "rkllm_run", "rkllm_abort", "rkllm_destroy", "rkllm_set_chat_template",
+                     "rkllm_load_lora", "rkllm_load_prompt_cache", "rkllm_release_prompt_cache",
+                     "rkllm_clear_kv_cache"):
+            setattr(self, name, _Function(getattr(self, f"_{name}")))
+
+    def _rkllm_init(self, handle_ref, param_ref, callback):
+        param = _arg(param_ref)
+        with self._lock:
+            handle_id = self._next_handle
+            self._next_handle += 1
+            self._instances[handle_id] = _Instance(callback, param.max_context_len, param.max_new_tokens)
+        _arg(handle_ref).value = handle_id
+        return 0
+
+    def _rkllm_run(self, handle, input_ref, infer_ref, userdata):
+        instance = self._instances.get(_handle_id(handle))
+        if instance is None:
+            return -1
+        instance.aborted = False
+        infer = _arg(infer_ref)
+        rkllm_input = _arg(input_ref)
+        if rkllm_input.input_mode == INPUT_TOKEN:
+            # Token ids stand in for the text; one token each
+            token_input = rkllm_input.input_data.token_input
+            prompt = " ".join(str(token_id) for token_id in token_input.input_ids[:token_input.n_tokens])
+            prompt_tokens = token_input.n_tokens
+        else:
+            prompt = (rkllm_input.input_data.prompt_input or b"").decode('utf-8', 'ignore')
+            prompt_tokens = count_tokens(prompt)
+        userdata = _handle_id(userdata)
+        result_type = instance.callback._argtypes_[0]._type_
+        result = result_type()
+
+        def call(state):
+            instance.callback(ctypes.pointer(result), userdata, state)
+
+        if not infer.keep_history:
+            instance.history_tokens = 0
+        if instance.history_tokens + prompt_tokens > instance.max_context_len or random.random() < self.error_rate:
+            call(RUN_ERROR)
+            return -1
+
+        # Prefill
+        prefill_started = time.time()
+        time.sleep(prompt_tokens / self.prefill_tps)
+        prefill_ms = (time.time() - prefill_started) * 1000.0
+        result.perf.prefill_tokens = prompt_tokens
+        result.perf.prefill_time_ms = prefill_ms
+        result.perf.memory_usage_mb = self.memory_mb
+
+        if infer.prompt_cache_params and infer.prompt_cache_params.contents.save_prompt_cache:
+            path = infer.prompt_cache_params.contents.prompt_cache_path.decode('utf-8')
+            with open(path, 'wb') as f:
+                f.write(bytes(prompt_tokens * PROMPT_CACHE_BYTES_PER_TOKEN))
+
+        if infer.mode == INFER_GET_LAST_HIDDEN_LAYER:
+            # One vector per token, the same for the same text
+            values = []
+            for index in range(prompt_tokens):
+                rng = random.Random(_seed(prompt[index * 4:index * 4 + 4]))
+                values.extend(rng.uniform(-1.0, 1.0) for _ in range(self.embed_size))
+            hidden = (ctypes.c_float * len(values))(*values)
+            result.last_hidden_layer.hidden_states = ctypes.cast(hidden, ctypes.POINTER(ctypes.c_float))
+            result.last_hidden_layer.embd_size = self.embed_size
+            result.last_hidden_layer.num_tokens = prompt_tokens
+            call(RUN_NORMAL)
+            result.last_hidden_layer.hidden_states = None
+            call(RUN_FINISH)
+            return 0
+
+        if infer.mode == INFER_GET_LOGITS:
+            rng = random.Random(_seed(prompt))
+            logits = (ctypes.c_float * self.vocab_size)(*(rng.gauss(0.0, 2.0) for _ in range(self.vocab_size)))
+            result.logits.logits = ctypes.cast(logits, ctypes.POINTER(ctypes.c_float))
+            result.logits.vocab_size = self.vocab_size
+            result.logits.num_tokens = 1
+            call(RUN_NORMAL)
+            result.logits.logits = None
+            call(RUN_FINISH)
+            return 0
+
+        # Decode
+        limit = self.reply_tokens
+        if instance.max_new_tokens > 0:
+            limit = min(limit, instance.max_new_tokens)
+        limit = min(limit, instance.max_context_len - instance.history_tokens - prompt_tokens)
+        rng = random.Random(_seed(prompt))
+        decode_started = time.time()
+        generated = 0
+        while generated < limit and not instance.aborted:
+            time.sleep(1.0 / self.decode_tps)
+            word = rng.choice(_WORDS)
+            result.text = (word.capitalize() if generated == 0 else " " + word).encode('utf-8')
+            generated += 1
+            call(RUN_NORMAL)
+        result.text = None
+        result.perf.generate_tokens = generated
+        result.perf.generate_time_ms = (time.time() - decode_started) * 1000.0
+        if infer.keep_history:
+            instance.history_tokens += prompt_tokens + generated
+        call(RUN_FINISH)
+        return 0
+
+    def _rkllm_abort(self, handle):
+        instance = self._instances.get(_handle_id(handle))
+        if instance is not None:
+            instance.aborted = True
+        return 0
+
+    def _rkllm_destroy(self, handle):
+        self._instances.pop(_handle_id(handle), None)
+        return 0
+
+    def _rkllm_clear_kv_cache(self, handle, keep_system_prompt, start_pos, end_pos):
+        instance = self._instances.get(_handle_id(handle))
+        if instance is not None:
+            instance.history_tokens = 0
+        return 0
+
+    def _rkllm_set_chat_template(self, handle, system_prompt, prompt_prefix, prompt_postfix):
+        return 0
+
+    def _rkllm_load_lora(self, handle, lora_adapter_ref):
+        return 0
+
+    def _rkllm_load_prompt_cache(self, handle, prompt_cache_path):
+        path = getattr(prompt_cache_path, 'value', prompt_cache_path)
+        if isinstance(path, bytes):
+            path = path.decode('utf-8')
+        return 0 if os.path.exists(path) else -1  # The runtime fails on a missing or unreadable file
+
+    def _rkllm_release_prompt_cache(self, handle):
+        return 0
@@ -0,0 +1,96 @@
+"""
+Server-sent event framing for chat streams.
+Content frames are built from a per-stream template: the id, model and
+timestamp are encoded once and each frame only encodes its text (with
+orjson when installed). Streams send coalesced frames, several tokens per
+frame, and StreamStats keeps the counters that show what that saves.
+"""
+
+import json
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value):
+    """JSON as UTF-8 bytes"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode('utf-8')
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # Stop reverse proxies from buffering frames
+}
+
+
+class StreamStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.streams = 0
+        self.frames = 0
+        self.tokens = 0
+        self.bytes = 0
+        self.seconds = 0.0  # Total time from the first to the last frame of finished streams
+        self.stream_frames = 0  # Frames of finished streams, for frames_per_second
+
+    def record_frame(self, tokens, size):
+        with self._lock:
+            self.frames += 1
+            self.tokens += tokens
+            self.bytes += size
+
+    def record_stream(self, frames, seconds):
+        with self._lock:
+            self.streams += 1
+            self.stream_frames += frames
+            self.seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                "streams": self.streams,
+                "frames": self.frames,
+                "tokens": self.tokens,
+                "bytes": self.bytes,
+                "tokens_per_frame": round(self.tokens / self.frames, 2) if self.frames else 0.0,
+                "bytes_per_token": round(self.bytes / self.tokens, 1) if self.tokens else 0.0,
+                "frames_per_second": round(self.stream_frames / self.seconds, 2) if self.seconds else 0.0,
+            }
+
+
+class ChunkEncoder:
+    """Encodes the chat.completion.chunk content frames of one stream"""
+
+    def __init__(self, completion_id, created_timestamp, model, stats=None):
+        head = dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created_timestamp,
+            "model": model,
+        })
+        self._head = b"data: " + head[:-1] + b',"choices":[{"index":0,"delta":{"content":'
+        self._tail = b'},"finish_reason":null}]}\n\n'
+        self.stats = stats
+        self.frames = 0
+        self._first_frame = None
+
+    def content(self, chunks):
+        """One frame carrying the text of `chunks` (one per decoded token)"""
+        frame = self._head + dumps("".join(chunks)) + self._tail
+        self.frames += 1
+        if self._first_frame is None:
+            self._first_frame = time.time()
+        if self.stats is not None:
+            self.stats.record_frame(len(chunks), len(frame))
+        return frame
+
+    def done(self):
+        """Record the finished stream's frame rate"""
+        if self.stats is not None and self._first_frame is not None:
+            self.stats.record_stream(self.frames, time.time() - self._first_frame)
@@ -0,0 +1,100 @@
+"""
+Startup pipeline for the RKLLM server.
+The server starts listening as soon as the process is up, so /livez answers
+while the model loads; /readyz and the inference endpoints return 503 until
+every phase has finished. Independent phases (frequency fixing, tokenizer
+and tool loading, model init) run on parallel threads. Each phase is timed
+and reported by /readyz and /health.
+
+Under systemd with Type=notify, readiness and the current phase are also
+sent to the service manager (sd_notify), so `systemctl start` returns once
+the server can take traffic.
+"""
+
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+
+def sd_notify(message):
+    """Send `message` to systemd's notify socket; does nothing outside a Type=notify service"""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]  # Abstract namespace socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(message.encode("utf-8"))
+    except OSError as e:
+        print(f"Could not notify systemd: {e}")
+
+
+class StartupPipeline:
+    def __init__(self):
+        self.started_at = time.time()
+        self.state = STARTING
+        self.error = None
+        self.total_ms = None
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    def run_phase(self, name, func):
+        """Run one phase and record how long it took; exceptions are recorded and re-raised"""
+        with self._lock:
+            self.phases[name] = {"state": "running", "ms": None}
+        print(f"Startup: {name}...")
+        sd_notify(f"STATUS=Starting: {name}")
+        started = time.time()
+        try:
+            result = func()
+        except Exception as e:
+            with self._lock:
+                self.phases[name] = {"state": FAILED, "ms": round((time.time() - started) * 1000.0, 1), "error": str(e)}
+            raise
+        elapsed_ms = round((time.time() - started) * 1000.0, 1)
+        with self._lock:
+            self.phases[name] = {"state": "done", "ms": elapsed_ms}
+        print(f"Startup: {name} done in {elapsed_ms:.0f} ms")
+        return result
+
+    def run_parallel(self, steps):
+        """Run (name, func) phases on their own threads and wait for all; re-raises the first failure"""
+        with ThreadPoolExecutor(max_workers=max(len(steps), 1), thread_name_prefix="startup") as pool:
+            futures = [pool.submit(self.run_phase, name, func) for name, func in steps]
+        for future in futures:
+            future.result()
+
+    def mark_ready(self):
+        with self._lock:
+            self.state = READY
+            self.total_ms = round((time.time() - self.started_at) * 1000.0, 1)
+        print(f"Startup: ready in {self.total_ms:.0f} ms")
+        sd_notify("READY=1\nSTATUS=Ready")
+
+    def fail(self, error):
+        with self._lock:
+            self.state = FAILED
+            self.error = str(error)
+        print(f"Startup failed: {error}")
+        sd_notify(f"STATUS=Startup failed: {error}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "elapsed_ms": self.total_ms if self.total_ms is not None else round((time.time() - self.started_at) * 1000.0, 1),
+                "phases": {name: dict(phase) for name, phase in self.phases.items()},
+                "error": self.error,
+            }
@@ -0,0 +1,85 @@
+"""
+Incremental matching of OpenAI `stop` strings on streamed text.
+All stop strings are matched at once with an Aho-Corasick automaton, one
+character at a time as tokens arrive. Text that could still turn into a stop
+string is held back, so a stop string is never sent to the client.
+"""
+
+from collections import deque
+
+
+class StopSequenceMatcher:
+    def __init__(self, stop_sequences):
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]  # Length of the text each state represents
+        self._match = [0]  # Length of the longest stop string ending at each state
+        for sequence in stop_sequences:
+            self._add(sequence)
+        self._build()
+        self._state = 0
+        self._pending = ""
+        self.matched = None
+
+    def _add(self, sequence):
+        state = 0
+        for ch in sequence:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[state] + 1)
+                self._match.append(0)
+                self._goto[state][ch] = next_state
+            state = next_state
+        self._match[state] = max(self._match[state], len(sequence))
+
+    def _build(self):
+        # States one character deep fail back to the root
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._match[next_state] = max(self._match[next_state], self._match[self._fail[next_state]])
+                queue.append(next_state)
+
+    def feed(self, text):
+        """
+        Consume streamed text. Returns (safe_text, matched): the text that can
+        be sent now, and whether a stop string was completed. After a match the
+        text from the stop string onwards is dropped.
+        """
+        if self.matched is not None:
+            return "", True
+        released = []
+        for ch in text:
+            state = self._state
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            self._state = state
+            self._pending += ch
+
+            if self._match[state]:
+                cut = len(self._pending) - self._match[state]
+                self.matched = self._pending[cut:]
+                released.append(self._pending[:cut])
+                self._pending = ""
+                return "".join(released), True
+
+            # Characters older than the current partial match can no longer start a stop string
+            release = len(self._pending) - self._depth[state]
+            if release > 0:
+                released.append(self._pending[:release])
+                self._pending = self._pending[release:]
+        return "".join(released), False
+
+    def flush(self):
+        """Release held-back text once generation has ended without a match"""
+        text, self._pending = self._pending, ""
+        return text
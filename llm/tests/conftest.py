@@ -0,0 +1,14 @@
+"""
+Tests run from llm/ (`python -m pytest -q tests`). The server modules import
+each other as top-level modules, and server.py is imported with the
+simulated runtime so no NPU or librkllmrt.so is needed.
+"""
+
+import os
+import sys
+
+LLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if LLM_DIR not in sys.path:
+    sys.path.insert(0, LLM_DIR)
+os.chdir(LLM_DIR)  # config.py paths are relative to llm/
+os.environ["RKLLM_BACKEND"] = "simulated"
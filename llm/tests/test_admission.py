@@ -0,0 +1,155 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionQueue, QueueFull, QueueTimeout
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+class Waiters:
+    """Threads queued one at a time behind a held slot, recording the order they are admitted in"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.order = []
+        self.threads = []
+        self.errors = []
+
+    def add(self, label, key, group=None):
+        def run():
+            try:
+                ticket = self.queue.acquire(key, group=group)
+            except Exception as e:
+                self.errors.append(e)
+                return
+            self.order.append(label)
+            ticket.release()
+
+        waiting = self.queue.stats()["waiting"]
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        # Enqueue in a known order
+        wait_until(lambda: self.queue.stats()["waiting"] == waiting + 1)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(5)
+        assert not self.errors
+
+
+def test_fifo_per_key():
+    queue = AdmissionQueue(slots=1)
+    holder = queue.acquire("a")
+    waiters = Waiters(queue)
+    for label in ("a1", "a2", "a3"):
+        waiters.add(label, "a")
+    holder.release()
+    waiters.join()
+    assert waiters.order == ["a1", "a2", "a3"]
+
+
+def test_round_robin_across_keys():
+    queue = AdmissionQueue(slots=1)
+    holder = queue.acquire("a")
+    waiters = Waiters(queue)
+    for label, key in [("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b"), ("c1", "c"), ("b2", "b")]:
+        waiters.add(label, key)
+    holder.release()
+    waiters.join()
+    assert waiters.order == ["a1", "b1", "c1", "a2", "b2", "a3"]
+
+
+def test_queue_position_follows_round_robin():
+    queue = AdmissionQueue(slots=1)
+    holder = queue.acquire("a")
+    waiters = Waiters(queue)
+    waiters.add("a1", "a")
+    waiters.add("a2", "a")
+    assert queue._position_for("b") == 2
+    assert queue._position_for("a") == 3
+    holder.release()
+    waiters.join()
+
+
+def test_queue_full_raises_with_retry_after():
+    queue = AdmissionQueue(slots=1, max_depth=1, default_service_time=2.0)
+    holder = queue.acquire("a")
+    waiters = Waiters(queue)
+    waiters.add("a1", "a")
+    with pytest.raises(QueueFull) as raised:
+        queue.acquire("b")
+    assert raised.value.retry_after > 0
+    assert queue.stats()["rejected"] == 1
+    holder.release()
+    waiters.join()
+
+
+def test_queue_timeout_leaves_the_queue():
+    queue = AdmissionQueue(slots=1, wait_timeout=0.05)
+    holder = queue.acquire("a")
+    with pytest.raises(QueueTimeout) as raised:
+        queue.acquire("b")
+    assert raised.value.waited >= 0.05
+    stats = queue.stats()
+    assert (stats["waiting"], stats["waiting_keys"], stats["timed_out"]) == (0, 0, 1)
+    holder.release()
+    # The timed-out request did not keep a place: the next one is admitted at once
+    assert queue.acquire("b", timeout=0).position == 0
+
+
+def test_double_release_frees_one_slot():
+    queue = AdmissionQueue(slots=1)
+    ticket = queue.acquire("a")
+    ticket.release()
+    ticket.release()
+    assert queue.stats()["active"] == 0
+
+    # A second release must not hand out a slot that is in use
+    held = queue.acquire("a")
+    ticket.release()
+    with pytest.raises(QueueTimeout):
+        queue.acquire("b", timeout=0.05)
+    held.release()
+    assert queue.stats()["active"] == 0
+
+
+def test_ticket_context_manager_releases():
+    queue = AdmissionQueue(slots=1)
+    with queue.acquire("a") as ticket:
+        assert queue.stats()["active"] == 1
+        assert ticket.headers()["X-Queue-Position"] == "0"
+    assert queue.stats()["active"] == 0
+
+
+def test_affinity_streak_is_limited():
+    queue = AdmissionQueue(slots=1, affinity_limit=2)
+    holder = queue.acquire("a", group="pirate")
+    waiters = Waiters(queue)
+    waiters.add("b1", "b", "base")
+    for label in ("p1", "p2", "p3"):
+        waiters.add(label, label, "pirate")
+    holder.release()
+    waiters.join()
+    # Two pirate requests skip ahead of b1, then round-robin order resumes
+    assert waiters.order == ["p1", "p2", "b1", "p3"]
+    assert queue.stats()["affinity_picks"] == 2
+
+
+def test_affinity_disabled_keeps_round_robin():
+    queue = AdmissionQueue(slots=1, affinity_limit=0)
+    holder = queue.acquire("a", group="pirate")
+    waiters = Waiters(queue)
+    waiters.add("b1", "b", "base")
+    waiters.add("p1", "p", "pirate")
+    holder.release()
+    waiters.join()
+    assert waiters.order == ["b1", "p1"]
+    assert queue.stats()["affinity_picks"] == 0
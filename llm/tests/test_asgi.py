@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+from asgi import SessionStream
+
+
+class FailingSession:
+    """A generation that produces one batch and then fails"""
+
+    is_generating = False
+
+    def batches(self, window, max_bytes):
+        yield ["Hello"]
+        raise RuntimeError('runtime said "no"')
+
+    async def abatches(self, window, max_bytes):
+        yield ["Hello"]
+        raise RuntimeError('runtime said "no"')
+
+
+def failing_stream():
+    return SessionStream(FailingSession, lambda chunks: "".join(chunks), lambda session: [])
+
+
+def check_error_events(events):
+    assert events[0] == "Hello"
+    assert events[-1] == "data: [DONE]\n\n"
+    error = json.loads(events[1][len("data: "):])
+    assert error == {"error": {"message": 'Stream error: runtime said "no"', "type": "server_error", "param": None, "code": None}}
+
+
+def test_stream_error_is_a_json_event():
+    check_error_events(list(failing_stream()))
+
+
+def test_async_stream_error_is_a_json_event():
+    async def collect():
+        return [event async for event in failing_stream()]
+    check_error_events(asyncio.run(collect()))
@@ -0,0 +1,72 @@
+import pytest
+
+from context_budget import ContextBudgeter
+
+
+class WordCounter:
+    """One token per whitespace-separated word"""
+
+    def count(self, text):
+        return len(text.split())
+
+    def count_batch(self, texts):
+        return [self.count(text) for text in texts]
+
+
+def budgeter(max_context=100, reserve_tokens=10):
+    return ContextBudgeter(WordCounter(), max_context, reserve_tokens=reserve_tokens)
+
+
+def words(n, word="w"):
+    return " ".join(f"{word}{i}" for i in range(n))
+
+
+def test_prompt_budget_leaves_room_for_the_answer():
+    assert budgeter().prompt_budget() == 90
+    assert budgeter().prompt_budget(20) == 70
+    # The answer never takes more than half the context
+    assert budgeter().prompt_budget(500) == 40
+
+
+def test_fits_after_counts_history():
+    assert budgeter().fits_after(60, words(10), max_tokens=20)
+    assert not budgeter().fits_after(65, words(10), max_tokens=20)
+
+
+def test_everything_fits_unchanged():
+    parts = ["User: " + words(5), "Assistant: " + words(5)]
+    assert budgeter().fit("system", parts) == parts
+    assert budgeter().stats()["trimmed_prompts"] == 0
+
+
+def test_oldest_parts_are_dropped_behind_a_note():
+    context = budgeter()
+    parts = [f"User: {words(20, f'm{n}_')}" for n in range(6)]
+    kept = context.fit("system prompt", parts, max_tokens=20)
+    assert kept[0].startswith("[") and "earlier messages omitted" in kept[0]
+    assert kept[-1] == parts[-1]
+    assert kept[1:] == parts[-len(kept) + 1:]
+    assert sum(len(part.split()) + 1 for part in kept) <= context.prompt_budget(20) - 2
+    stats = context.stats()
+    assert stats["trimmed_prompts"] == 1
+    assert stats["dropped_messages"] == len(parts) - len(kept) + 1
+
+
+def test_oversized_last_part_keeps_its_label_and_end():
+    context = budgeter()
+    kept = context.fit("", ["User: " + words(200)])
+    assert len(kept) == 1
+    assert kept[0].startswith("User: ")
+    assert kept[0].endswith("w199")
+    assert len(kept[0].split()) <= context.prompt_budget()
+    assert context.stats()["truncated_messages"] == 1
+
+
+@pytest.mark.parametrize("budget", [1, 5, 50])
+def test_truncate_text_keeps_the_end(budget):
+    text = words(30)
+    truncated = budgeter().truncate_text(text, budget)
+    assert len(truncated.split()) <= budget
+    assert text.endswith(truncated)
+    # Cut at a word boundary
+    assert truncated.startswith("w")
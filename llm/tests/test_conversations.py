@@ -0,0 +1,91 @@
+import time
+
+from context_budget import ContextBudgeter
+from conversations import ConversationStore
+from token_counter import TokenCounter
+
+USER = {"role": "user", "content": "Hello"}
+SECOND = {"role": "user", "content": "And then?"}
+
+
+def test_new_messages_after_history():
+    store = ConversationStore()
+    conversation = store.get_or_create("a")
+    conversation.commit([USER], "Hi there", 12)
+    assert conversation.new_messages([USER, {"role": "assistant", "content": "Hi there "}, SECOND]) == [SECOND]
+    # An edited earlier message means the history no longer matches
+    assert conversation.new_messages([{"role": "user", "content": "Hey"}, {"role": "assistant", "content": "Hi there"}, SECOND]) is None
+    assert conversation.new_messages([USER]) is None
+
+
+def test_resolve_messages_appends_for_previous_response_id():
+    store = ConversationStore()
+    conversation = store.get_or_create("a")
+    conversation.commit([USER], "Hi there", 12)
+    assert conversation.resolve_messages([SECOND], append_only=True) == [USER, {"role": "assistant", "content": "Hi there"}, SECOND]
+    full = [USER, {"role": "assistant", "content": "Hi there"}, SECOND]
+    assert conversation.resolve_messages(full, append_only=True) == full
+
+
+def test_response_ids_expire_with_their_conversation():
+    store = ConversationStore(ttl=0.05, max_conversations=2)
+    conversation = store.get_or_create("a")
+    store.add_response_id(conversation, "chatcmpl-1")
+    assert store.by_response_id("chatcmpl-1") is conversation
+    time.sleep(0.06)
+    assert store.by_response_id("chatcmpl-1") is None
+    assert store.stats()["expired"] == 1
+
+
+def test_store_is_capped_least_recently_used_first():
+    store = ConversationStore(max_conversations=2)
+    store.add_response_id(store.get_or_create("a"), "r-a")
+    store.add_response_id(store.get_or_create("b"), "r-b")
+    store.by_response_id("r-a")  # Touches "a", so "b" is the oldest
+    store.get_or_create("c")
+    assert store.stats()["active"] == 2
+    assert store.by_response_id("r-b") is None
+    assert store.by_response_id("r-a") is not None
+
+
+def test_new_turn_must_fit_on_top_of_history():
+    counter = TokenCounter()
+    counter.load()
+    budgeter = ContextBudgeter(counter, max_context=100, reserve_tokens=10)
+    turn = "User: " + "word " * 10
+    assert budgeter.fits_after(40, turn, max_tokens=20)
+    assert not budgeter.fits_after(70, turn, max_tokens=20)
+    assert not budgeter.fits_after(40, turn, max_tokens=50)
+
+
+def test_stateless_responses_do_not_evict_sessions():
+    store = ConversationStore(max_conversations=2, max_responses=2)
+    session = store.get_or_create("session")
+    store.add_response_id(session, "r-session")
+    for n in range(5):
+        store.add_response(f"r-{n}", [{"role": "user", "content": f"q{n}"}], f"a{n}")
+    assert store.by_response_id("r-session") is session
+    stats = store.stats()
+    assert (stats["active"], stats["responses"]) == (1, 2)
+    # Only the newest stateless responses are kept
+    assert store.by_response_id("r-2") is None
+
+
+def test_continuing_a_stateless_response_starts_a_conversation():
+    store = ConversationStore()
+    question = {"role": "user", "content": "hi"}
+    store.add_response("r-1", [question], "hello")
+    conversation = store.by_response_id("r-1")
+    assert conversation.history_tokens == 0
+    follow_up = {"role": "user", "content": "more"}
+    assert conversation.resolve_messages([follow_up], append_only=True) == [
+        question, {"role": "assistant", "content": "hello"}, follow_up]
+    assert store.by_response_id("r-1") is conversation
+    assert store.stats()["responses"] == 0
+
+
+def test_stateless_responses_expire():
+    store = ConversationStore(ttl=0.05)
+    store.add_response("r-1", [{"role": "user", "content": "hi"}], "hello")
+    time.sleep(0.1)
+    assert store.by_response_id("r-1") is None
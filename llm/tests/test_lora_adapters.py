@@ -0,0 +1,63 @@
+import pytest
+
+from lora_adapters import AdapterRegistry
+
+MODELS = {"luna-small": "small.rkllm", "luna-large": "large.rkllm"}
+
+
+@pytest.fixture
+def registry(tmp_path):
+    path = tmp_path / "pirate.rkllm"
+    path.write_bytes(b"")
+    registry = AdapterRegistry(dict(MODELS))
+    registry.register("pirate", str(path), "luna-large")
+    return registry
+
+
+def test_resolve_by_model_id_and_name(registry):
+    model, adapter = registry.resolve("luna-large:pirate")
+    assert (model, adapter.name) == ("luna-large", "pirate")
+    model, adapter = registry.resolve("pirate")
+    assert (model, adapter.name) == ("luna-large", "pirate")
+    model, adapter = registry.resolve("luna-large", "pirate")
+    assert (model, adapter.name) == ("luna-large", "pirate")
+    assert registry.get("pirate").requests == 3
+
+
+def test_colon_names_without_registered_adapter_pass_through(registry):
+    assert registry.resolve("qwen3:0.6b") == ("qwen3:0.6b", None)
+    assert registry.resolve("luna-large:ghost") == ("luna-large:ghost", None)
+    assert registry.resolve("luna-small") == ("luna-small", None)
+
+
+def test_unknown_adapter_field_and_wrong_base(registry):
+    with pytest.raises(KeyError):
+        registry.resolve("luna-large", "ghost")
+    with pytest.raises(ValueError):
+        registry.resolve("luna-small:pirate")
+    with pytest.raises(ValueError):
+        registry.resolve("luna-small", "pirate")
+
+
+def test_register_validation(registry, tmp_path):
+    path = str(tmp_path / "pirate.rkllm")
+    for name, base, adapter_path, scale in [
+        ("pirate", "luna-large", path, 1.0),      # Duplicate
+        ("default", "luna-large", path, 1.0),     # Reserved
+        ("luna-small", "luna-large", path, 1.0),  # A model name
+        ("bad name", "luna-large", path, 1.0),
+        ("other", "luna-huge", path, 1.0),
+        ("other", "luna-large", str(tmp_path / "missing.rkllm"), 1.0),
+        ("other", "luna-large", path, 0),
+        ("other", "luna-large", path, True),
+    ]:
+        with pytest.raises(ValueError):
+            registry.register(name, adapter_path, base, scale)
+
+
+def test_remove_and_for_base(registry):
+    assert [adapter.name for adapter in registry.for_base("luna-large")] == ["pirate"]
+    assert registry.for_base("luna-small") == []
+    assert registry.remove("pirate").name == "pirate"
+    assert registry.remove("pirate") is None
+    assert registry.resolve("luna-large:pirate") == ("luna-large:pirate", None)
@@ -0,0 +1,61 @@
+import math
+
+from metrics import Histogram, RequestMetrics, RingBuffer, Summary, quantile
+
+
+def test_ring_buffer_keeps_the_latest_samples():
+    ring = RingBuffer(3)
+    for value in range(5):
+        ring.add(float(value))
+    assert ring.sorted() == [2.0, 3.0, 4.0]
+    assert ring.count == 5
+
+
+def test_quantile_nearest_rank():
+    samples = [float(value) for value in range(1, 11)]
+    assert quantile(samples, 0.5) == 5.0
+    assert quantile(samples, 0.9) == 9.0
+    assert quantile(samples, 0.99) == 10.0
+    assert math.isnan(quantile([], 0.5))
+
+
+def test_summary_renders_window_quantiles_and_all_time_sum():
+    summary = Summary("luna_test_seconds", "Test", window=2)
+    for value in (10.0, 1.0, 2.0):
+        summary.observe(value)
+    lines = summary.render()
+    assert lines[:2] == ["# HELP luna_test_seconds Test", "# TYPE luna_test_seconds summary"]
+    assert 'luna_test_seconds{quantile="0.5"} 1.0' in lines
+    assert 'luna_test_seconds{quantile="0.99"} 2.0' in lines
+    assert "luna_test_seconds_sum 13.0" in lines
+    assert "luna_test_seconds_count 3" in lines
+
+
+def test_empty_summary_renders_nan():
+    assert 'luna_test_seconds{quantile="0.5"} NaN' in Summary("luna_test_seconds", "Test").render()
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("luna_test_seconds", "Test", (0.1, 0.5))
+    for value in (0.05, 0.1, 0.3, 2.0):
+        histogram.observe(value)
+    lines = histogram.render()
+    assert 'luna_test_seconds_bucket{le="0.1"} 2' in lines
+    assert 'luna_test_seconds_bucket{le="0.5"} 3' in lines
+    assert 'luna_test_seconds_bucket{le="+Inf"} 4' in lines
+    assert "luna_test_seconds_count 4" in lines
+
+
+def test_request_metrics_counters_and_skipped_zero_rates():
+    metrics = RequestMetrics(window=8)
+    metrics.record_generation(0.2, 400.0, 0.0, prompt_tokens=30, generated_tokens=0)
+    metrics.record_generation(0.4, 380.0, 14.0, prompt_tokens=20, generated_tokens=12, memory_mb=1200.0)
+    metrics.record_error()
+    lines = metrics.render()
+    assert "luna_generations_total 2" in lines
+    assert "luna_generation_errors_total 1" in lines
+    assert "luna_prompt_tokens_total 50" in lines
+    assert "luna_generated_tokens_total 12" in lines
+    # A generation without decoded tokens has no decode speed
+    assert "luna_decode_tokens_per_second_count 1" in lines
+    assert "luna_memory_usage_mb_count 1" in lines
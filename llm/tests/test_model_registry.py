@@ -0,0 +1,48 @@
+import threading
+
+from model_registry import ModelRegistry
+
+
+class FakeModel:
+    def __init__(self, name, path, worker):
+        self.name = name
+        self.worker = worker
+
+    def release(self):
+        pass
+
+
+def registry(instances=3):
+    return ModelRegistry({"small": "small.rkllm", "large": "large.rkllm"}, FakeModel, memory_budget_mb=10000,
+                         default_model="small", instances=instances)
+
+
+def test_new_model_goes_to_an_unoccupied_domain():
+    models = registry()
+    small = models.checkout("small")
+    assert small.worker == 0
+    # Domain 0 is busy with "small"; "large" must not be pinned there
+    large = models.checkout("large")
+    assert large.worker == 1
+
+
+def test_idle_domain_holding_another_model_is_picked_last():
+    models = registry()
+    models.checkin(models.checkout("small"))  # "small" idle on domain 0
+    busy = models.checkout("large")  # Domain 1: domain 0 holds "small"
+    assert busy.worker == 1
+    second = models.checkout("large")
+    assert second.worker == 2
+
+
+def test_checkout_waits_when_every_slot_is_taken():
+    models = registry(instances=1)
+    first = models.checkout("small")
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(models.checkout("small")))
+    waiter.start()
+    waiter.join(0.1)
+    assert not got
+    models.checkin(first)
+    waiter.join(5)
+    assert got[0] is first
@@ -0,0 +1,156 @@
+import os
+
+from prompt_cache import PrefixCacheManager
+
+
+def save(manager, model_id, prefix, size, prefill_ms=100.0, prefill_tokens=50):
+    """Write the cache file the runtime would write and register it, as a finished run leaves it"""
+    with open(manager.path_for(model_id, prefix), 'wb') as f:
+        f.write(b"\0" * size)
+    entry = manager.record_save(model_id, prefix, prefill_ms, prefill_tokens)
+    manager.release(entry)
+    return entry
+
+
+def test_miss_then_hit_counts_saved_prefill(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=1 << 20)
+    assert manager.lookup("luna-small", "system") is None
+    save(manager, "luna-small", "system", 100)
+    entry = manager.lookup("luna-small", "system")
+    manager.record_hit(entry)
+    stats = manager.stats()
+    assert (stats["misses"], stats["hits"], stats["saves"]) == (1, 1, 1)
+    assert (stats["prefill_ms_saved"], stats["prefill_tokens_saved"]) == (100.0, 50)
+
+
+def test_prefixes_are_per_model(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=1 << 20)
+    save(manager, "luna-small", "system", 100)
+    assert manager.lookup("luna-large", "system") is None
+    assert manager.path_for("luna-small", "system") != manager.path_for("luna-large", "system")
+
+
+def test_record_save_without_a_file_is_ignored(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=1 << 20)
+    assert manager.record_save("luna-small", "system", 100.0, 50) is None
+    assert manager.stats()["entries"] == 0
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=250)
+    save(manager, "luna-small", "a", 100)
+    save(manager, "luna-small", "b", 100)
+    manager.lookup("luna-small", "a")
+    save(manager, "luna-small", "c", 100)
+    assert manager.lookup("luna-small", "b") is None
+    assert not (tmp_path / f"{manager.digest('luna-small', 'b')}.bin").exists()
+    assert manager.lookup("luna-small", "a") is not None
+    assert manager.stats()["evictions"] == 1
+
+
+def test_index_survives_a_restart_and_drops_missing_files(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=1 << 20)
+    save(manager, "luna-small", "a", 100)
+    save(manager, "luna-small", "b", 100)
+    (tmp_path / f"{manager.digest('luna-small', 'b')}.bin").unlink()
+    reloaded = PrefixCacheManager(str(tmp_path), max_bytes=1 << 20)
+    assert reloaded.stats()["entries"] == 1
+    assert reloaded.lookup("luna-small", "a").prefill_tokens == 50
+
+
+def test_eligible_needs_min_chars(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=1 << 20, min_chars=10)
+    assert not manager.eligible("")
+    assert not manager.eligible("short")
+    assert manager.eligible("long enough prefix")
+
+
+def test_entries_in_use_are_not_evicted(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=250)
+    save(manager, "luna-small", "a", 100)
+    save(manager, "luna-small", "b", 100)
+    held = manager.lookup("luna-small", "a")
+    manager.release(manager.lookup("luna-small", "b"))  # Now "a" is the least recently used
+    save(manager, "luna-small", "c", 100)
+    # "a" is held by a run, so "b" goes instead
+    assert os.path.exists(held.path)
+    assert manager.stats()["evictions"] == 1
+    assert manager.lookup("luna-small", "b") is None
+    manager.release(held)
+
+
+def test_release_evicts_what_was_held_over_the_limit(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=150)
+    save(manager, "luna-small", "a", 100)
+    held = manager.lookup("luna-small", "a")
+    with open(manager.path_for("luna-small", "b"), 'wb') as f:
+        f.write(b"\0" * 100)
+    saved = manager.record_save("luna-small", "b", 100.0, 50)  # A run is about to load it
+    assert manager.stats()["entries"] == 2
+    manager.release(held)
+    assert not os.path.exists(held.path)
+    assert os.path.exists(saved.path)
+    manager.release(saved)
+    assert manager.stats()["entries"] == 1
+
+
+def test_load_failure_forgets_the_entry(tmp_path):
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=1 << 20)
+    save(manager, "luna-small", "a", 100)
+    entry = manager.lookup("luna-small", "a")
+    manager.record_load_failure(entry)
+    manager.release(entry)
+    assert manager.lookup("luna-small", "a") is None
+    assert manager.stats()["load_failures"] == 1
+    assert PrefixCacheManager(str(tmp_path), max_bytes=1 << 20).stats()["entries"] == 0
+
+
+class PrefixModel:
+    """What RKLLM.run needs of a loaded model, recording the prompts it prefills"""
+
+    handle = None
+    rkllm_infer_params = None
+
+    def __init__(self, load_result):
+        self.load_result = load_result
+        self.prefilled = []
+        self.released = 0
+
+    def cache_model_id(self, adapter):
+        return "luna-small"
+
+    def rkllm_load_prompt_cache(self, handle, path):
+        return self.load_result
+
+    def rkllm_release_prompt_cache(self, handle):
+        self.released += 1
+
+    def _run_prompt(self, prompt, session, infer_params):
+        self.prefilled.append(prompt)
+
+
+def run_with_cached_prefix(monkeypatch, tmp_path, load_result):
+    import server
+    manager = PrefixCacheManager(str(tmp_path), max_bytes=1 << 20)
+    save(manager, "luna-small", "SYSTEM", 100)
+    monkeypatch.setattr(server, "prefix_cache", manager)
+    model = PrefixModel(load_result)
+    session = server.GenerationSession("SYSTEM user turn")
+    server.RKLLM.run(model, "SYSTEM user turn", session, prefix="SYSTEM")
+    return manager, model, session
+
+
+def test_run_prefills_only_the_rest_after_loading_the_prefix(monkeypatch, tmp_path):
+    manager, model, session = run_with_cached_prefix(monkeypatch, tmp_path, 0)
+    assert model.prefilled == [" user turn"]
+    assert (session.prefix_cache, model.released) == ("hit", 1)
+    assert manager.stats()["hits"] == 1
+    assert manager.lookup("luna-small", "SYSTEM").in_use == 1  # Only this lookup holds it
+
+
+def test_run_prefills_the_full_prompt_when_the_load_fails(monkeypatch, tmp_path):
+    manager, model, session = run_with_cached_prefix(monkeypatch, tmp_path, -1)
+    assert model.prefilled == ["SYSTEM user turn"]
+    assert (session.prefix_cache, model.released) == (None, 0)
+    stats = manager.stats()
+    assert (stats["hits"], stats["load_failures"], stats["entries"]) == (0, 1, 0)
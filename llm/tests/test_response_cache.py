@@ -0,0 +1,66 @@
+import asyncio
+
+from response_cache import ReplaySession, ResponseCache
+
+USAGE = {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}
+
+
+def test_key_covers_everything_that_changes_the_text():
+    key = ResponseCache.key("luna-small", None, "prompt", 16, ["END"])
+    assert key == ResponseCache.key("luna-small", None, "prompt", 16, ["END"])
+    assert len({
+        key,
+        ResponseCache.key("luna-large", None, "prompt", 16, ["END"]),
+        ResponseCache.key("luna-small", "pirate", "prompt", 16, ["END"]),
+        ResponseCache.key("luna-small", None, "prompt!", 16, ["END"]),
+        ResponseCache.key("luna-small", None, "prompt", 32, ["END"]),
+        ResponseCache.key("luna-small", None, "prompt", 16, None),
+    }) == 6
+
+
+def test_lru_eviction_by_entries():
+    cache = ResponseCache(max_bytes=1 << 20, max_entries=2)
+    cache.put("a", "A", "stop", USAGE)
+    cache.put("b", "B", "stop", USAGE)
+    assert cache.get("a").text == "A"
+    cache.put("c", "C", "stop", USAGE)
+    assert cache.get("b") is None
+    assert [cache.get(key).text for key in ("a", "c")] == ["A", "C"]
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"], stats["evictions"]) == (2, 3, 1, 1)
+
+
+def test_size_limit_evicts_and_skips_oversized_entries():
+    cache = ResponseCache(max_bytes=1000)
+    assert cache.put("huge", "x" * 2000, "length", USAGE) is None
+    cache.put("a", "x" * 400, "stop", USAGE)
+    cache.put("b", "y" * 400, "stop", USAGE)
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+
+
+def test_entries_survive_a_restart(tmp_path):
+    cache = ResponseCache(max_bytes=1 << 20, max_entries=2, cache_dir=str(tmp_path))
+    cache.put("a", "A", "stop", USAGE)
+    cache.put("b", "B", "length", USAGE)
+    cache.put("c", "C", "stop", USAGE)
+    # Evicted entries are removed from disk too
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["b.json", "c.json"]
+
+    reloaded = ResponseCache(max_bytes=1 << 20, cache_dir=str(tmp_path))
+    cached = reloaded.get("b")
+    assert (cached.text, cached.finish_reason, cached.usage) == ("B", "length", USAGE)
+    assert reloaded.get("a") is None
+
+
+def test_replay_session_chunks_the_cached_text():
+    cache = ResponseCache(max_bytes=1 << 20)
+    session = ReplaySession(cache.put("a", "abcdefghij", "stop", USAGE), chunk_chars=4)
+    assert list(session) == ["abcd", "efgh", "ij"]
+    assert list(session.batches()) == [["abcd"], ["efgh"], ["ij"]]
+    assert session.wait() == "abcdefghij"
+    assert session.usage() == USAGE and session.usage() is not USAGE
+
+    async def collect():
+        return [batch async for batch in session.abatches()]
+    assert asyncio.run(collect()) == [["abcd"], ["efgh"], ["ij"]]
@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+import pytest
+
+from scoring import log_softmax, score_continuations, top_tokens
+
+VOCAB = 8
+
+
+def context_logprobs(ids):
+    """Deterministic next-token distribution for a context"""
+    rng = np.random.default_rng(hash(tuple(ids)) % (2 ** 32))
+    return log_softmax(rng.normal(size=VOCAB).astype(np.float32))
+
+
+class FakeRuntime:
+    """logprobs_for() of a runtime returning the last row only, or a row per position"""
+
+    def __init__(self, rows_per_position):
+        self.rows_per_position = rows_per_position
+        self.prefilled = []
+
+    def __call__(self, ids):
+        self.prefilled.append(tuple(ids))
+        if self.rows_per_position:
+            return np.stack([context_logprobs(ids[:n]) for n in range(1, len(ids) + 1)])
+        return context_logprobs(ids)[None, :]
+
+
+def expected_logprob(prompt, candidate):
+    return sum(float(context_logprobs(list(prompt) + list(candidate[:k]))[token]) for k, token in enumerate(candidate))
+
+
+@pytest.mark.parametrize("rows_per_position", [False, True])
+def test_teacher_forced_sum_over_candidate_tokens(rows_per_position):
+    prompt, candidates = [5, 1], [[3], [3, 4, 2], [6, 0]]
+    runtime = FakeRuntime(rows_per_position)
+    scores, next_token, prefills = score_continuations(runtime, prompt, candidates)
+    for scored, candidate in zip(scores, candidates):
+        assert scored["logprob"] == pytest.approx(expected_logprob(prompt, candidate), abs=1e-5)
+        assert len(scored["token_logprobs"]) == len(candidate)
+    assert sum(scored["prob"] for scored in scores) == pytest.approx(1.0)
+    np.testing.assert_allclose(next_token, context_logprobs(prompt))
+    assert prefills == len(runtime.prefilled)
+
+
+def test_shared_contexts_are_prefilled_once():
+    runtime = FakeRuntime(rows_per_position=False)
+    # Prompt, prompt+3, prompt+3+4 and prompt+6: the shared "3" prefix is run once
+    _, _, prefills = score_continuations(runtime, [5], [[3], [3, 4, 2], [3, 4], [6, 1]])
+    assert sorted(runtime.prefilled) == [(5,), (5, 3), (5, 3, 4), (5, 6)]
+    assert prefills == 4
+
+
+def test_row_per_position_needs_one_prefill_per_candidate():
+    runtime = FakeRuntime(rows_per_position=True)
+    _, _, prefills = score_continuations(runtime, [5], [[3, 4, 2], [6, 1]])
+    assert prefills == 2
+
+
+def test_candidates_may_share_their_first_token():
+    scores, _, _ = score_continuations(FakeRuntime(False), [2], [[1, 4], [1, 5]])
+    assert scores[0]["token_logprobs"][0] == scores[1]["token_logprobs"][0]
+    assert scores[0]["logprob"] != scores[1]["logprob"]
+
+
+def test_log_softmax_rows_and_top_tokens():
+    logprobs = log_softmax(np.array([[0.0, 1.0, 2.0], [3.0, 3.0, 3.0]], dtype=np.float32))
+    np.testing.assert_allclose(np.exp(logprobs).sum(axis=-1), [1.0, 1.0], rtol=1e-6)
+    assert logprobs[1][0] == pytest.approx(-math.log(3))
+    assert [token_id for token_id, _ in top_tokens(logprobs[0], 2)] == [2, 1]
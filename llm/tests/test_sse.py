@@ -0,0 +1,35 @@
+import json
+
+from sse import ChunkEncoder, StreamStats
+
+
+def test_frames_are_complete_chunk_events():
+    encoder = ChunkEncoder("chatcmpl-1", 1700000000, "luna-small")
+    frame = encoder.content(["Hel", "lo \"", "wörld\n"])
+    assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+    chunk = json.loads(frame[len(b"data: "):])
+    assert chunk == {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "luna-small",
+        "choices": [{"index": 0, "delta": {"content": "Hello \"wörld\n"}, "finish_reason": None}],
+    }
+
+
+def test_stats_count_tokens_per_frame():
+    stats = StreamStats()
+    encoder = ChunkEncoder("chatcmpl-1", 0, "luna-small", stats)
+    sizes = [len(encoder.content(["a", "b", "c"])), len(encoder.content(["d"]))]
+    encoder.done()
+    summary = stats.stats()
+    assert (summary["streams"], summary["frames"], summary["tokens"]) == (1, 2, 4)
+    assert summary["bytes"] == sum(sizes)
+    assert summary["tokens_per_frame"] == 2.0
+
+
+def test_stream_without_frames_is_not_recorded():
+    stats = StreamStats()
+    ChunkEncoder("chatcmpl-1", 0, "luna-small", stats).done()
+    assert stats.stats()["streams"] == 0
+    assert stats.stats()["frames_per_second"] == 0.0
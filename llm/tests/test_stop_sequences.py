@@ -0,0 +1,72 @@
+from stop_sequences import StopSequenceMatcher
+
+
+def feed_all(matcher, chunks):
+    out = []
+    for chunk in chunks:
+        text, matched = matcher.feed(chunk)
+        out.append(text)
+        if matched:
+            break
+    return "".join(out)
+
+
+def test_match_split_across_chunks():
+    matcher = StopSequenceMatcher(["</answer>"])
+    assert feed_all(matcher, ["The answer is 4</an", "sw", "er> and more"]) == "The answer is 4"
+    assert matcher.matched == "</answer>"
+    assert matcher.feed("ignored") == ("", True)
+
+
+def test_partial_match_is_held_back_then_released():
+    matcher = StopSequenceMatcher(["STOP"])
+    assert matcher.feed("go ST") == ("go ", False)
+    assert matcher.feed("OP?") == ("", True)
+    matcher = StopSequenceMatcher(["STOP"])
+    assert matcher.feed("go ST") == ("go ", False)
+    assert matcher.feed("ART") == ("START", False)
+
+
+def test_overlapping_stops_cut_at_earliest_completed():
+    matcher = StopSequenceMatcher(["abcd", "bc"])
+    assert feed_all(matcher, ["xa", "bc", "d"]) == "xa"
+    assert matcher.matched == "bc"
+
+
+def test_stop_that_is_suffix_of_another_prefix():
+    # "aab" fails over into "ab" after "aa"
+    matcher = StopSequenceMatcher(["aab", "ab"])
+    assert feed_all(matcher, ["a", "a", "b"]) == ""
+    assert matcher.matched == "aab"
+
+
+def test_flush_releases_held_text_without_match():
+    matcher = StopSequenceMatcher(["ndQQ"])
+    assert feed_all(matcher, ["runtime sta", "nd"]) == "runtime sta"
+    assert matcher.matched is None
+    assert matcher.flush() == "nd"
+    assert matcher.flush() == ""
+
+
+def session_output(chunks, stop, max_tokens=None):
+    from server import GenerationSession
+    session = GenerationSession("prompt", max_tokens=max_tokens, stop=stop)
+    for chunk in chunks:
+        session.on_token(chunk)
+    session.on_finish(None)
+    return "".join(session.chunks), session.finish_reason
+
+
+def test_session_flushes_tail_on_length():
+    text, finish_reason = session_output(["runtime ", "sta", "nd"], ["ndQQ"], max_tokens=3)
+    assert (text, finish_reason) == ("runtime stand", "length")
+
+
+def test_session_flushes_tail_on_natural_end():
+    text, finish_reason = session_output(["It is 1:30p", "m."], ["m.Z"])
+    assert (text, finish_reason) == ("It is 1:30pm.", "stop")
+
+
+def test_session_drops_stop_string_and_rest():
+    text, finish_reason = session_output(["one two", " END", " three"], [" END"])
+    assert (text, finish_reason) == ("one two", "stop")
@@ -0,0 +1,49 @@
+from tool_call_parser import StreamingToolCallParser, ToolCallDelta
+
+
+def feed_in_pieces(parser, text, size=3):
+    events = []
+    for start in range(0, len(text), size):
+        events += parser.feed(text[start:start + size])
+    return events + parser.finish()
+
+
+def deltas(events):
+    return [event.to_dict() for event in events if isinstance(event, ToolCallDelta)]
+
+
+def test_content_and_call_deltas():
+    parser = StreamingToolCallParser()
+    events = feed_in_pieces(parser, 'Checking. <tool_call>{"name": "clock", "arguments": {"tz": "UTC"}}</tool_call>')
+    assert "".join(event for event in events if isinstance(event, str)) == "Checking. "
+    start, arguments = deltas(events)
+    assert start == {"index": 0, "id": parser.calls[0]["id"], "type": "function", "function": {"name": "clock", "arguments": ""}}
+    assert arguments == {"index": 0, "function": {"arguments": '{"tz": "UTC"}'}}
+
+
+def test_invalid_call_sends_no_delta_and_keeps_indices():
+    parser = StreamingToolCallParser()
+    events = feed_in_pieces(parser, (
+        '<tool_call>{"name": "clock", "arguments": {broken</tool_call>\n'
+        '<tool_call>{"name": "weather", "arguments": {}}</tool_call>'
+    ))
+    sent = deltas(events)
+    assert [delta["index"] for delta in sent] == [0, 0]
+    assert sent[0]["function"]["name"] == "weather"
+    assert sent[0]["id"] == parser.calls[0]["id"]
+    assert [call["function"]["name"] for call in parser.calls] == ["weather"]
+
+
+def test_text_after_the_last_call_marks_the_parser_done():
+    parser = StreamingToolCallParser()
+    parser.feed('<tool_call>{"name": "clock"}</tool_call>')
+    assert not parser.done
+    parser.feed("\nDone")
+    assert parser.done
+    assert parser.calls[0]["function"]["arguments"] == "{}"
+
+
+def test_partial_open_tag_is_held_back():
+    parser = StreamingToolCallParser()
+    assert parser.feed("Hi <tool") == ["Hi "]
+    assert parser.feed("box") == ["<toolbox"]
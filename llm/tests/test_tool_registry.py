@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+from tool_registry import ToolRegistry, tool
+
+
+def test_results_in_call_order_with_errors():
+    def add(a, b):
+        return a + b
+
+    def fail():
+        raise RuntimeError("boom")
+
+    registry = ToolRegistry(builtin_tools={"add": add, "fail": fail})
+    results = registry.execute_many([("add", {"a": 1, "b": 2}), ("fail", {}), ("missing", {}), ("add", [1, 2])])
+    assert results[0] == 3
+    assert results[1] == {"error": "Tool execution failed: boom"}
+    assert "not found" in results[2]["error"]
+    assert "must be an object" in results[3]["error"]
+    assert registry.stats()["errors"] == 1
+
+
+def test_timeout_starts_when_each_call_starts():
+    # More parallel calls than the old pool had threads; none should time out
+    @tool(timeout=0.5)
+    def nap():
+        time.sleep(0.2)
+        return "ok"
+
+    registry = ToolRegistry(builtin_tools={"nap": nap})
+    started = time.time()
+    assert registry.execute_many([("nap", {})] * 8) == ["ok"] * 8
+    assert time.time() - started < 0.5
+    assert registry.stats()["timeouts"] == 0
+
+
+def test_timed_out_calls_are_capped_per_tool():
+    release = threading.Event()
+
+    @tool(timeout=0.05)
+    def hang():
+        release.wait(5)
+        return "late"
+
+    def quick():
+        return "fine"
+
+    registry = ToolRegistry(builtin_tools={"hang": hang, "quick": quick}, max_stuck=2)
+    results = registry.execute_many([("hang", {}), ("hang", {})])
+    assert all("timed out" in result["error"] for result in results)
+    assert registry.stats()["stuck"] == 2
+
+    # The hung tool is refused without starting another thread; other tools still run
+    results = registry.execute_many([("hang", {}), ("quick", {})])
+    assert "unavailable" in results[0]["error"]
+    assert results[1] == "fine"
+    assert registry.stats()["refused"] == 1
+
+    release.set()
+    deadline = time.time() + 5
+    while registry.stats()["stuck"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert registry.stats()["stuck"] == 0
+    assert registry.execute("hang", {}) == "late"
+
+
+def test_cache_ttl_reuses_results():
+    calls = []
+
+    @tool(cache_ttl=60)
+    def lookup(key):
+        calls.append(key)
+        return key.upper()
+
+    registry = ToolRegistry(builtin_tools={"lookup": lookup})
+    assert registry.execute("lookup", {"key": "a"}) == "A"
+    assert registry.execute("lookup", {"key": "a"}) == "A"
+    assert registry.execute("lookup", {"key": "b"}) == "B"
+    assert calls == ["a", "b"]
+    assert registry.stats()["cache_hits"] == 1
+
+
+def test_uncached_tools_run_every_time():
+    calls = []
+
+    def ping():
+        calls.append(1)
+        return len(calls)
+
+    registry = ToolRegistry(builtin_tools={"ping": ping})
+    assert [registry.execute("ping", {}) for _ in range(3)] == [1, 2, 3]
+
+
+def write_tool_file(path, body, mtime):
+    path.write_text(body)
+    os.utime(path, (mtime, mtime))
+
+
+def test_hot_reload_picks_up_changes_and_removals(tmp_path):
+    weather = tmp_path / "weather.py"
+    write_tool_file(weather, "def get_weather(city):\n    return 'sunny in ' + city\n", 1000)
+    write_tool_file(tmp_path / "_private.py", "def hidden():\n    return 1\n", 1000)
+    registry = ToolRegistry(tools_dir=str(tmp_path))
+    assert registry.load() is True
+    assert registry.names() == ["get_weather"]
+    assert registry.execute("get_weather", {"city": "Oslo"}) == "sunny in Oslo"
+    assert registry.load() is False
+
+    write_tool_file(weather, "def get_weather(city):\n    return 'rain in ' + city\n\ndef get_wind():\n    return 3\n", 2000)
+    assert registry.load() is True
+    assert registry.names() == ["get_weather", "get_wind"]
+    assert registry.execute("get_weather", {"city": "Oslo"}) == "rain in Oslo"
+    assert registry.stats()["reloads"] == 1
+
+    # A file that fails to import keeps its previous tools
+    write_tool_file(weather, "def get_weather(city):\n    return (\n", 3000)
+    registry.load()
+    assert registry.execute("get_weather", {"city": "Oslo"}) == "rain in Oslo"
+
+    weather.unlink()
+    registry.load()
+    assert registry.names() == []
+
+
+def test_direct_response_needs_every_tool_to_answer():
+    @tool(response_template="It is {temperature} degrees in {city}.")
+    def get_weather(city):
+        return {"city": city, "temperature": 21}
+
+    def get_wind():
+        return 3
+
+    registry = ToolRegistry(builtin_tools={"get_weather": get_weather, "get_wind": get_wind})
+    calls = [("get_weather", {"city": "Oslo"})]
+    assert registry.direct_response(calls, registry.execute_many(calls)) == "It is 21 degrees in Oslo."
+    calls.append(("get_wind", {}))
+    assert registry.direct_response(calls, registry.execute_many(calls)) is None
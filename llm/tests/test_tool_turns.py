@@ -0,0 +1,76 @@
+import pytest
+
+import server
+import tool_registry
+
+
+def finished_session(chunks, tool_parser=None, max_tokens=None, stop=None):
+    """A GenerationSession that has already run, replaying `chunks` as its tokens"""
+    session = server.GenerationSession("prompt", max_tokens=max_tokens, stop=stop, tool_parser=tool_parser)
+    for chunk in chunks:
+        session.on_token(chunk)
+    session.on_finish(None)
+    return session
+
+
+@pytest.fixture
+def first_pass(monkeypatch):
+    """Make start_generation return a first pass that produced the given chunks"""
+    def install(chunks, **kwargs):
+        def start_generation(prompt, model_name=None, **options):
+            return finished_session(chunks, tool_parser=options.get("tool_parser"), **kwargs)
+        monkeypatch.setattr(server, "start_generation", start_generation)
+    return install
+
+
+def run_turn(stop):
+    turn = server.ToolTurn([{"role": "user", "content": "hi"}])
+    tools = [{"type": "function", "function": {"name": "noop", "parameters": {}}}]
+    events = list(server.tool_turn_events(turn, tools, stop=stop))
+    return "".join(event for event in events if isinstance(event, str)), turn
+
+
+def test_natural_end_keeps_text_held_for_partial_stop(first_pass):
+    first_pass(["The model re", "al"])
+    text, turn = run_turn(["alX"])
+    assert text == "The model real"
+    assert turn.finish_reason == "stop"
+
+
+def test_length_end_keeps_text_held_for_partial_stop(first_pass):
+    first_pass(["The model re", "al"], max_tokens=2)
+    text, turn = run_turn(["alX"])
+    assert text == "The model real"
+    assert turn.finish_reason == "length"
+
+
+def test_stop_string_cuts_first_pass(first_pass):
+    first_pass(["The model", " END", " more"])
+    text, turn = run_turn([" END"])
+    assert text == "The model"
+    assert turn.finish_reason == "stop"
+
+
+@pytest.fixture
+def clock_tool(monkeypatch):
+    @tool_registry.tool(response_template="It is {time}.")
+    def clock():
+        return {"time": "1:30pm"}
+    monkeypatch.setattr(server, "tool_registry", tool_registry.ToolRegistry(builtin_tools={"clock": clock}))
+
+
+CLOCK_CALL = '<tool_call>{"name": "clock", "arguments": {}}</tool_call>'
+
+
+def test_direct_answer_keeps_text_held_for_partial_stop(first_pass, clock_tool):
+    first_pass([CLOCK_CALL])
+    text, turn = run_turn(["m.Z"])
+    assert text == "It is 1:30pm."
+    assert turn.path == "direct"
+
+
+def test_direct_answer_is_cut_at_stop(first_pass, clock_tool):
+    first_pass([CLOCK_CALL])
+    text, turn = run_turn(["30"])
+    assert text == "It is 1:"
+    assert turn.path == "direct"
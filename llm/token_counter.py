@@ -0,0 +1,152 @@
+"""
+Token counting for the RKLLM server.
+The tokenizer is loaded once and shared. It prefers the model's own
+tokenizer.json through the `tokenizers` library, then tiktoken's GPT-2
+encoding, then a whitespace split so the server keeps running without either.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def _prompt_hash(text):
+    return hashlib.blake2b(text.encode('utf-8', 'ignore'), digest_size=16).digest()
+
+
+class TokenCounter:
+    """Shared tokenizer with an LRU cache of counts keyed by text hash."""
+
+    def __init__(self, tokenizer_path=None, cache_size=2048):
+        self.tokenizer_path = tokenizer_path
+        self.cache_size = cache_size
+        self.backend = None
+        self._encode = None
+        self._encode_batch = None
+        self._tokenizer = None  # The model's own tokenizer, when loaded
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Load the tokenizer. Called at startup; later calls are no-ops."""
+        with self._load_lock:
+            if self.backend is not None:
+                return self.backend
+
+            if self.tokenizer_path and os.path.exists(self.tokenizer_path):
+                try:
+                    from tokenizers import Tokenizer  # type: ignore
+                    tokenizer = Tokenizer.from_file(self.tokenizer_path)
+                    self._encode = lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+                    self._encode_batch = lambda texts: [
+                        len(encoding.ids)
+                        for encoding in tokenizer.encode_batch(texts, add_special_tokens=False)
+                    ]
+                    self._tokenizer = tokenizer
+                    self.backend = "tokenizers"
+                except Exception as e:
+                    print(f"Could not load tokenizer from {self.tokenizer_path}: {e}")
+
+            if self.backend is None:
+                try:
+                    import tiktoken  # type: ignore
+                    encoding = tiktoken.get_encoding("gpt2")
+                    self._encode = lambda text: len(encoding.encode(text, disallowed_special=()))
+                    self._encode_batch = lambda texts: [
+                        len(ids) for ids in encoding.encode_batch(texts, disallowed_special=())
+                    ]
+                    self.backend = "tiktoken-gpt2"
+                except Exception:
+                    pass
+
+            if self.backend is None:
+                # Fallback keeps the server functional without any tokenizer installed
+                self._encode = lambda text: len(text.split())
+                self._encode_batch = lambda texts: [len(text.split()) for text in texts]
+                self.backend = "whitespace"
+
+            print(f"Token counter using {self.backend} backend")
+            return self.backend
+
+    def _lookup(self, key):
+        with self._lock:
+            count = self._cache.get(key)
+            if count is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return count
+
+    def _store(self, key, count):
+        with self._lock:
+            self._cache[key] = count
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def count(self, text):
+        """Return the number of tokens in `text`."""
+        if not text:
+            return 0
+        if self.backend is None:
+            self.load()
+        key = _prompt_hash(text)
+        count = self._lookup(key)
+        if count is None:
+            count = self._encode(text)
+            self._store(key, count)
+        return count
+
+    def count_batch(self, texts):
+        """Return token counts for several texts, encoding all cache misses in one batch."""
+        if self.backend is None:
+            self.load()
+        counts = [0] * len(texts)
+        missing = []
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+            key = _prompt_hash(text)
+            count = self._lookup(key)
+            if count is None:
+                missing.append((i, key, text))
+            else:
+                counts[i] = count
+        if missing:
+            for (i, key, _), count in zip(missing, self._encode_batch([text for _, _, text in missing])):
+                counts[i] = count
+                self._store(key, count)
+        return counts
+
+    @property
+    def has_model_tokenizer(self):
+        """Whether token ids match the model's vocabulary (only with the model's tokenizer.json)"""
+        if self.backend is None:
+            self.load()
+        return self._tokenizer is not None
+
+    def encode(self, text):
+        """Token ids of `text` in the model's vocabulary. Requires has_model_tokenizer."""
+        if not self.has_model_tokenizer:
+            raise RuntimeError(f"token ids need the model tokenizer ({self.tokenizer_path})")
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+
+    def decode(self, ids):
+        if not self.has_model_tokenizer:
+            raise RuntimeError(f"token ids need the model tokenizer ({self.tokenizer_path})")
+        return self._tokenizer.decode(ids, skip_special_tokens=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "cached_entries": len(self._cache),
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+            }
+
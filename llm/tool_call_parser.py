@@ -0,0 +1,126 @@
+"""
+Incremental parsing of <tool_call> blocks from streamed model output.
+Text outside the tags is passed through as content as soon as it cannot be
+the start of a tag. A block is emitted as OpenAI `tool_calls` deltas (its id
+and name, then its arguments) once it closes and parses as JSON; a block
+that does not parse is dropped without a delta, so delta indices always
+match `calls`. After a block closes the parser only waits to see
+whether another block follows; anything else marks the parser done so the
+caller can stop decoding.
+"""
+
+import json
+import uuid
+
+OPEN_TAG = "<tool_call>"
+CLOSE_TAG = "</tool_call>"
+
+
+class ToolCallDelta:
+    """One OpenAI `tool_calls` delta: the call's start (id and name) or its arguments."""
+
+    def __init__(self, index, call_id=None, name=None, arguments=None):
+        self.index = index
+        self.id = call_id
+        self.name = name
+        self.arguments = arguments
+
+    def to_dict(self):
+        delta = {"index": self.index}
+        function = {}
+        if self.id is not None:
+            delta["id"] = self.id
+            delta["type"] = "function"
+            function["name"] = self.name
+            function["arguments"] = ""
+        if self.arguments is not None:
+            function["arguments"] = self.arguments
+        delta["function"] = function
+        return delta
+
+
+def _held_back(buffer, tag):
+    """Length of the longest suffix of `buffer` that could still grow into `tag`"""
+    for length in range(min(len(buffer), len(tag) - 1), 0, -1):
+        if tag.startswith(buffer[-length:]):
+            return length
+    return 0
+
+
+class StreamingToolCallParser:
+    def __init__(self):
+        self.mode = "content"  # "content", "call" (inside a block) or "after_call"
+        self.buffer = ""
+        self.calls = []  # Complete tool calls in OpenAI format
+        self.done = False  # A block closed and something other than another block followed
+        self._call_id = None
+
+    def feed(self, text):
+        """Consume streamed text and return the events it completes: content strings and ToolCallDeltas"""
+        if self.done:
+            return []
+        self.buffer += text
+        events = []
+        while self.buffer and not self.done:
+            if self.mode == "content":
+                start = self.buffer.find(OPEN_TAG)
+                if start < 0:
+                    keep = _held_back(self.buffer, OPEN_TAG)
+                    content, self.buffer = self.buffer[:len(self.buffer) - keep], self.buffer[len(self.buffer) - keep:]
+                    if content:
+                        events.append(content)
+                    break
+                if start:
+                    events.append(self.buffer[:start])
+                self._open_call()
+                self.buffer = self.buffer[start + len(OPEN_TAG):]
+            elif self.mode == "call":
+                end = self.buffer.find(CLOSE_TAG)
+                if end < 0:
+                    break
+                events.extend(self._close_call(self.buffer[:end]))
+                self.buffer = self.buffer[end + len(CLOSE_TAG):]
+                self.mode = "after_call"
+            else:
+                rest = self.buffer.lstrip()
+                if rest.startswith(OPEN_TAG):
+                    self._open_call()
+                    self.buffer = rest[len(OPEN_TAG):]
+                elif rest and not OPEN_TAG.startswith(rest):
+                    # Trailing text after the last call is not needed
+                    self.done = True
+                else:
+                    break
+        return events
+
+    def finish(self):
+        """Events for whatever is still buffered once generation has ended"""
+        events = []
+        if self.mode == "content" and self.buffer:
+            events.append(self.buffer)
+        elif self.mode == "call":
+            print("Tool call was not closed before generation ended")
+        self.buffer = ""
+        return events
+
+    def _open_call(self):
+        self.mode = "call"
+        self._call_id = f"call_{uuid.uuid4()}"
+
+    def _close_call(self, body):
+        index = len(self.calls)
+        try:
+            tool_data = json.loads(body.strip())
+            name = tool_data["name"]
+            arguments = json.dumps(tool_data.get("arguments", {}))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Error parsing tool call: {e}")
+            return []
+        # Announced only now: a name sent before the arguments parse could leave clients a broken call at this index
+        events = [ToolCallDelta(index, self._call_id, name), ToolCallDelta(index, arguments=arguments)]
+        self.calls.append({
+            "id": self._call_id,
+            "type": "function",
+            "function": {"name": name, "arguments": arguments}
+        })
+        return events
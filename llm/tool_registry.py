@@ -0,0 +1,332 @@
+"""
+Tool registry for the RKLLM server.
+Every public function defined in a Python file in the tools directory
+becomes a tool named after the function. Files are imported once at startup
+and re-imported when they change on disk. Tool calls from one model turn run
+in parallel, each on its own thread with a timeout that starts when the call
+does, and tools marked with a cache TTL reuse results for identical arguments.
+A thread cannot be killed, so a call that times out keeps running in the
+background; once a tool has `max_stuck` such calls, further calls to it are
+refused until one of them returns. Tools with a
+response template (or marked direct) answer the user from their result
+without a second model pass.
+
+A tool module can tune its tools with the decorator:
+
+    from tool_registry import tool
+
+    @tool(timeout=5, cache_ttl=60, response_template="It is {temperature} degrees in {city}.")
+    def get_weather(city):
+        ...
+"""
+
+import importlib.util
+import inspect
+import json
+import os
+import threading
+import time
+
+
+def tool(timeout=None, cache_ttl=None, response_template=None, direct=False):
+    """
+    Mark a function as a tool with its own timeout (seconds) and result cache
+    TTL (seconds). `response_template` is formatted with the result's fields
+    (and the whole result as {result}) to answer without a second model pass;
+    `direct` returns the result itself as the answer.
+    """
+    def decorate(func):
+        func._tool_options = {
+            "timeout": timeout,
+            "cache_ttl": cache_ttl,
+            "response_template": response_template,
+            "direct": direct,
+        }
+        return func
+    return decorate
+
+
+class ToolSpec:
+    def __init__(self, name, func, source=None, timeout=None, cache_ttl=None, response_template=None, direct=False):
+        self.name = name
+        self.func = func
+        self.source = source  # File the tool was loaded from, None for built-in tools
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.response_template = response_template
+        self.direct = direct
+
+    @classmethod
+    def from_function(cls, func, source=None):
+        options = getattr(func, '_tool_options', {})
+        return cls(
+            func.__name__, func, source,
+            timeout=options.get("timeout"),
+            cache_ttl=options.get("cache_ttl"),
+            response_template=options.get("response_template"),
+            direct=options.get("direct", False),
+        )
+
+    def format_response(self, result):
+        """
+        The user-facing answer for `result` when the tool answers directly, or
+        None when the model should write the answer (no template, an error
+        result, or a template the result does not fill).
+        """
+        if isinstance(result, dict) and "error" in result:
+            return None
+        if self.response_template:
+            fields = dict(result) if isinstance(result, dict) else {}
+            fields["result"] = result
+            try:
+                return self.response_template.format(**fields)
+            except (KeyError, IndexError, ValueError):
+                return None
+        if self.direct:
+            return result if isinstance(result, str) else json.dumps(result)
+        return None
+
+
+class ToolCall:
+    """One tool call running on its own thread"""
+
+    def __init__(self, registry, spec, arguments):
+        self.registry = registry
+        self.spec = spec
+        self.arguments = arguments
+        self.timeout = spec.timeout or registry.default_timeout
+        self.started = None
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False  # Timed out while still running
+        self._thread = threading.Thread(target=self._run, name=f"tool-{spec.name}", daemon=True)
+
+    def start(self):
+        self.started = time.time()
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.result = self.registry._call(self.spec, self.arguments)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.registry._finished(self)
+
+    def wait(self):
+        """True if the call finished within its timeout, counted from when it started"""
+        return self.done.wait(max(self.started + self.timeout - time.time(), 0))
+
+
+class ToolRegistry:
+    def __init__(self, tools_dir=None, builtin_tools=None, default_timeout=10.0, max_stuck=4):
+        self.tools_dir = tools_dir
+        self.default_timeout = default_timeout
+        self._builtin = {name: ToolSpec.from_function(func) for name, func in (builtin_tools or {}).items()}
+        self._file_tools = {}
+        self._mtimes = {}  # path -> mtime of the version that is loaded
+        self._lock = threading.Lock()
+        self._cache = {}  # (name, arguments json) -> (expires_at, result)
+        self._cache_lock = threading.Lock()
+        self.max_stuck = max_stuck
+        self._stuck = {}  # Tool name -> calls that timed out and are still running
+        self._watcher = None
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.refused = 0
+        self.reloads = 0
+        self.turns = {"direct": 0, "synthesis": 0}  # How tool turns were answered
+
+    def _tool_files(self):
+        if not self.tools_dir or not os.path.isdir(self.tools_dir):
+            return {}
+        files = {}
+        for name in sorted(os.listdir(self.tools_dir)):
+            if name.endswith(".py") and not name.startswith("_"):
+                path = os.path.join(self.tools_dir, name)
+                files[path] = os.path.getmtime(path)
+        return files
+
+    def _import_file(self, path):
+        module_name = f"luna_tools_{os.path.splitext(os.path.basename(path))[0]}"
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return [
+            ToolSpec.from_function(func, path)
+            for name, func in inspect.getmembers(module, inspect.isfunction)
+            if not name.startswith("_") and func.__module__ == module_name
+        ]
+
+    def load(self):
+        """Import changed, new and removed tool files. Returns True if anything changed."""
+        files = self._tool_files()
+        with self._lock:
+            if files == self._mtimes:
+                return False
+            tools = {name: spec for name, spec in self._file_tools.items() if spec.source in files}
+            for path, mtime in files.items():
+                if self._mtimes.get(path) == mtime:
+                    continue
+                try:
+                    specs = self._import_file(path)
+                except Exception as e:
+                    # Keep the previous version of a file that fails to import
+                    print(f"Error loading tools from {path}: {e}")
+                    continue
+                tools = {name: spec for name, spec in tools.items() if spec.source != path}
+                for spec in specs:
+                    tools[spec.name] = spec
+            reloaded = bool(self._mtimes)
+            self._file_tools = tools
+            self._mtimes = files
+            if reloaded:
+                self.reloads += 1
+        with self._cache_lock:
+            self._cache.clear()
+        print(f"Loaded tools: {self.names()}")
+        return True
+
+    def watch(self, interval=2.0):
+        """Reload tool files in the background when they change"""
+        if self._watcher is not None or not self.tools_dir:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.load()
+                except Exception as e:
+                    print(f"Error reloading tools: {e}")
+
+        self._watcher = threading.Thread(target=run, name="tool-watcher", daemon=True)
+        self._watcher.start()
+
+    def get(self, name):
+        """Built-in tools take precedence over tools loaded from files"""
+        with self._lock:
+            return self._builtin.get(name) or self._file_tools.get(name)
+
+    def names(self):
+        with self._lock:
+            return sorted(set(self._builtin) | set(self._file_tools))
+
+    def _cache_key(self, name, arguments):
+        return name, json.dumps(arguments, sort_keys=True, default=str)
+
+    def _cached(self, spec, arguments):
+        if not spec.cache_ttl:
+            return None
+        with self._cache_lock:
+            entry = self._cache.get(self._cache_key(spec.name, arguments))
+            if entry is None or entry[0] < time.time():
+                return None
+            self.cache_hits += 1
+            return entry
+
+    def _call(self, spec, arguments):
+        result = spec.func(**arguments)
+        if spec.cache_ttl:
+            with self._cache_lock:
+                self._cache[self._cache_key(spec.name, arguments)] = (time.time() + spec.cache_ttl, result)
+        return result
+
+    def execute_many(self, calls):
+        """
+        Run (name, arguments) tool calls in parallel and return their results
+        in the same order. Failures and timeouts become {"error": ...} results
+        so the model can still answer.
+        """
+        results = [None] * len(calls)
+        running = []
+        for i, (name, arguments) in enumerate(calls):
+            self.calls += 1
+            spec = self.get(name)
+            if spec is None:
+                results[i] = {"error": f"Tool '{name}' not found"}
+                continue
+            if not isinstance(arguments, dict):
+                results[i] = {"error": f"Arguments for tool '{name}' must be an object"}
+                continue
+            cached = self._cached(spec, arguments)
+            if cached is not None:
+                results[i] = cached[1]
+                continue
+            with self._lock:
+                stuck = self._stuck.get(name, 0)
+            if stuck >= self.max_stuck:
+                self.refused += 1
+                results[i] = {"error": f"Tool '{name}' is unavailable: {stuck} earlier calls have not returned"}
+                continue
+            call = ToolCall(self, spec, arguments)
+            call.start()
+            running.append((i, call))
+
+        for i, call in running:
+            if not call.wait():
+                with self._lock:
+                    if not call.done.is_set():
+                        # The thread cannot be killed; its result is discarded when it finishes
+                        call.abandoned = True
+                        self._stuck[call.spec.name] = self._stuck.get(call.spec.name, 0) + 1
+                if call.abandoned:
+                    self.timeouts += 1
+                    results[i] = {"error": f"Tool '{call.spec.name}' timed out after {call.timeout:g}s"}
+                    continue
+            if call.error is not None:
+                self.errors += 1
+                results[i] = {"error": f"Tool execution failed: {str(call.error)}"}
+            else:
+                results[i] = call.result
+        return results
+
+    def _finished(self, call):
+        with self._lock:
+            call.done.set()
+            if call.abandoned:
+                self._stuck[call.spec.name] -= 1
+                if not self._stuck[call.spec.name]:
+                    del self._stuck[call.spec.name]
+
+    def execute(self, name, arguments):
+        return self.execute_many([(name, arguments)])[0]
+
+    def direct_response(self, calls, results):
+        """
+        Answer for a turn whose tools can all answer directly, joined in call
+        order, or None if any of them needs the model to write the answer.
+        """
+        answers = []
+        for (name, _), result in zip(calls, results):
+            spec = self.get(name)
+            answer = spec.format_response(result) if spec is not None else None
+            if answer is None:
+                return None
+            answers.append(answer)
+        return "\n".join(answers)
+
+    def record_turn(self, path):
+        with self._cache_lock:
+            self.turns[path] += 1
+
+    def stats(self):
+        with self._cache_lock:
+            cached_results = len(self._cache)
+        with self._lock:
+            stuck = sum(self._stuck.values())
+        return {
+            "loaded": self.names(),
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "stuck": stuck,
+            "refused": self.refused,
+            "cached_results": cached_results,
+            "reloads": self.reloads,
+            "turns": dict(self.turns),
+        }
@@ -18,6 +18,9 @@ LOG_FILE="/home/luna/luna-update.log"
 # Where to store backup before updating (for rollback)
 BACKUP_DIR="/home/luna/luna-server-backup"
 
+# How long services get to become ready after a start (model load and warm-up)
+READY_TIMEOUT=120
+
 # ==================== UTILITY FUNCTIONS ====================
 
 # Logging function - writes messages with timestamps to both console and log file
@@ -33,11 +36,14 @@ check_services() {
     local llm_status=0
     local status_status=0
     
-    # Test LLM service by hitting its health endpoint
+    # Test LLM service by hitting its readiness endpoint (503 until the model is loaded and warmed up)
     # curl -sf: s=silent (no progress), f=fail on HTTP errors
     # > /dev/null 2>&1: throw away all output
-    if curl -sf http://localhost:1306/health > /dev/null 2>&1; then
+    if curl -sf http://localhost:1306/readyz > /dev/null 2>&1; then
         llm_status=1  # Mark as healthy
+    elif [ "$(curl -s -o /dev/null -w '%{http_code}' http://localhost:1306/readyz)" = "404" ] \
+        && curl -sf http://localhost:1306/health > /dev/null 2>&1; then
+        llm_status=1  # Older version without /readyz (e.g. after a rollback)
     fi
     
     # Test Status service by hitting its recognition endpoint
@@ -53,6 +59,19 @@ check_services() {
     fi
 }
 
+# Wait until both services are ready instead of sleeping for a fixed time
+wait_for_services() {
+    local waited=0
+    while [ $waited -lt $READY_TIMEOUT ]; do
+        if check_services; then
+            return 0  # Ready
+        fi
+        sleep 2
+        waited=$((waited + 2))
+    done
+    return 1  # Still not ready after READY_TIMEOUT seconds
+}
+
 # Rollback function - restores previous working version when update fails
 rollback() {
     log "ROLLBACK: Rolling back to previous version"
@@ -78,11 +97,8 @@ rollback() {
     # Start services with the restored code
     sudo systemctl start llm.service status.service
     
-    # Wait for services to start up
-    sleep 15
-    
-    # Test if rollback worked
-    if check_services; then
+    # Wait for services to start up and test if rollback worked
+    if wait_for_services; then
         log "ROLLBACK: Services restored successfully"
         return 0  # Rollback succeeded
     else
@@ -179,12 +195,9 @@ perform_update() {
     log "UPDATE: Starting services"
     sudo systemctl start llm.service status.service
     
-    # Give services time to start up properly
+    # Wait until the services are ready (the LLM loads and warms up its model first)
     log "UPDATE: Waiting for services to start"
-    sleep 15
-    
-    # Test if update was successful
-    if check_services; then
+    if wait_for_services; then
         # Update successful!
         log "UPDATE: Update successful! Services are healthy"
         
@@ -4,16 +4,31 @@
 # Use user-accessible log location to avoid permission issues
 LOG_FILE="/home/luna/luna-health.log"
 
+# Seconds to wait for the LLM service to load and warm up the model after a restart
+READY_TIMEOUT=120
+
 log() {
     echo "$(date '+%Y-%m-%d %H:%M:%S') - $1" | tee -a "$LOG_FILE"
 }
 
-# Check LLM service
-if ! curl -sf http://localhost:1306/health > /dev/null 2>&1; then
+# Poll /readyz until the model is loaded and warmed up, or READY_TIMEOUT passes
+wait_for_llm_ready() {
+    local waited=0
+    while [ $waited -lt $READY_TIMEOUT ]; do
+        if curl -sf http://localhost:1306/readyz > /dev/null 2>&1; then
+            return 0
+        fi
+        sleep 2
+        waited=$((waited + 2))
+    done
+    return 1
+}
+
+# Check LLM service: /livez answers as soon as the process serves HTTP, even while the model loads
+if ! curl -sf http://localhost:1306/livez > /dev/null 2>&1; then
     log "HEALTH: LLM service is down, restarting"
     sudo systemctl restart llm.service
-    sleep 10
-    if curl -sf http://localhost:1306/health > /dev/null 2>&1; then
+    if wait_for_llm_ready; then
         log "HEALTH: LLM service restarted successfully"
     else
         log "HEALTH: LLM service failed to restart"